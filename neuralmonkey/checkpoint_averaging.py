@@ -0,0 +1,141 @@
+"""Averaging of the variables of multiple checkpoints.
+
+Averaging the parameters of several checkpoints of a single training run
+(e.g. the N best ones or the last N saved ones) gives a model which is
+usually better than any of the checkpoints alone and approaches the quality
+of an ensemble of the checkpoints, while it is run in a single session.
+
+The averaged variables are stored in a new checkpoint which can be loaded in
+the same way as any other variables file of the model.
+"""
+
+from typing import Dict, Iterable, List, Optional
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from typeguard import check_argument_types
+
+from neuralmonkey.logging import log
+
+
+def last_checkpoints(checkpoints: List[str], n: int) -> List[str]:
+    """Select the most recently saved checkpoints.
+
+    Arguments:
+        checkpoints: Prefixes of the checkpoints to choose from.
+        n: Number of the checkpoints to select.
+
+    Returns:
+        The prefixes of the ``n`` newest checkpoints, the newest first.
+    """
+    check_argument_types()
+    if n < 1:
+        raise ValueError("At least one checkpoint must be selected.")
+
+    mtimes = tf.train.get_checkpoint_mtimes(checkpoints)
+    if len(mtimes) != len(checkpoints):
+        raise ValueError("Some of the checkpoints do not exist: {}"
+                         .format(checkpoints))
+
+    order = np.argsort(mtimes)[::-1]
+    return [checkpoints[i] for i in order[:n]]
+
+
+def average_checkpoints(
+        checkpoints: List[str],
+        output_path: str,
+        variable_names: Optional[Iterable[str]] = None) -> None:
+    """Average variables of the checkpoints and save them as a checkpoint.
+
+    All the checkpoints must contain the same variables. The variables which
+    are not averaged (e.g. the global step or the integer variables) are
+    copied from the first checkpoint.
+
+    Arguments:
+        checkpoints: Prefixes of the averaged checkpoints.
+        output_path: Prefix of the checkpoint with the averaged variables.
+        variable_names: Names of the variables to average, usually the
+            trainable variables of the model. If not given, all the floating
+            point variables are averaged.
+    """
+    check_argument_types()
+    if not checkpoints:
+        raise ValueError("No checkpoints to average.")
+
+    readers = [tf.train.NewCheckpointReader(path) for path in checkpoints]
+    shapes = readers[0].get_variable_to_shape_map()
+
+    for path, reader in zip(checkpoints[1:], readers[1:]):
+        if reader.get_variable_to_shape_map() != shapes:
+            raise ValueError(
+                "Checkpoint {} has different variables than {}."
+                .format(path, checkpoints[0]))
+
+    values = {name: readers[0].get_tensor(name)
+              for name in shapes}  # type: Dict[str, np.ndarray]
+
+    if variable_names is None:
+        averaged = [name for name, value in values.items()
+                    if np.issubdtype(value.dtype, np.floating)]
+    else:
+        averaged = list(variable_names)
+        missing = [name for name in averaged if name not in values]
+        if missing:
+            raise ValueError("Variables missing in the checkpoints: {}"
+                             .format(", ".join(missing)))
+
+    for name in averaged:
+        total = values[name].astype(np.float64)
+        for reader in readers[1:]:
+            total += reader.get_tensor(name)
+        values[name] = (total / len(readers)).astype(values[name].dtype)
+
+    log("Averaged {} of {} variables from {} checkpoints."
+        .format(len(averaged), len(values), len(checkpoints)))
+    _save_values(values, output_path)
+    log("Averaged variables saved in {}".format(output_path))
+
+
+def _save_values(values: Dict[str, np.ndarray], output_path: str) -> None:
+    """Save numpy arrays as a checkpoint with the given variable names."""
+    with tf.Graph().as_default():
+        placeholders = {}
+        variables = {}
+        for i, (name, value) in enumerate(sorted(values.items())):
+            placeholders[name] = tf.placeholder(
+                tf.as_dtype(value.dtype), value.shape)
+            variables[name] = tf.Variable(placeholders[name],
+                                          name="variable_{}".format(i))
+
+        # the variables are stored under their original names
+        saver = tf.train.Saver(var_list=variables)
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer(),
+                        feed_dict={placeholders[name]: value
+                                   for name, value in values.items()})
+            saver.save(session, output_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Average the variables of multiple checkpoints.")
+    parser.add_argument("checkpoints", metavar="CHECKPOINT", nargs="+",
+                        help="prefixes of the checkpoints, e.g. "
+                        "experiment/variables.data.0")
+    parser.add_argument("-o", "--output", required=True,
+                        help="prefix of the averaged checkpoint")
+    parser.add_argument("-n", "--last", type=int, default=None,
+                        help="average only the given number of the most "
+                        "recently saved checkpoints")
+    args = parser.parse_args()
+
+    checkpoints = args.checkpoints
+    if args.last is not None:
+        checkpoints = last_checkpoints(checkpoints, args.last)
+
+    average_checkpoints(checkpoints, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,241 @@
 """ Implementation of the dataset class. """
 
+import copy
+import functools
+import glob
 import os
+import itertools
+import queue
 import random
 import re
 import collections
+import threading
 
-from typing import cast, Any, List, Callable, Iterable, Dict, Tuple, Union
+from typing import (cast, Any, List, Callable, Iterable, Dict, Tuple, Union,
+                    Optional, Sequence)
 
 import numpy as np
 from typeguard import check_argument_types
 
-from neuralmonkey.logging import log
+from neuralmonkey.logging import log, warn
+from neuralmonkey.processors.parallel import DEFAULT_CHUNK_SIZE, parallel_map
+from neuralmonkey.ragged import (RaggedSeriesBuilder, RaggedTokenSeries,
+                                 TokenTable)
+from neuralmonkey.readers.line_index import count_lines, iterate_lines
 from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+from neuralmonkey.series_cache import SeriesCache, get_cached_series_reader
 
 # pylint: disable=invalid-name
 Reader = Callable[[List[str]], Any]
+LengthKey = Callable[[Dict[str, Any]], int]
+Indices = Union[range, np.ndarray]
 # pylint: enable=invalid-name
 
+# number of examples that are bucketed together in lazy datasets by default
+LAZY_POOL_SIZE = 100000
+
+
+# pylint: disable=too-few-public-methods
+class BatchingScheme(object):
+    """Length-bucketed batching with a token budget.
+
+    Instead of cutting the data into batches with a fixed number of
+    sentences, the examples are grouped by their length and each batch is
+    filled up to a budget of (padded) tokens. This way, the batches are
+    length-homogeneous and the computation spent on padding is minimal. The
+    order of the batches is shuffled so that the training does not see the
+    data sorted by length.
+
+    The examples are bucketed within a pool of a limited size. For in-memory
+    datasets, the pool is the whole dataset by default, for lazy datasets, the
+    pool is a bounded look-ahead window to the data.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 token_budget: int,
+                 length_series: Optional[List[str]] = None,
+                 length_key: Optional[LengthKey] = None,
+                 max_batch_size: Optional[int] = None,
+                 pool_size: Optional[int] = None,
+                 shuffle_batches: bool = True) -> None:
+        """Create a new batching scheme.
+
+        Arguments:
+            token_budget: Maximum number of tokens in a batch, including the
+                padding, i.e. the number of examples in the batch multiplied
+                by the length of the longest one.
+            length_series: Series whose lengths determine the length of an
+                example (the maximum is taken). If None, all series with
+                items that have length are used.
+            length_key: A callable which takes a dictionary from series names
+                to the items of an example and returns the length of the
+                example. Overrides ``length_series``.
+            max_batch_size: Optional limit on the number of examples in a
+                batch.
+            pool_size: Number of examples that are bucketed together. If None,
+                the whole in-memory dataset or ``LAZY_POOL_SIZE`` examples
+                of a lazy dataset are used.
+            shuffle_batches: Flag whether to shuffle the order of the batches.
+        """
+        check_argument_types()
+
+        if token_budget <= 0:
+            raise ValueError("Token budget must be a positive integer.")
+        if max_batch_size is not None and max_batch_size <= 0:
+            raise ValueError("Maximum batch size must be a positive integer.")
+        if pool_size is not None and pool_size <= 0:
+            raise ValueError("Pool size must be a positive integer.")
+
+        self.token_budget = token_budget
+        self.length_series = length_series
+        self.length_key = length_key
+        self.max_batch_size = max_batch_size
+        self.pool_size = pool_size
+        self.shuffle_batches = shuffle_batches
+    # pylint: enable=too-many-arguments
+
+    def example_length(self, example: Dict[str, Any]) -> int:
+        """Get the length of a single example.
+
+        Arguments:
+            example: Dictionary from series names to the items of the example.
+
+        Returns:
+            The length used for bucketing of the example.
+        """
+        if self.length_key is not None:
+            return self.length_key(example)
+
+        if self.length_series is not None:
+            items = [example[s] for s in self.length_series]
+        else:
+            items = list(example.values())
+
+        lengths = [len(i) for i in items if hasattr(i, "__len__")]
+        return max(lengths) if lengths else 1
+
+    def bucket(self, examples: List[Dict[str, Any]]) -> List[List[int]]:
+        """Split a pool of examples into length-homogeneous batches.
+
+        Arguments:
+            examples: The pool of examples to be batched.
+
+        Returns:
+            List of batches, each of them is a list of indices to the pool.
+        """
+        lengths = [self.example_length(ex) for ex in examples]
+        # the sort is stable, so the (shuffled) order of examples of the same
+        # length is preserved
+        order = sorted(range(len(examples)), key=lambda i: lengths[i])
+
+        batches = []  # type: List[List[int]]
+        current = []  # type: List[int]
+        current_max_len = 0
+
+        for index in order:
+            new_max_len = max(current_max_len, lengths[index])
+            over_budget = (len(current) + 1) * new_max_len > self.token_budget
+            over_size = (self.max_batch_size is not None
+                         and len(current) >= self.max_batch_size)
+
+            if current and (over_budget or over_size):
+                batches.append(current)
+                current = []
+                new_max_len = lengths[index]
+
+            current.append(index)
+            current_max_len = new_max_len
+
+        if current:
+            batches.append(current)
+
+        if self.shuffle_batches:
+            random.shuffle(batches)
+
+        return batches
+# pylint: enable=too-few-public-methods
+
+
+class SeriesView(collections.Sequence):
+    """Read-only view of selected items of a data series.
+
+    The view only holds a reference to the series and the indices of the
+    selected items, the items are not copied.
+    """
+
+    def __init__(self, series: Any, indices: Indices) -> None:
+        if isinstance(series, SeriesView):
+            indices = _compose_indices(series.indices, indices)
+            series = series.series
+
+        self.series = series
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return SeriesView(self.series, self.indices[index])
+        return self.series[int(self.indices[index])]
+
+    def __iter__(self) -> Iterable[Any]:
+        for index in self.indices:
+            yield self.series[int(index)]
+
+
+def _compose_indices(outer: Optional[Indices], inner: Indices) -> Indices:
+    """Get indices into a series of items selected by two levels of indexing.
+
+    Arguments:
+        outer: Indices selecting a view of the series. None means the whole
+            series.
+        inner: Indices into the view.
+
+    Returns:
+        Indices into the original series.
+    """
+    if outer is None:
+        return inner
+    if isinstance(outer, range):
+        if isinstance(inner, range):
+            return outer[inner.start:inner.stop:inner.step]
+        return outer.start + outer.step * inner
+    if isinstance(inner, range):
+        return outer[inner.start:inner.stop:inner.step]
+    return outer[inner]
+
+
+def _select_items(series: Any, indices: Optional[Indices]) -> Any:
+    """Select items of a series without copying them.
+
+    Numpy series are indexed directly, ranges become slices, so the result is
+    a view of the original array. Ranges of ragged token series are slices of
+    their buffers. Other series are wrapped by a ``SeriesView``.
+    """
+    if indices is None:
+        return series
+
+    if isinstance(series, np.ndarray):
+        if isinstance(indices, range):
+            return series[indices.start:indices.stop:indices.step]
+        return series[indices]
+
+    if isinstance(series, RaggedTokenSeries) and isinstance(indices, range):
+        return series[indices.start:indices.stop:indices.step]
+
+    return SeriesView(series, indices)
+
+
+def _take_items(series: Any, indices: Indices) -> Any:
+    """Copy selected items of a series into a new series of the same kind."""
+    if isinstance(series, np.ndarray):
+        return _select_items(series, indices).copy()
+    if isinstance(series, RaggedTokenSeries):
+        return series.take(np.asarray(indices))
+    return list(_select_items(series, indices))
+
 
 class Dataset(collections.Sized):
     """ This class serves as collection for data series for particular
@@ -24,8 +243,16 @@ class Dataset(collections.Sized):
     dataset, it also manages the vocabularies inferred from the data.
 
     A data series is either a list of strings or a numpy array.
+
+    Shuffling, batching and taking subsets of the dataset do not copy the
+    series. Instead, the datasets share the series and select their items
+    using an array of indices.
     """
 
+    # number of examples bucketed together when the batching scheme does not
+    # specify the pool size, None means the whole dataset
+    default_pool_size = None  # type: Optional[int]
+
     def __init__(self, name: str, series: Dict[str, List],
                  series_outputs: Dict[str, str]) -> None:
         """Creates a dataset from the provided already preprocessed
@@ -39,6 +266,9 @@ class Dataset(collections.Sized):
         self.name = name
         self._series = series
         self.series_outputs = series_outputs
+        # indices of the items of the series that belong to the dataset,
+        # None means all of them in their original order
+        self._indices = None  # type: Optional[Indices]
 
         self._check_series_lengths()
 
@@ -48,26 +278,50 @@ class Dataset(collections.Sized):
         Raises:
             Exception when the lengths in the dataset do not match.
         """
-        lengths = [len(list(v)) for v in self._series.values()
-                   if isinstance(v, (list, np.ndarray))]
+        lengths = [len(v) for v in self._series.values()
+                   if isinstance(v, (list, np.ndarray, RaggedTokenSeries))]
 
         if len(set(lengths)) > 1:
-            err_str = ["{}: {}".format(s, len(list(self._series[s])))
+            err_str = ["{}: {}".format(s, len(self._series[s]))
                        for s in self._series]
             raise Exception("Lengths of data series must be equal. Instead: {}"
                             .format(", ".join(err_str)))
 
+    def _view(self, name: str, indices: Indices,
+              series_outputs: Dict[str, str] = None) -> "Dataset":
+        """Create a dataset sharing the series with this one.
+
+        The lengths of the series are not checked again.
+
+        Arguments:
+            name: The name of the new dataset.
+            indices: Indices of the selected items relative to this dataset.
+            series_outputs: Output files for target series of the new dataset.
+
+        Returns:
+            The dataset consisting of the selected items.
+        """
+        view = copy.copy(self)
+        view.name = name
+        view.series_outputs = series_outputs or {}
+        view._series = dict(self._series)
+        view._indices = _compose_indices(self._indices, indices)
+        return view
+
     def __len__(self) -> int:
         """Get the length of the dataset.
 
         Returns:
             The length of the dataset.
         """
+        if self._indices is not None:
+            return len(self._indices)
+
         if not list(self._series.values()):
             return 0
 
         first_series = next(iter(self._series.values()))
-        return len(list(first_series))
+        return len(first_series)
 
     def has_series(self, name: str) -> bool:
         """Check if the dataset contains a series of a given name.
@@ -93,22 +347,23 @@ class Dataset(collections.Sized):
         Raises:
             KeyError if the series does not exists and allow_none is False
         """
-        if allow_none:
-            return self._series.get(name)
+        if allow_none and name not in self._series:
+            return None
 
-        return self._series[name]
+        return _select_items(self._series[name], self._indices)
 
     @property
     def series_ids(self) -> Iterable[str]:
         return self._series.keys()
 
     def shuffle(self) -> None:
-        """Shuffle the dataset randomly """
-        keys = list(self._series.keys())
-        zipped = list(zip(*[self._series[k] for k in keys]))
-        random.shuffle(zipped)
-        for key, serie in zip(keys, list(zip(*zipped))):
-            self._series[key] = serie
+        """Shuffle the dataset randomly.
+
+        Only a random permutation of the indices of the items is created, the
+        series themselves are not reordered.
+        """
+        self._indices = _compose_indices(
+            self._indices, np.random.permutation(len(self)))
 
     def batch_serie(self, serie_name: str,
                     batch_size: int) -> Iterable[Iterable]:
@@ -130,30 +385,97 @@ class Dataset(collections.Sized):
         if buf:
             yield buf
 
-    def batch_dataset(self, batch_size: int) -> Iterable['Dataset']:
+    def batch_dataset(self, batch_size: int,
+                      batching_scheme: Optional[BatchingScheme] = None
+                     ) -> Iterable['Dataset']:
         """Split the dataset into a list of batched datasets.
 
         Arguments:
             batch_size: The size of a batch.
+            batching_scheme: If provided, the dataset is split into
+                length-bucketed batches given by the scheme and the batch size
+                is ignored.
 
         Returns:
             Generator yielding batched datasets.
         """
-        keys = list(self._series.keys())
-        batched_series = [self.batch_serie(key, batch_size) for key in keys]
+        if batching_scheme is not None:
+            return self._bucketed_batches(batching_scheme)
+
+        return self._sequential_batches(batch_size)
+
+    def _sequential_batches(self, batch_size: int) -> Iterable['Dataset']:
+        length = len(self)
+        for batch_index, start in enumerate(range(0, length, batch_size)):
+            yield self._view(self.name + "-batch-{}".format(batch_index),
+                             range(start, min(start + batch_size, length)))
+
+    def _examples(self) -> Iterable[Dict[str, Any]]:
+        """Iterate over the examples of the dataset.
+
+        Returns:
+            Generator yielding dictionaries from series names to the items
+            of the individual examples.
+        """
+        keys = list(self.series_ids)
+        for items in zip(*[self.get_series(key) for key in keys]):
+            yield dict(zip(keys, items))
+
+    def _batch_from_examples(self, examples: List[Dict[str, Any]],
+                             batch_index: int) -> 'Dataset':
+        batch_dict = {key: [ex[key] for ex in examples]
+                      for key in self.series_ids}
+        return Dataset(self.name + "-batch-{}".format(batch_index),
+                       batch_dict, {})
+
+    def _pool_batch(self, pool: List[Dict[str, Any]], pool_start: int,
+                    indices: List[int], batch_index: int) -> 'Dataset':
+        """Create a batch of examples selected from a pool.
+
+        Arguments:
+            pool: The examples in the pool.
+            pool_start: Index of the first example of the pool in the dataset.
+            indices: Indices of the examples of the batch within the pool.
+            batch_index: The number of the batch.
+        """
+        return self._view(self.name + "-batch-{}".format(batch_index),
+                          np.array(indices, dtype=np.int64) + pool_start)
+
+    def _bucketed_batches(
+            self, scheme: BatchingScheme) -> Iterable['Dataset']:
+        examples = iter(self._examples())
+
+        pool_size = scheme.pool_size
+        if pool_size is None:
+            pool_size = self.default_pool_size
 
         batch_index = 0
-        for next_batches in zip(*batched_series):
-            batch_dict = {key: data for key, data in zip(keys, next_batches)}
-            dataset = Dataset(self.name + "-batch-{}".format(batch_index),
-                              batch_dict, {})
-            batch_index += 1
-            yield dataset
+        pool_start = 0
+        while True:
+            pool = list(itertools.islice(examples, pool_size))
+            if not pool:
+                break
+
+            for indices in scheme.bucket(pool):
+                yield self._pool_batch(pool, pool_start, indices, batch_index)
+                batch_index += 1
+
+            if pool_size is None:
+                break
+            pool_start += len(pool)
 
     def add_series(self, name: str, series: List[Any]) -> None:
         if name in self._series:
             raise ValueError(
                 "Can't series that already exist: {}".format(name))
+
+        if self._indices is not None:
+            # the new series is in the order of the dataset, so the other
+            # series have to be reordered as well
+            self._series = {key: _take_items(value, self._indices)
+                            for key, value in self._series.items()}
+            self._indices = None
+
         self._series[name] = series
 
     def subset(self, start: int, length: int) -> "Dataset":
@@ -165,11 +487,8 @@ class Dataset(collections.Sized):
         subset_outputs = {k: "{}.{:010}".format(v, start)
                           for k, v in self.series_outputs.items()}
 
-        # new series
-        subset_series = {k: v[start:start + length]
-                         for k, v in self._series.items()}
-
-        return Dataset(subset_name, subset_series, subset_outputs)
+        end = min(start + length, len(self))
+        return self._view(subset_name, range(start, end), subset_outputs)
 
 
 class LazyDataset(Dataset):
@@ -179,20 +498,41 @@ class LazyDataset(Dataset):
     that the contents of the file are not fully loaded to the memory.
     Instead, everytime the function ``get_series`` is called, a new file handle
     is created and a generator which yields lines from the file is returned.
+    When the dataset is batched, all series are read together in a single
+    pass, so each file is read and parsed only once per epoch.
+
+    The lazy dataset can be shuffled using a shuffle buffer of a limited size,
+    optionally combined with shuffling of the order of fixed-size chunks of the
+    input files. All series are shuffled with the same random seed, so they
+    stay aligned.
     """
 
+    default_pool_size = LAZY_POOL_SIZE
+
+    # pylint: disable=too-many-arguments
     def __init__(self, name: str,
                  series_paths_and_readers: Dict[str, Tuple[List[str], Reader]],
                  series_outputs: Dict[str, str],
-                 preprocessors: List[Tuple[str, str, Callable]] = None
-                ) -> None:
+                 preprocessors: List[Tuple[str, str, Callable]] = None,
+                 shuffle_buffer_size: Optional[int] = None,
+                 shuffle_chunk_size: Optional[int] = None,
+                 preprocess_workers: int = 1) -> None:
         """Create a new instance of the lazy dataset.
 
         Arguments:
-            name: The name of the dataset series_paths_and_readers: The mapping
-            of series name to its file series_outputs: Dictionary mapping
-            series names to their output file preprocess: The preprocessor to
-            apply to the read lines
+            name: The name of the dataset
+            series_paths_and_readers: The mapping of series name to its file
+            series_outputs: Dictionary mapping series names to their output
+                file
+            preprocessors: The preprocessors to apply to the read lines
+            shuffle_buffer_size: Number of examples held in memory when
+                shuffling. If None, the dataset is not shuffled by the buffer.
+            shuffle_chunk_size: If set, the order of chunks of this many lines
+                of the input files is shuffled before the shuffle buffer is
+                applied. This is supported only for series whose readers
+                allow random access, e.g. the plain text readers.
+            preprocess_workers: Number of processes applying the
+                preprocessors while the data are read.
         """
         parent_series = dict()  # type: Dict[str, Any]
         parent_series.update({s: None for s in series_paths_and_readers})
@@ -203,7 +543,7 @@ class LazyDataset(Dataset):
 
         for series_name, (paths, _) in series_paths_and_readers.items():
             for path in paths:
-                if not os.path.isfile(path):
+                if not os.path.exists(path):
                     raise FileNotFoundError(
                         "File not found. Series: {}, Path: {}"
                         .format(series_name, path))
@@ -221,6 +561,30 @@ class LazyDataset(Dataset):
                              src_id, str(func)))
                 self.preprocess_series[tgt_id] = (src_id, func)
 
+        if shuffle_buffer_size is not None and shuffle_buffer_size < 1:
+            raise ValueError("Shuffle buffer size must be a positive integer.")
+        if shuffle_chunk_size is not None and shuffle_chunk_size < 1:
+            raise ValueError("Shuffle chunk size must be a positive integer.")
+
+        if shuffle_chunk_size is not None:
+            for series_name in series_paths_and_readers:
+                if not self._is_seekable(series_name):
+                    warn("Series '{}' cannot be read by chunks, shuffling of "
+                         "chunks is disabled.".format(series_name))
+                    shuffle_chunk_size = None
+                    break
+
+        if preprocess_workers < 1:
+            raise ValueError("Number of preprocessing workers must be a "
+                             "positive integer.")
+
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shuffle_chunk_size = shuffle_chunk_size
+        self.preprocess_workers = preprocess_workers
+        self._shuffle_seed = None  # type: Optional[int]
+        self._start_line = 0
+    # pylint: enable=too-many-arguments
+
     def has_series(self, name: str) -> bool:
         """Check if the dataset contains a series of a given name.
 
@@ -233,6 +597,53 @@ class LazyDataset(Dataset):
         return (name in self.series_paths_and_readers
                 or name in self.preprocess_series)
 
+    def _is_line_based(self, name: str) -> bool:
+        """Check whether a series is read by a line-based reader.
+
+        Series of line-based readers can be accessed randomly using the
+        persistent line index of their files.
+        """
+        _, reader = self.series_paths_and_readers[name]
+        return hasattr(reader, "parse_line")
+
+    def _is_seekable(self, name: str) -> bool:
+        """Check whether a series can be read from an arbitrary position.
+
+        This holds for line-based series and for series whose readers provide
+        the ``read_range`` and ``count_items`` functions, such as the reader
+        of the preprocessed series cache.
+        """
+        _, reader = self.series_paths_and_readers[name]
+        return self._is_line_based(name) or hasattr(reader, "read_range")
+
+    def _series_length(self, name: str) -> int:
+        """Get the number of items in the files of a series."""
+        paths, reader = self.series_paths_and_readers[name]
+        if self._is_line_based(name):
+            return count_lines(paths)
+        if hasattr(reader, "count_items"):
+            return getattr(reader, "count_items")(paths)
+        return sum(1 for _ in reader(paths))
+
+    def __len__(self) -> int:
+        """Get the length of the dataset.
+
+        For seekable series, the length is obtained from the line index of
+        the files (or the reader). Otherwise, the first series is read to
+        count its items.
+
+        Returns:
+            The length of the dataset.
+        """
+        seekable = [s for s in self.series_paths_and_readers
+                    if self._is_seekable(s)]
+        if seekable:
+            name = seekable[0]
+        else:
+            name = next(iter(self.series_paths_and_readers))
+
+        return max(self._series_length(name) - self._start_line, 0)
+
     def get_series(self, name: str, allow_none: bool = False) -> Iterable:
         """Get the data series with a given name.
 
@@ -256,22 +667,154 @@ class LazyDataset(Dataset):
             return None
 
         if name in self.series_paths_and_readers:
-            paths, reader = self.series_paths_and_readers[name]
-            return reader(paths)
+            return self._read_series(name)
         elif name in self.preprocess_series:
             src_id, func = self.preprocess_series[name]
-            paths, reader = self.series_paths_and_readers[src_id]
-            src_series = reader(paths)
-            return map(func, src_series)
+            src_series = self._read_series(src_id)
+            return parallel_map(func, src_series, self.preprocess_workers)
         else:
             raise Exception("Series '{}' is not in the dataset.".format(name))
 
+    def _read_series(self, name: str) -> Iterable:
+        """Read a series from its files, shuffled if requested.
+
+        Every series is shuffled using a random generator initialized with
+        the same seed, so the corresponding items of all series end up at the
+        same positions.
+        """
+        if self._shuffle_seed is None:
+            return self._read_lines(name, self._start_line)
+
+        rng = random.Random(self._shuffle_seed)
+
+        if self.shuffle_chunk_size is not None:
+            chunk_starts = list(range(self._start_line,
+                                      self._series_length(name),
+                                      self.shuffle_chunk_size))
+            rng.shuffle(chunk_starts)
+            series = itertools.chain.from_iterable(
+                self._read_lines(name, start, self.shuffle_chunk_size)
+                for start in chunk_starts)  # type: Iterable
+        else:
+            series = self._read_lines(name, self._start_line)
+
+        if self.shuffle_buffer_size is not None:
+            series = _shuffle_buffer(series, self.shuffle_buffer_size, rng)
+
+        return series
+
+    def _read_lines(self, name: str, start: int = 0,
+                    count: Optional[int] = None) -> Iterable:
+        """Read a range of items of a series from its files.
+
+        Line-based series are read from the given position using the line
+        index of the files, readers that support random access read the range
+        themselves, other series have to be read from the beginning.
+
+        Arguments:
+            name: The name of the series.
+            start: Index of the first item.
+            count: Maximum number of items to read. If None, the series is
+                read until its end.
+        """
+        paths, reader = self.series_paths_and_readers[name]
+
+        if start == 0 and count is None:
+            return reader(paths)
+
+        if self._is_line_based(name):
+            return map(getattr(reader, "parse_line"),
+                       iterate_lines(paths, start, count))
+
+        if hasattr(reader, "read_range"):
+            return getattr(reader, "read_range")(paths, start, count)
+
+        stop = None if count is None else start + count
+        return itertools.islice(reader(paths), start, stop)
+
+    def _examples(self) -> Iterable[Dict[str, Any]]:
+        """Iterate over the examples of the dataset in a single pass.
+
+        Every file series is read exactly once and the preprocessed series are
+        derived from the already parsed items of their source series, so no
+        file is opened nor parsed more than once per pass over the data.
+
+        Returns:
+            Generator yielding dictionaries from series names to the items
+            of the individual examples.
+        """
+        examples = self._raw_examples()
+
+        if not self.preprocess_series:
+            yield from examples
+            return
+
+        # only the source items are sent to the preprocessing workers
+        src_ids = {src_id for src_id, _ in self.preprocess_series.values()}
+        examples, sources = itertools.tee(examples)
+        preprocessed = parallel_map(
+            _ExamplePreprocessor(self.preprocess_series),
+            ({src_id: ex[src_id] for src_id in src_ids} for ex in sources),
+            self.preprocess_workers)
+
+        for example, new_items in zip(examples, preprocessed):
+            example.update(new_items)
+            yield example
+
+    def _raw_examples(self) -> Iterable[Dict[str, Any]]:
+        """Iterate over the examples of the series read from files."""
+        keys = list(self.series_paths_and_readers)
+        for items in zip(*[self._read_series(key) for key in keys]):
+            yield dict(zip(keys, items))
+
+    def _sequential_batches(self, batch_size: int) -> Iterable['Dataset']:
+        examples = iter(self._examples())
+
+        batch_index = 0
+        while True:
+            batch = list(itertools.islice(examples, batch_size))
+            if not batch:
+                break
+
+            yield self._batch_from_examples(batch, batch_index)
+            batch_index += 1
+
+    def _pool_batch(self, pool: List[Dict[str, Any]], pool_start: int,
+                    indices: List[int], batch_index: int) -> 'Dataset':
+        return self._batch_from_examples([pool[i] for i in indices],
+                                         batch_index)
+
+    def from_offset(self, start: int) -> "LazyDataset":
+        """Get a view of the dataset that starts at the given item.
+
+        Series of line-based readers seek directly to the item using the line
+        index of their files.
+
+        Arguments:
+            start: Number of items to skip.
+
+        Returns:
+            A lazy dataset sharing the files and the configuration with this
+            one, which skips the first ``start`` items.
+        """
+        if start > len(self):
+            raise ValueError("Trying to skip more instances than "
+                             "the size of the dataset")
+
+        dataset = copy.copy(self)
+        dataset._start_line = self._start_line + start
+        return dataset
+
     def shuffle(self) -> None:
-        """Does nothing, not in-memory shuffle is impossible.
+        """Shuffle the dataset using the shuffle buffer.
 
-        TODO: this is related to the ``__len__`` method.
+        The shuffling is done lazily when the series are read. If neither
+        the shuffle buffer nor the chunk shuffling is enabled, this does
+        nothing.
         """
-        pass
+        if (self.shuffle_buffer_size is not None
+                or self.shuffle_chunk_size is not None):
+            self._shuffle_seed = random.getrandbits(32)
 
     @property
     def series_ids(self) -> Iterable[str]:
@@ -291,19 +834,121 @@ class LazyDataset(Dataset):
                           for k, v in self.series_outputs.items()}
 
         # new series
-        # TODO make this more efficient with large datasets
-        subset_series = {}
-
-        for s_id, (paths, reader) in self.series_paths_and_readers.items():
-            generator = reader(paths)
-            for _ in range(start):
-                next(generator)
+        subset_series = {
+            s_id: list(self._read_lines(s_id, self._start_line + start,
+                                        length))
+            for s_id in self.series_paths_and_readers}
 
-            subset_series[s_id] = [next(generator) for _ in range(length)]
+        for s_id, (src_id, func) in self.preprocess_series.items():
+            if src_id is not None:
+                subset_series[s_id] = list(parallel_map(
+                    func, subset_series[src_id], self.preprocess_workers))
 
         return Dataset(subset_name, subset_series, subset_outputs)
 
 
+class ShardedDataset(LazyDataset):
+    """Lazy dataset stored in many aligned shards.
+
+    Every series is split into the same number of files, the i-th files of
+    all series form the i-th shard. Several shards are read at once on
+    background threads and their examples are interleaved, so reading is not
+    limited by a single file handle. Shuffling the dataset reshuffles the
+    order in which the shards are read and, if configured, shuffles the
+    interleaved examples using the shuffle buffer.
+
+    Note that ``subset`` reads the examples in the order of the files, not in
+    the interleaved order.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str,
+                 series_paths_and_readers: Dict[str, Tuple[List[str], Reader]],
+                 series_outputs: Dict[str, str],
+                 preprocessors: List[Tuple[str, str, Callable]] = None,
+                 shuffle_buffer_size: Optional[int] = None,
+                 parallel_shards: int = 4,
+                 preprocess_workers: int = 1) -> None:
+        """Create a new instance of the sharded dataset.
+
+        Arguments:
+            name: The name of the dataset
+            series_paths_and_readers: The mapping of series name to its shard
+                files and reader. All series must have the same number of
+                files.
+            series_outputs: Dictionary mapping series names to their output
+                file
+            preprocessors: The preprocessors to apply to the read lines
+            shuffle_buffer_size: Number of examples held in memory when
+                shuffling. If None, only the order of shards is shuffled.
+            parallel_shards: Number of shards read at once.
+            preprocess_workers: Number of processes applying the
+                preprocessors while the data are read.
+        """
+        super().__init__(name, series_paths_and_readers, series_outputs,
+                         preprocessors, shuffle_buffer_size, None,
+                         preprocess_workers)
+
+        num_shards = {len(paths) for paths, _
+                      in series_paths_and_readers.values()}
+        if len(num_shards) != 1:
+            raise ValueError(
+                "All series of a sharded dataset must have the same number "
+                "of files. Instead: {}".format(", ".join(
+                    "{}: {}".format(key, len(paths)) for key, (paths, _)
+                    in series_paths_and_readers.items())))
+        if parallel_shards < 1:
+            raise ValueError("Number of parallel shards must be a positive "
+                             "integer.")
+
+        self.num_shards = num_shards.pop()
+        self.parallel_shards = parallel_shards
+        self._shard_order = list(range(self.num_shards))
+    # pylint: enable=too-many-arguments
+
+    def get_series(self, name: str, allow_none: bool = False) -> Iterable:
+        if allow_none and not self.has_series(name):
+            return None
+
+        if name in self.series_paths_and_readers:
+            return (example[name] for example in self._raw_examples())
+        elif name in self.preprocess_series:
+            return (example[name] for example in self._examples())
+        else:
+            raise Exception("Series '{}' is not in the dataset.".format(name))
+
+    def _read_shard(self, shard: int) -> Iterable[Dict[str, Any]]:
+        keys = list(self.series_paths_and_readers)
+        readers = [reader([paths[shard]]) for paths, reader
+                   in self.series_paths_and_readers.values()]
+        for items in zip(*readers):
+            yield dict(zip(keys, items))
+
+    def _raw_examples(self) -> Iterable[Dict[str, Any]]:
+        """Read the shards in parallel and interleave their examples."""
+        examples = _interleave_shards(
+            [functools.partial(self._read_shard, shard)
+             for shard in self._shard_order],
+            self.parallel_shards)  # type: Iterable[Dict[str, Any]]
+
+        if self._start_line:
+            examples = itertools.islice(examples, self._start_line, None)
+
+        if (self._shuffle_seed is not None
+                and self.shuffle_buffer_size is not None):
+            examples = _shuffle_buffer(examples, self.shuffle_buffer_size,
+                                       random.Random(self._shuffle_seed))
+
+        return examples
+
+    def shuffle(self) -> None:
+        """Shuffle the order of shards and apply the shuffle buffer."""
+        order = list(range(self.num_shards))
+        random.shuffle(order)
+        self._shard_order = order
+        super().shuffle()
+
+
 # pylint: disable=invalid-name
 DatasetPreprocess = Callable[[Dataset], Iterable[Any]]
 DatasetPostprocess = Callable[[Dataset, Dict[str, Iterable[Any]]],
@@ -318,9 +963,154 @@ SERIES_OUTPUT = re.compile("s_(.*)_out")
 PREPROCESSED_SERIES = re.compile("pre_([^_]*)$")
 
 
+# pylint: disable=too-few-public-methods
+class _ExamplePreprocessor(object):
+    """Apply the preprocessors of a lazy dataset to a single example."""
+
+    def __init__(self,
+                 preprocess_series: Dict[str, Tuple[str, Callable]]) -> None:
+        self.preprocess_series = preprocess_series
+
+    def __call__(self, sources: Dict[str, Any]) -> Dict[str, Any]:
+        return {tgt_id: func(sources[src_id])
+                for tgt_id, (src_id, func) in self.preprocess_series.items()}
+
+
+class _DatasetChunkPreprocessor(object):
+    """Apply a dataset-level preprocessor to a chunk of a dataset."""
+
+    def __init__(self,
+                 preprocessor: Callable[[Dataset], Iterable[Any]]) -> None:
+        self.preprocessor = preprocessor
+
+    def __call__(self, chunk: Dataset) -> List[Any]:
+        return list(self.preprocessor(chunk))
+# pylint: enable=too-few-public-methods
+
+
+# sentinel marking the end of a shard in the queue of its examples
+_SHARD_END = object()
+# number of examples passed from a shard reader thread at once
+_SHARD_BLOCK_SIZE = 64
+
+
+def _interleave_shards(shards: List[Callable[[], Iterable[Any]]],
+                       parallel_shards: int,
+                       queue_size: int = 16) -> Iterable[Any]:
+    """Read shards on background threads and interleave their items.
+
+    Every active shard is read by its own thread which passes blocks of items
+    through a bounded queue. The blocks are taken from the active shards in a
+    round-robin fashion. When a shard is exhausted, reading of the next shard
+    starts, so the order of the items depends only on the order of the
+    shards.
+
+    Arguments:
+        shards: Functions returning iterables over the items of the shards.
+        parallel_shards: Number of shards read at once.
+        queue_size: Maximum number of blocks read ahead in every shard.
+
+    Returns:
+        Generator yielding the interleaved items.
+    """
+    stop = threading.Event()
+    remaining = iter(shards)
+    active = collections.deque()  # type: collections.deque
+
+    def put(blocks: queue.Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(shard: Callable[[], Iterable[Any]],
+                blocks: queue.Queue) -> None:
+        # pylint: disable=broad-except
+        try:
+            items = iter(shard())
+            while True:
+                block = list(itertools.islice(items, _SHARD_BLOCK_SIZE))
+                if not block:
+                    break
+                if not put(blocks, block):
+                    return
+            put(blocks, _SHARD_END)
+        except Exception as exc:
+            put(blocks, exc)
+
+    def start_next_shard() -> None:
+        shard = next(remaining, None)
+        if shard is not None:
+            blocks = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+            thread = threading.Thread(target=produce, args=(shard, blocks),
+                                      name="shard-reader", daemon=True)
+            thread.start()
+            active.append((blocks, thread))
+
+    for _ in range(parallel_shards):
+        start_next_shard()
+
+    try:
+        while active:
+            blocks, thread = active.popleft()
+            block = blocks.get()
+
+            if block is _SHARD_END:
+                thread.join()
+                start_next_shard()
+                continue
+            if isinstance(block, Exception):
+                raise block
+
+            active.append((blocks, thread))
+            yield from block
+    finally:
+        # also reached when the consumer stops early
+        stop.set()
+        for _, thread in active:
+            thread.join()
+
+
+def _shuffle_buffer(items: Iterable[Any], buffer_size: int,
+                    rng: random.Random) -> Iterable[Any]:
+    """Shuffle a stream of items using a buffer of a limited size.
+
+    Arguments:
+        items: The stream of items to shuffle.
+        buffer_size: Maximum number of items held in the buffer.
+        rng: The random generator used for the shuffling.
+
+    Returns:
+        Generator yielding the shuffled items.
+    """
+    buf = []  # type: List[Any]
+    for item in items:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+
+        index = rng.randrange(buffer_size)
+        yield buf[index]
+        buf[index] = item
+
+    rng.shuffle(buf)
+    yield from buf
+
+
+# pylint: disable=too-many-arguments
 def load_dataset_from_files(
         name: str = None, lazy: bool = False,
         preprocessors: List[Tuple[str, str, Callable]] = None,
+        shuffle_buffer_size: Optional[int] = None,
+        shuffle_chunk_size: Optional[int] = None,
+        series_cache: Optional[SeriesCache] = None,
+        compact_series: bool = False,
+        preprocess_workers: int = 1,
+        sharded: bool = False,
+        parallel_shards: int = 4,
         **kwargs) -> Dataset:
 
     """Load a dataset from the files specified by the provided arguments.
@@ -330,9 +1120,31 @@ def load_dataset_from_files(
         name: The name of the dataset to use. If None (default), the name will
               be inferred from the file names.
         lazy: Boolean flag specifying whether to use lazy loading (useful for
-              large files). Note that the lazy dataset cannot be shuffled.
-              Defaults to False.
+              large files). Note that the lazy dataset can be shuffled only
+              using the shuffle buffer. Defaults to False.
         preprocessor: A callable used for preprocessing of the input sentences.
+        shuffle_buffer_size: Size of the shuffle buffer of the lazy dataset.
+              Without it, the lazy dataset cannot be shuffled.
+        shuffle_chunk_size: If set, the lazy dataset shuffles the order of
+              chunks of this many lines before applying the shuffle buffer.
+        series_cache: If provided, the outputs of the preprocessors are stored
+              in this on-disk cache and loaded from it if the input files,
+              the readers and the preprocessors have not changed.
+        compact_series: If True, the series of tokenized sentences of an
+              in-memory dataset are stored in compact arrays of interned
+              tokens instead of lists of lists of strings.
+        preprocess_workers: Number of processes used to apply the
+              preprocessors. The preprocessors are applied on chunks of the
+              series in parallel, the order of the items is preserved. For
+              lazy datasets, the preprocessing runs while the data are read.
+              Preprocessors which cannot be pickled (e.g. lambdas) are
+              applied in the main process.
+        sharded: If True, the files of the series are treated as aligned
+              shards of a lazy dataset, which are read in parallel (see
+              ``ShardedDataset``). The paths of the series can be glob
+              patterns, the matching files are sorted and the i-th files of
+              all series form the i-th shard.
+        parallel_shards: Number of shards of a sharded dataset read at once.
         kwargs: Dataset keyword argument specs. These parameters should begin
                 with 's_' prefix and may end with '_out' suffix.  For example,
                 a data series 'source' which specify the source sentences
@@ -356,6 +1168,11 @@ def load_dataset_from_files(
     series_paths_and_readers = _get_series_paths_and_readers(kwargs)
     series_outputs = _get_series_outputs(kwargs)
 
+    if sharded:
+        series_paths_and_readers = {
+            key: (_expand_globs(paths), reader)
+            for key, (paths, reader) in series_paths_and_readers.items()}
+
     if not series_paths_and_readers:
         raise Exception("No input files are provided.")
 
@@ -365,12 +1182,36 @@ def load_dataset_from_files(
     if name is None:
         name = _get_name_from_paths(series_paths_and_readers)
 
-    if lazy:
+    if not lazy and not sharded and (shuffle_buffer_size is not None
+                                     or shuffle_chunk_size is not None):
+        warn("Shuffle buffer is used only with lazy datasets.")
+
+    if sharded:
+        if not lazy:
+            warn("Sharded datasets are always lazy.")
+        if series_cache is not None or shuffle_chunk_size is not None:
+            warn("Series cache and shuffling of chunks are not used with "
+                 "sharded datasets.")
+
+        dataset = ShardedDataset(
+            name, series_paths_and_readers, series_outputs, preprocessors,
+            shuffle_buffer_size, parallel_shards, preprocess_workers)
+        # type: Dataset
+    elif lazy:
+        if series_cache is not None and preprocessors is not None:
+            preprocessors = _cache_lazy_preprocessed_series(
+                series_cache, series_paths_and_readers, preprocessors,
+                preprocess_workers)
+
         dataset = LazyDataset(name, series_paths_and_readers, series_outputs,
-                              preprocessors)
+                              preprocessors, shuffle_buffer_size,
+                              shuffle_chunk_size, preprocess_workers)
         # type: Dataset
     else:
-        series = {key: list(reader(paths))
+        # with compact series, the sentences are interned while they are
+        # read, so the series never exist as lists of lists of strings
+        table = TokenTable() if compact_series else None
+        series = {key: _collect_series(reader(paths), table)
                   for key, (paths, reader) in series_paths_and_readers.items()}
 
         if preprocessors is not None:
@@ -383,14 +1224,115 @@ def load_dataset_from_files(
                         ("The source series ({}) of the '{}' preprocessor "
                          "is not defined in the dataset.").format(
                              src_id, str(function)))
-                series[tgt_id] = list(map(function, series[src_id]))
+
+                if series_cache is None:
+                    series[tgt_id] = _collect_series(parallel_map(
+                        function, series[src_id], preprocess_workers), table)
+                    continue
+
+                paths, reader = series_paths_and_readers[src_id]
+                key = series_cache.series_key(paths, reader, function)
+                cached = series_cache.load(key)
+                if cached is not None:
+                    log("Series '{}' loaded from cache".format(tgt_id))
+                    series[tgt_id] = _collect_series(cached, table)
+                else:
+                    series[tgt_id] = _collect_series(parallel_map(
+                        function, series[src_id], preprocess_workers), table)
+                    series_cache.store(key, series[tgt_id])
 
         dataset = Dataset(name, series, series_outputs)
         log("Dataset length: {}".format(len(dataset)))
 
-    _preprocessed_datasets(dataset, kwargs)
+    _preprocessed_datasets(dataset, kwargs, preprocess_workers)
 
     return dataset
+# pylint: enable=too-many-arguments
+
+
+def _collect_series(items: Iterable[Any],
+                    table: Optional[TokenTable]) -> Sequence[Any]:
+    """Collect the items of a series from a stream.
+
+    If a token table is given, a series of tokenized sentences is stored as a
+    ragged token series using the table, which is built while the items are
+    read. If an item which is not a list of strings is encountered, the
+    series is collected as a list instead.
+    """
+    if table is None:
+        return list(items)
+
+    builder = RaggedSeriesBuilder(table)
+    iterator = iter(items)
+    for item in iterator:
+        if not (isinstance(item, list)
+                and all(isinstance(token, str) for token in item)):
+            # not a series of tokenized sentences
+            return list(builder.build()) + [item] + list(iterator)
+        builder.append(item)
+
+    return builder.build()
+
+
+def _cache_lazy_preprocessed_series(
+        series_cache: SeriesCache,
+        series_paths_and_readers: Dict[str, Tuple[List[str], Reader]],
+        preprocessors: List[Tuple[str, str, Callable]],
+        preprocess_workers: int = 1) -> List[Tuple[str, str, Callable]]:
+    """Replace the preprocessors of a lazy dataset by cached series.
+
+    The preprocessed series that are not in the cache yet are computed in a
+    single pass over their source files and stored. The cached series are
+    added to the series read from files, so they are neither read nor
+    preprocessed again in the following epochs.
+
+    Arguments:
+        series_cache: The cache of the preprocessed series.
+        series_paths_and_readers: The file series of the dataset. The cached
+            series are added to this dictionary.
+        preprocessors: The preprocessors of the dataset.
+        preprocess_workers: Number of processes applying the preprocessors.
+
+    Returns:
+        The preprocessors whose outputs could not be cached.
+    """
+    remaining = []  # type: List[Tuple[str, str, Callable]]
+
+    for src_id, tgt_id, function in preprocessors:
+        if src_id not in series_paths_and_readers or src_id == tgt_id:
+            # the error is reported by the dataset
+            remaining.append((src_id, tgt_id, function))
+            continue
+
+        paths, reader = series_paths_and_readers[src_id]
+        key = series_cache.series_key(paths, reader, function)
+        cached = series_cache.load(key)
+        if cached is None:
+            log("Preprocessing series '{}' for the cache".format(tgt_id))
+            cached = series_cache.store(key, parallel_map(
+                function, reader(paths), preprocess_workers))
+
+        if cached is None:
+            remaining.append((src_id, tgt_id, function))
+        else:
+            log("Series '{}' read from cache".format(tgt_id))
+            series_paths_and_readers[tgt_id] = (
+                [cached.path], get_cached_series_reader([cached]))
+
+    return remaining
+
+
+def _expand_globs(paths: List[str]) -> List[str]:
+    """Expand glob patterns in a list of paths.
+
+    The files matching a pattern are sorted, paths that do not match any file
+    are kept, so the missing files are reported by the dataset.
+    """
+    expanded = []  # type: List[str]
+    for path in paths:
+        matches = sorted(glob.glob(path))
+        expanded.extend(matches if matches else [path])
+    return expanded
 
 
 def _get_name_from_paths(series_paths: Dict[str, Tuple[List[str],
@@ -474,10 +1416,30 @@ def _get_series_outputs(series_config: SeriesConfig) -> Dict[str, str]:
     return outputs
 
 
+def _copy_subset(dataset: Dataset, start: int, length: int) -> Dataset:
+    """Copy a range of an in-memory dataset to a standalone dataset.
+
+    Unlike ``Dataset.subset``, the new dataset does not share the series
+    with the original one, so it can be sent to a worker process without
+    the whole series.
+    """
+    subset = dataset.subset(start, length)
+    indices = range(len(subset))
+    return Dataset(subset.name,
+                   {key: _take_items(subset.get_series(key), indices)
+                    for key in subset.series_ids},
+                   {})
+
+
 def _preprocessed_datasets(
         dataset: Dataset,
-        series_config: SeriesConfig) -> None:
-    """Apply dataset-level preprocessing."""
+        series_config: SeriesConfig,
+        preprocess_workers: int = 1) -> None:
+    """Apply dataset-level preprocessing.
+
+    With more than one worker, the preprocessors of in-memory datasets are
+    applied to chunks of the dataset in parallel processes.
+    """
     keys = [key for key in series_config.keys()
             if PREPROCESSED_SERIES.match(key)]
 
@@ -486,7 +1448,17 @@ def _preprocessed_datasets(
         preprocessor = cast(DatasetPreprocess, series_config[key])
 
         if isinstance(dataset, Dataset):
-            new_series = list(preprocessor(dataset))
+            if preprocess_workers > 1 and not isinstance(dataset,
+                                                         LazyDataset):
+                # only the chunks are sent to the workers, not the dataset
+                chunks = (_copy_subset(dataset, start, DEFAULT_CHUNK_SIZE)
+                          for start in range(0, len(dataset),
+                                             DEFAULT_CHUNK_SIZE))
+                new_series = list(itertools.chain.from_iterable(
+                    parallel_map(_DatasetChunkPreprocessor(preprocessor),
+                                 chunks, preprocess_workers, chunk_size=1)))
+            else:
+                new_series = list(preprocessor(dataset))
             dataset.add_series(name, new_series)
         elif isinstance(dataset, LazyDataset):
             dataset.preprocess_series[name] = (None, preprocessor)
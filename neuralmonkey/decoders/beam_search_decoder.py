@@ -1,44 +1,67 @@
-from typing import NamedTuple, Tuple, List
+from typing import Any, Callable, NamedTuple, Tuple, List
 
 import tensorflow as tf
 from typeguard import check_argument_types
 
-from neuralmonkey.decoding_function import BaseAttention
+from neuralmonkey.decoding_function import BaseAttention, CoverageAttention
 from neuralmonkey.model.model_part import ModelPart, FeedDict
 from neuralmonkey.dataset import Dataset
 from neuralmonkey.decoders.decoder import Decoder
 from neuralmonkey.vocabulary import (START_TOKEN_INDEX, END_TOKEN_INDEX,
                                      PAD_TOKEN_INDEX)
 
+# The hypotheses of all sentences in the batch are decoded at once. The rows
+# of the search state are ordered by the beam and then by the batch, so the
+# hypothesis k of the sentence b is in the row k * batch + b.
+
 # pylint: disable=invalid-name
 SearchState = NamedTuple("SearchState",
-                         [("logprob_sum", tf.Tensor),  # beam x 1
-                          ("lengths", tf.Tensor),  # beam x 1
-                          ("finished", tf.Tensor),  # beam x 1
-                          ("last_word_ids", tf.Tensor),  # beam x 1
-                          ("last_state", tf.Tensor),  # beam x rnn_size
-                          ("last_attns", tf.Tensor)])  # beam x ???
+                         [("logprob_sum", tf.Tensor),  # (beam * batch)
+                          ("lengths", tf.Tensor),  # (beam * batch)
+                          ("finished", tf.Tensor),  # (beam * batch)
+                          ("last_word_ids", tf.Tensor),  # (beam * batch)
+                          ("last_state", Any),  # (beam * batch) x rnn_size
+                          ("last_attns", List[tf.Tensor])])  # (beam*batch) x ?
 
 SearchStepOutput = NamedTuple("SearchStepOutput",
-                              [("scores", tf.Tensor),
-                               ("parent_ids", tf.Tensor),
-                               ("token_ids", tf.Tensor)])
+                              [("scores", tf.Tensor),  # beam x batch
+                               ("parent_ids", tf.Tensor),  # beam x batch
+                               ("token_ids", tf.Tensor)])  # beam x batch
 # pylint: enable=invalid-name
 
 
+def _map_state(function: Callable[[tf.Tensor], tf.Tensor], state: Any) -> Any:
+    """Apply a function on the RNN state or on the parts of an LSTM state."""
+    if isinstance(state, tf.contrib.rnn.LSTMStateTuple):
+        return tf.contrib.rnn.LSTMStateTuple(*[function(s) for s in state])
+    return function(state)
+
+
 class BeamSearchDecoder(ModelPart):
-    """In-graph beam search for batch size 1.
+    """In-graph beam search for whole batches.
+
+    The decoder keeps ``beam_size`` hypotheses for every sentence of the
+    batch. In every step, the best ``beam_size`` continuations of each
+    sentence are selected from all its hypotheses extended by all words of
+    the vocabulary.
+
+    The search stops before ``max_steps`` when the hypotheses up to the
+    rank ``early_stop_rank`` of all sentences cannot change anymore. The
+    hypotheses of higher ranks may then differ from the ones found by
+    a search running for all the steps.
 
     The hypothesis scoring algorithm is taken from
     https://arxiv.org/pdf/1609.08144.pdf. Length normalization is parameter
     alpha from equation 14.
     """
+    # pylint: disable=too-many-arguments
     def __init__(self,
                  name: str,
                  parent_decoder: Decoder,
                  beam_size: int,
                  length_normalization: float,
                  max_steps: int = None,
+                 early_stop_rank: int = 1,
                  save_checkpoint: str = None,
                  load_checkpoint: str = None) -> None:
         ModelPart.__init__(self, name, save_checkpoint, load_checkpoint)
@@ -51,8 +74,18 @@ class BeamSearchDecoder(ModelPart):
         self._max_steps = max_steps
         if self._max_steps is None:
             self._max_steps = parent_decoder.max_output_len
+        if self._max_steps < 1:
+            raise ValueError("Beam search must run for at least one step, "
+                             "max_steps was {}.".format(self._max_steps))
+
+        if early_stop_rank < 1 or early_stop_rank > beam_size:
+            raise ValueError(
+                ("Early stopping rank must be between 1 and the beam size "
+                 "({}), was {}.").format(beam_size, early_stop_rank))
+        self.early_stop_rank = early_stop_rank
 
         self.outputs = self._decoding_loop()
+    # pylint: enable=too-many-arguments
 
     @property
     def beam_size(self):
@@ -62,35 +95,119 @@ class BeamSearchDecoder(ModelPart):
     def vocabulary(self):
         return self.parent_decoder.vocabulary
 
-    def _decoding_loop(self):
+    def _decoding_loop(self) -> SearchStepOutput:
+        """Run the beam search in a while loop.
+
+        The search runs for at most ``max_steps`` steps. It stops earlier
+        when no unfinished hypothesis of any sentence can get a better score
+        than the finished hypothesis of the rank ``early_stop_rank`` of the
+        sentence, which is also the case when all the hypotheses have ended.
+
+        Returns:
+            The search step outputs stacked in time, the shape of each of
+            them is time x beam x batch.
+        """
         # collect attention objects
         att_objects = [self.parent_decoder.get_attention_object(e, False)
                        for e in self.parent_decoder.encoders]
         att_objects = [a for a in att_objects if a is not None]
 
+        if any(isinstance(a, CoverageAttention) for a in att_objects):
+            raise ValueError("Beam search does not support coverage "
+                             "attention, its history is not reordered "
+                             "with the hypotheses.")
+
+        batch_size = self.parent_decoder.batch_size
+        rows = self._beam_size * batch_size
+
+        # the encoder tensors are tiled to the hypotheses once, the copies
+        # also keep the histories of the loop body out of the decoder
+        att_objects = [a.tiled(rows) for a in att_objects]
+
+        # pylint: disable=protected-access
+        initial_state = self.parent_decoder._initial_rnn_state()
+        # pylint: enable=protected-access
+
+        # only the first hypothesis of each sentence is used in the first
+        # step, the others are replaced by its continuations
         state = SearchState(
-            logprob_sum=tf.zeros([1]),
-            lengths=tf.ones([1], dtype=tf.int32),
-            finished=tf.zeros([1], dtype=tf.bool),
-            last_word_ids=tf.expand_dims(tf.constant(START_TOKEN_INDEX), 0),
-            last_state=self.parent_decoder.initial_state,
-            last_attns=[tf.zeros([1, a.attn_size]) for a in att_objects]
+            logprob_sum=tf.concat(
+                [tf.zeros([batch_size]),
+                 tf.fill([rows - batch_size], tf.float32.min)], 0),
+            lengths=tf.ones([rows], dtype=tf.int32),
+            finished=tf.zeros([rows], dtype=tf.bool),
+            last_word_ids=tf.fill([rows], START_TOKEN_INDEX),
+            last_state=_map_state(
+                lambda s: tf.tile(s, [self._beam_size, 1]), initial_state),
+            last_attns=[tf.zeros([rows, a.attn_size]) for a in att_objects]
         )
 
-        # TODO rewrite using tf.while_loop
-
-        outputs = []
-        for _ in range(self._max_steps):
-            state, output = self.step(att_objects, state)
-            outputs.append(output)
+        def cond(step, bs_state, *_):
+            return tf.logical_and(tf.less(step, self._max_steps),
+                                  tf.logical_not(self._search_done(bs_state)))
+
+        def body(step, bs_state, scores_array, parents_array, tokens_array):
+            bs_state, output = self.step(att_objects, bs_state)
+            return (step + 1,
+                    bs_state,
+                    scores_array.write(step, output.scores),
+                    parents_array.write(step, output.parent_ids),
+                    tokens_array.write(step, output.token_ids))
+
+        loop_vars = (tf.constant(0), state,
+                     tf.TensorArray(tf.float32, size=0, dynamic_size=True),
+                     tf.TensorArray(tf.int32, size=0, dynamic_size=True),
+                     tf.TensorArray(tf.int32, size=0, dynamic_size=True))
+        _, _, scores_array, parents_array, tokens_array = tf.while_loop(
+            cond, body, loop_vars)
+
+        outputs = SearchStepOutput(scores=scores_array.stack(),
+                                   parent_ids=parents_array.stack(),
+                                   token_ids=tokens_array.stack())
+        for output in outputs:
+            output.set_shape([None, self._beam_size, None])
 
         return outputs
 
+    def _search_done(self, bs_state: SearchState) -> tf.Tensor:
+        """Check whether the best hypotheses can no longer change.
+
+        The sum of the log-probabilities of a hypothesis can only decrease,
+        so the score of an unfinished hypothesis is bounded by its current
+        sum divided by the largest length penalty it can reach. When this
+        bound is not higher than the score of the ``early_stop_rank``-th best
+        finished hypothesis, the hypotheses up to this rank are final.
+        """
+        max_penalty = tf.maximum(
+            self._length_penalty(bs_state.lengths),
+            self._length_penalty(self._max_steps + 1))
+
+        finished_scores = tf.where(
+            bs_state.finished,
+            bs_state.logprob_sum / self._length_penalty(bs_state.lengths),
+            tf.fill(tf.shape(bs_state.logprob_sum), tf.float32.min))
+        unfinished_bounds = tf.where(
+            bs_state.finished,
+            tf.fill(tf.shape(bs_state.logprob_sum), tf.float32.min),
+            bs_state.logprob_sum / max_penalty)
+
+        # shape(both) = batch
+        kth_finished = tf.nn.top_k(
+            tf.transpose(tf.reshape(finished_scores, [self._beam_size, -1])),
+            self.early_stop_rank).values[:, -1]
+        best_unfinished = tf.reduce_max(tf.reshape(
+            unfinished_bounds, [self._beam_size, -1]), 0)
+
+        return tf.reduce_all(tf.greater_equal(kth_finished, best_unfinished))
+
     # pylint: disable=too-many-locals
     def step(self,
              att_objects: List[BaseAttention],
              bs_state: SearchState) -> Tuple[SearchState, SearchStepOutput]:
 
+        batch_size = self.parent_decoder.batch_size
+        vocabulary_size = len(self.parent_decoder.vocabulary)
+
         # embed the previously decoded word
         input_ = self.parent_decoder.embed_and_dropout(
             bs_state.last_word_ids)
@@ -100,14 +217,14 @@ class BeamSearchDecoder(ModelPart):
 
         # run the parent decoder decoding step
         # shapes:
-        # logits: beam x vocabulary
-        # state: beam x rnn_size
-        # attns: encoder x beam x context vector size
+        # logits: (beam * batch) x vocabulary
+        # state: (beam * batch) x rnn_size
+        # attns: encoder x (beam * batch) x context vector size
         logits, state, attns = self.parent_decoder.step(
             att_objects, input_, bs_state.last_state, bs_state.last_attns)
 
         # mask the probabilities
-        # shape(logprobs) = beam x vocabulary
+        # shape(logprobs) = (beam * batch) x vocabulary
         logprobs = tf.nn.log_softmax(logits)
 
         finished_mask = tf.expand_dims(tf.to_float(bs_state.finished), 1)
@@ -115,7 +232,7 @@ class BeamSearchDecoder(ModelPart):
 
         finished_row = tf.one_hot(
             PAD_TOKEN_INDEX,
-            len(self.parent_decoder.vocabulary),
+            vocabulary_size,
             dtype=tf.float32,
             on_value=0.,
             off_value=tf.float32.min)
@@ -124,48 +241,53 @@ class BeamSearchDecoder(ModelPart):
         logprobs = unfinished_logprobs + finished_logprobs
 
         # update hypothesis scores
-        # shape(hyp_probs) = beam x vocabulary
+        # shape(hyp_probs) = (beam * batch) x vocabulary
         hyp_probs = tf.expand_dims(bs_state.logprob_sum, 1) + logprobs
 
         # update hypothesis lengths
         hyp_lengths = bs_state.lengths + 1 - tf.to_int32(bs_state.finished)
 
-        # shape(scores) = beam x vocabulary
+        # shape(scores) = (beam * batch) x vocabulary
         scores = hyp_probs / tf.expand_dims(
             self._length_penalty(hyp_lengths), 1)
 
-        # flatten so we can use top_k
-        scores_flat = tf.reshape(scores, [-1])
-
-        # shape(both) = beam
-        topk_scores, topk_indices = tf.nn.top_k(scores_flat, self._beam_size)
-
-        topk_scores.set_shape([self._beam_size])
-        topk_indices.set_shape([self._beam_size])
-
-        # flatten the hypothesis probabilities
-        hyp_probs_flat = tf.reshape(hyp_probs, [-1])
+        # group the hypotheses by sentences so we can use top_k
+        # shape(scores_by_sentence) = batch x (beam * vocabulary)
+        scores_by_sentence = tf.reshape(
+            tf.transpose(
+                tf.reshape(scores,
+                           [self._beam_size, batch_size, vocabulary_size]),
+                [1, 0, 2]),
+            [batch_size, self._beam_size * vocabulary_size])
+
+        # shape(both) = beam x batch
+        topk_scores, topk_indices = tf.nn.top_k(scores_by_sentence,
+                                                self._beam_size)
+        topk_scores = tf.transpose(topk_scores)
+        topk_indices = tf.transpose(topk_indices)
+
+        next_word_ids = tf.mod(topk_indices, vocabulary_size)
+        next_beam_ids = tf.div(topk_indices, vocabulary_size)
+
+        # rows of the parent hypotheses, shape(both) = (beam * batch)
+        parent_rows = tf.reshape(
+            next_beam_ids * batch_size + tf.range(batch_size), [-1])
+        next_word_ids_flat = tf.reshape(next_word_ids, [-1])
 
         # select logprobs of the best hyps (disregard lenghts)
-        next_logprob_sum = tf.gather(hyp_probs_flat, topk_indices)
-        # pylint: disable=no-member
-        next_logprob_sum.set_shape([self._beam_size])
-        # pylint: enable=no-member
-
-        next_word_ids = tf.mod(topk_indices,
-                               len(self.parent_decoder.vocabulary))
-
-        next_beam_ids = tf.div(topk_indices,
-                               len(self.parent_decoder.vocabulary))
+        next_logprob_sum = tf.gather(
+            tf.reshape(hyp_probs, [-1]),
+            parent_rows * vocabulary_size + next_word_ids_flat)
 
-        next_beam_prev_state = tf.gather(state, next_beam_ids)
-        next_beam_prev_attns = [tf.gather(a, next_beam_ids) for a in attns]
-        next_lengths = tf.gather(hyp_lengths, next_beam_ids)
+        next_beam_prev_state = _map_state(
+            lambda s: tf.gather(s, parent_rows), state)
+        next_beam_prev_attns = [tf.gather(a, parent_rows) for a in attns]
+        next_lengths = tf.gather(hyp_lengths, parent_rows)
 
         # update finished flags
-        has_just_finished = tf.equal(next_word_ids, END_TOKEN_INDEX)
+        has_just_finished = tf.equal(next_word_ids_flat, END_TOKEN_INDEX)
         next_finished = tf.logical_or(
-            tf.gather(bs_state.finished, next_beam_ids),
+            tf.gather(bs_state.finished, parent_rows),
             has_just_finished)
 
         output = SearchStepOutput(
@@ -177,7 +299,7 @@ class BeamSearchDecoder(ModelPart):
             logprob_sum=next_logprob_sum,
             lengths=next_lengths,
             finished=next_finished,
-            last_word_ids=next_word_ids,
+            last_word_ids=next_word_ids_flat,
             last_state=next_beam_prev_state,
             last_attns=next_beam_prev_attns)
 
@@ -192,7 +314,6 @@ class BeamSearchDecoder(ModelPart):
             train: Boolean flag, telling whether this is a training run
         """
         assert not train
-        assert len(dataset) == 1
 
         return {}
 
@@ -1,13 +1,17 @@
 import math
 from typing import cast, Iterable, List, Callable, Optional, Any, Tuple
+# pylint: disable=unused-import
+from typing import Dict
+# pylint: enable=unused-import
 
 import numpy as np
 import tensorflow as tf
 from typeguard import check_argument_types
 
-from neuralmonkey.decoding_function import BaseAttention
+from neuralmonkey.decoding_function import BaseAttention, CoverageAttention
 from neuralmonkey.dataset import Dataset
-from neuralmonkey.vocabulary import Vocabulary, START_TOKEN, END_TOKEN_INDEX
+from neuralmonkey.vocabulary import (
+    Vocabulary, START_TOKEN, END_TOKEN_INDEX, is_encoded_series)
 from neuralmonkey.model.model_part import ModelPart, FeedDict
 from neuralmonkey.model.sequence import EmbeddedSequence
 from neuralmonkey.logging import log, warn
@@ -25,6 +29,65 @@ RNN_CELL_TYPES = {
 }
 
 
+def _new_array(dtype: tf.DType) -> tf.TensorArray:
+    return tf.TensorArray(dtype=dtype, size=0, dynamic_size=True)
+
+
+def _state_parts(state: Any) -> List[tf.Tensor]:
+    if isinstance(state, tf.contrib.rnn.LSTMStateTuple):
+        return [state.c, state.h]
+    return [state]
+
+
+# per-step lists which the attention objects may append to
+_HISTORIES = ["attentions_in_time", "logits_in_time"]
+
+# attention object, name of the history and its length before the decoding
+HistoryRecord = Tuple[BaseAttention, str, int]
+
+
+def _history_records(att_objects: List[BaseAttention]) -> List[HistoryRecord]:
+    return [(a, name, len(getattr(a, name)))
+            for a in att_objects for name in _HISTORIES if hasattr(a, name)]
+
+
+def _batch_constants(outputs: List[tf.Tensor],
+                     step_inputs: List[tf.Tensor]) -> List[tf.Tensor]:
+    """Find the tensors a decoding step uses which are constant in a batch.
+
+    These are the tensors computed from the fed data (not just from the
+    model variables) which the ops of the step depend on, but which do not
+    depend on the step inputs themselves.
+
+    Arguments:
+        outputs: The outputs of the step.
+        step_inputs: The placeholders of the step inputs.
+
+    Returns:
+        List of the tensors, which can be fetched and fed back.
+    """
+    graph = tf.get_default_graph()
+    step_input_ops = set(t.op for t in step_inputs)
+
+    step_ops = set(tf.contrib.graph_editor.get_backward_walk_ops(
+        [t.op for t in outputs],
+        within_ops=tf.contrib.graph_editor.get_forward_walk_ops(
+            list(step_input_ops))))
+    data_ops = set(tf.contrib.graph_editor.get_forward_walk_ops(
+        [op for op in graph.get_operations() if op.type == "Placeholder"]))
+
+    constants = []  # type: List[tf.Tensor]
+    for op in sorted(step_ops - step_input_ops, key=lambda op: op.name):
+        for tensor in op.inputs:
+            if (tensor.op not in step_ops and tensor.op in data_ops
+                    and tensor.op.type != "Placeholder"
+                    and graph.is_feedable(tensor)
+                    and tensor not in constants):
+                constants.append(tensor)
+
+    return constants
+
+
 # pylint: disable=too-many-instance-attributes,too-few-public-methods
 # Big decoder cannot be simpler. Not sure if refactoring
 # it into smaller units would be helpful
@@ -169,6 +232,12 @@ class Decoder(ModelPart):
             embedded_go_symbols = tf.nn.embedding_lookup(self.embedding_matrix,
                                                          self.go_symbols)
 
+            # time-major histories of the attention distributions and logits
+            self.attention_histories = {}
+            # type: Dict[BaseAttention, tf.Tensor]
+            self.attention_logit_histories = {}
+            # type: Dict[BaseAttention, tf.Tensor]
+
             # fetch train attention objects
             self._train_attention_objects = {}
             # type: Dict[Attentive, tf.Tensor]
@@ -179,13 +248,20 @@ class Decoder(ModelPart):
                         for e in self.encoders
                         if isinstance(e, Attentive)}
 
-            self.train_logits, _, _ = self._decoding_loop(
-                embedded_go_symbols,
-                train_inputs=embedded_train_inputs,
-                train_mode=True)
+            # coverage attention needs the history of the attention
+            # distributions, which is not available inside a while loop
+            self._static_unrolling = any(
+                isinstance(a, CoverageAttention)
+                for a in self._train_attention_objects.values())
+
+            self.train_logits = self._train_loop(
+                embedded_go_symbols, embedded_train_inputs)
 
             assert not tf.get_variable_scope().reuse
             tf.get_variable_scope().reuse_variables()
+            # the step scope is entered as a scope object, which does not
+            # inherit the reuse flag of the decoder scope
+            self.step_scope.reuse_variables()
 
             # fetch runtime attention objects
             self._runtime_attention_objects = {}
@@ -198,31 +274,33 @@ class Decoder(ModelPart):
 
             (self.runtime_logits,
              self.runtime_rnn_states,
-             self.runtime_mask) = self._decoding_loop(
-                 embedded_go_symbols,
-                 train_mode=False)
+             self.runtime_mask) = self._runtime_loop(embedded_go_symbols)
+
+            self._create_incremental_step()
 
             train_targets = tf.transpose(self.train_inputs)
 
             self.train_xents = tf.contrib.seq2seq.sequence_loss(
-                tf.stack(self.train_logits, 1), train_targets,
+                tf.transpose(self.train_logits, [1, 0, 2]), train_targets,
                 tf.transpose(self.train_padding),
                 average_across_batch=False)
             self.train_loss = tf.reduce_mean(self.train_xents)
             self.cost = self.train_loss
 
-            self.train_logprobs = [tf.nn.log_softmax(l)
-                                   for l in self.train_logits]
+            self.train_logprobs = self.train_logits - tf.reduce_logsumexp(
+                self.train_logits, axis=2, keep_dims=True)
 
-            self.decoded = [tf.argmax(logit[:, 1:], 1) + 1 for logit in
-                            self.runtime_logits]
+            self.decoded = tf.argmax(self.runtime_logits[:, :, 1:], 2) + 1
 
+            # the runtime decoding runs at least as many steps as there are
+            # in the targets, see the runtime_min_steps placeholder
+            target_steps = tf.shape(self.train_inputs)[0]
             self.runtime_loss = tf.contrib.seq2seq.sequence_loss(
-                tf.stack(self.runtime_logits, 1), train_targets,
-                tf.transpose(self.train_padding))
+                tf.transpose(self.runtime_logits[:target_steps], [1, 0, 2]),
+                train_targets, tf.transpose(self.train_padding))
 
-            self.runtime_logprobs = [tf.nn.log_softmax(l)
-                                     for l in self.runtime_logits]
+            self.runtime_logprobs = self.runtime_logits - tf.reduce_logsumexp(
+                self.runtime_logits, axis=2, keep_dims=True)
 
             self._visualize_attention()
 
@@ -238,18 +316,24 @@ class Decoder(ModelPart):
 
         self.batch_size = tf.shape(self.go_symbols)[1]
 
+        # the runtime decoding does not stop before this number of steps even
+        # if all the outputs have already ended, the targets of this length
+        # are fed when the runtime loss is computed
+        self.runtime_min_steps = tf.placeholder_with_default(
+            0, shape=[], name="decoder_runtime_min_steps")
+
     def _create_training_placeholders(self) -> None:
         """Creates training placeholder nodes in the computation graph
 
-        The training placeholder nodes are NOT fed during runtime.
+        The training placeholder nodes are NOT fed during runtime. The targets
+        are padded only to the length of the longest one in the batch (unless
+        the decoder is statically unrolled).
         """
         self.train_inputs = tf.placeholder(
-            tf.int32, [self.max_output_len, None],
-            name="decoder_input_placeholder")
+            tf.int32, [None, None], name="decoder_input_placeholder")
 
         self.train_padding = tf.placeholder(
-            tf.float32, [self.max_output_len, None],
-            name="decoder_padding_placeholder")
+            tf.float32, [None, None], name="decoder_padding_placeholder")
 
     def _create_initial_state(self) -> None:
         """Construct the part of the computation graph that computes
@@ -384,18 +468,8 @@ class Decoder(ModelPart):
                 decoded using the loop function)
             scope: Variable scope to use
         """
-        att_objects = [self.get_attention_object(e, train_mode)
-                       for e in self.encoders]
-        att_objects = [a for a in att_objects if a is not None]
-
-        if self._rnn_cell_str == 'GRU':
-            state = self.initial_state
-        elif self._rnn_cell_str == 'LSTM':
-            state = tf.contrib.rnn.LSTMStateTuple(
-                self.initial_state, self.initial_state)
-        else:
-            raise ValueError("Unknown RNN cell.")
-
+        att_objects = self._attention_objects(train_mode)
+        state = self._initial_rnn_state()
         step_logits = None
 
         attns = [tf.zeros([self.batch_size, a.attn_size])
@@ -435,16 +509,285 @@ class Decoder(ModelPart):
 
         return logits, states, mask
 
+    def _attention_objects(self, train_mode: bool) -> List[BaseAttention]:
+        att_objects = [self.get_attention_object(e, train_mode)
+                       for e in self.encoders]
+        return [a for a in att_objects if a is not None]
+
+    def _initial_rnn_state(self) -> Any:
+        if self._rnn_cell_str == 'GRU':
+            return self.initial_state
+        elif self._rnn_cell_str == 'LSTM':
+            return tf.contrib.rnn.LSTMStateTuple(
+                self.initial_state, self.initial_state)
+
+        raise ValueError("Unknown RNN cell.")
+
+    @staticmethod
+    def _write_histories(records: List[HistoryRecord],
+                         arrays: List[tf.TensorArray],
+                         step: tf.Tensor) -> List[tf.TensorArray]:
+        """Write the last entries of the attention histories in a loop."""
+        return [array.write(step, getattr(a, name)[-1])
+                for array, (a, name, _) in zip(arrays, records)]
+
+    def _store_histories(
+            self, records: List[HistoryRecord],
+            arrays: Optional[List[tf.TensorArray]] = None) -> None:
+        """Stack the attention histories recorded during the decoding.
+
+        The tensors appended to the per-step lists of the attention objects
+        in a while loop body cannot be used outside of the loop, so they are
+        removed from the lists and the histories recorded in the tensor
+        arrays are used instead.
+
+        Arguments:
+            records: The recorded histories.
+            arrays: The tensor arrays with the histories recorded in a while
+                loop, or None if the decoder was statically unrolled.
+        """
+        histories = {"attentions_in_time": self.attention_histories,
+                     "logits_in_time": self.attention_logit_histories}
+
+        if arrays is None:
+            for a, name, length in records:
+                if len(getattr(a, name)) > length:
+                    histories[name][a] = tf.stack(getattr(a, name)[length:])
+            return
+
+        for (a, name, length), array in zip(records, arrays):
+            del getattr(a, name)[length:]
+            history = array.stack()
+            history.set_shape([None, None, None])
+            histories[name][a] = history
+
+    def _train_loop(self, go_symbols: tf.Tensor,
+                    train_inputs: tf.Tensor) -> tf.Tensor:
+        """Run the decoder RNN on the ground truth inputs in a while loop.
+
+        The loop runs as many steps as there are in the fed targets, which
+        are only padded to the longest target in the batch.
+
+        Arguments:
+            go_symbols: The embedded start symbols of shape
+                (1, batch_size, embedding_size)
+            train_inputs: The embedded targets without the last step.
+
+        Returns:
+            Time-major tensor of the logits.
+        """
+        att_objects = self._attention_objects(train_mode=True)
+
+        records = _history_records(att_objects)
+
+        if self._static_unrolling:
+            logits, _, _ = self._decoding_loop(
+                go_symbols, train_inputs=train_inputs, train_mode=True)
+            self._store_histories(records)
+            return tf.stack(logits)
+
+        inputs = tf.concat([go_symbols, train_inputs], 0)
+        steps = tf.shape(self.train_inputs)[0]
+
+        # pylint: disable=unused-argument
+        def cond(step, state, attns, logits_array, history_arrays):
+            return tf.less(step, steps)
+        # pylint: enable=unused-argument
+
+        def body(step, state, attns, logits_array, history_arrays):
+            step_logits, state, attns = self.step(
+                att_objects, inputs[step], state, attns)
+            return (step + 1, state, attns,
+                    logits_array.write(step, step_logits),
+                    self._write_histories(records, history_arrays, step))
+
+        loop_vars = (
+            tf.constant(0),
+            self._initial_rnn_state(),
+            [tf.zeros([self.batch_size, a.attn_size]) for a in att_objects],
+            _new_array(tf.float32),
+            [_new_array(tf.float32) for _ in records])
+
+        _, _, _, logits_array, history_arrays = tf.while_loop(
+            cond, body, loop_vars)
+        self._store_histories(records, history_arrays)
+
+        logits = logits_array.stack()
+        logits.set_shape([None, None, len(self.vocabulary)])
+        return logits
+
+    # pylint: disable=too-many-locals
+    def _runtime_loop(self, go_symbols: tf.Tensor) -> Tuple[
+            tf.Tensor, Any, tf.Tensor]:
+        """Run the decoder RNN on its own outputs in a while loop.
+
+        The decoding stops after ``max_output_len`` steps, or as soon as all
+        the outputs have ended (but not before ``runtime_min_steps``).
+        The histories of the runtime attention objects are stored in the
+        ``attention_histories`` and ``attention_logit_histories``
+        dictionaries.
+
+        If the decoder is statically unrolled (see ``_static_unrolling``),
+        the loop always runs for ``max_output_len`` steps.
+
+        Arguments:
+            go_symbols: The tensor of start symbols of shape (1, batch_size)
+
+        Returns:
+            A tuple of time-major tensors of the logits, the RNN states
+            (an ``LSTMStateTuple`` of them for LSTM cells) and the mask of the
+            unfinished outputs.
+        """
+        att_objects = self._attention_objects(train_mode=False)
+        records = _history_records(att_objects)
+
+        if self._static_unrolling:
+            logits, states, mask = self._decoding_loop(
+                go_symbols, train_mode=False)
+            self._store_histories(records)
+
+            if self._rnn_cell_str == 'LSTM':
+                stacked_states = tf.contrib.rnn.LSTMStateTuple(
+                    tf.stack([s.c for s in states]),
+                    tf.stack([s.h for s in states]))
+            else:
+                stacked_states = tf.stack(states)
+            return tf.stack(logits), stacked_states, tf.stack(mask)
+
+        # pylint: disable=unused-argument
+        def cond(step, input_, state, attns, finished, *arrays):
+            unfinished = tf.logical_or(
+                tf.less(step, self.runtime_min_steps),
+                tf.logical_not(tf.reduce_all(finished)))
+            return tf.logical_and(tf.less(step, self.max_output_len),
+                                  unfinished)
+        # pylint: enable=unused-argument
+
+        # pylint: disable=too-many-arguments
+        def body(step, input_, state, attns, finished, logits_array,
+                 states_arrays, mask_array, history_arrays):
+            step_logits, state, attns = self.step(
+                att_objects, input_, state, attns)
+
+            next_word_id = tf.argmax(step_logits, axis=1)
+            has_just_finished = tf.equal(next_word_id, END_TOKEN_INDEX)
+            finished = tf.logical_or(has_just_finished, finished)
+
+            return (
+                step + 1,
+                self.embed_and_dropout(next_word_id),
+                state,
+                attns,
+                finished,
+                logits_array.write(step, step_logits),
+                [array.write(step, part) for array, part in zip(
+                    states_arrays, _state_parts(state))],
+                mask_array.write(step, tf.logical_not(finished)),
+                self._write_histories(records, history_arrays, step))
+        # pylint: enable=too-many-arguments
+
+        initial_state = self._initial_rnn_state()
+        loop_vars = (
+            tf.constant(0),
+            go_symbols[0],
+            initial_state,
+            [tf.zeros([self.batch_size, a.attn_size]) for a in att_objects],
+            tf.zeros([self.batch_size], dtype=tf.bool),
+            _new_array(tf.float32),
+            [_new_array(tf.float32) for _ in _state_parts(initial_state)],
+            _new_array(tf.bool),
+            [_new_array(tf.float32) for _ in records])
+
+        (_, _, _, _, _, logits_array, states_arrays, mask_array,
+         history_arrays) = tf.while_loop(cond, body, loop_vars)
+
+        self._store_histories(records, history_arrays)
+
+        states = [array.stack() for array in states_arrays]
+        for part in states:
+            part.set_shape([None, None, self.rnn_size])
+        if self._rnn_cell_str == 'LSTM':
+            rnn_states = tf.contrib.rnn.LSTMStateTuple(*states)
+        else:
+            rnn_states = states[0]
+
+        logits = logits_array.stack()
+        logits.set_shape([None, None, len(self.vocabulary)])
+        mask = mask_array.stack()
+        mask.set_shape([None, None])
+
+        return logits, rnn_states, mask
+    # pylint: enable=too-many-locals
+
+    def _create_incremental_step(self) -> None:
+        """Create the graph which runs a single decoding step at a time.
+
+        The step is fed with the previous word, RNN state and attention
+        contexts, which default to the start of the decoding. The new state
+        and contexts are fetched and fed back in the next session run. The
+        tensors in ``step_batch_constants`` (the encoder outputs, attention
+        keys, etc.) do not change during the decoding of a batch, so they
+        can be fetched in the first step and fed in the following ones
+        instead of running the encoders again.
+
+        Coverage attention needs the whole history of the attention
+        distributions, so the incremental step is not available with it and
+        all its tensors are None.
+        """
+        self.step_input_ids = None  # type: Optional[tf.Tensor]
+        self.step_prev_states = None  # type: Optional[List[tf.Tensor]]
+        self.step_prev_attns = None  # type: Optional[List[tf.Tensor]]
+        self.step_logprobs = None  # type: Optional[tf.Tensor]
+        self.step_states = None  # type: Optional[List[tf.Tensor]]
+        self.step_attns = None  # type: Optional[List[tf.Tensor]]
+        self.step_batch_constants = None  # type: Optional[List[tf.Tensor]]
+
+        if self._static_unrolling:
+            return
+
+        self.step_input_ids = tf.placeholder_with_default(
+            self.go_symbols[0], [None], name="decoder_step_input_ids")
+
+        # the step may be fed with the hypotheses of a beam search, the
+        # copies also keep the histories of the step out of the decoder
+        att_objects = [a.tiled(tf.shape(self.step_input_ids)[0])
+                       for a in self._attention_objects(train_mode=False)]
+
+        self.step_prev_states = [
+            tf.placeholder_with_default(part, [None, self.rnn_size],
+                                        name="decoder_step_prev_state")
+            for part in _state_parts(self._initial_rnn_state())]
+        self.step_prev_attns = [
+            tf.placeholder_with_default(
+                tf.zeros([self.batch_size, a.attn_size]), [None, a.attn_size],
+                name="decoder_step_prev_attn")
+            for a in att_objects]
+
+        if self._rnn_cell_str == 'LSTM':
+            prev_state = tf.contrib.rnn.LSTMStateTuple(*self.step_prev_states)
+        else:
+            prev_state = self.step_prev_states[0]
+
+        logits, state, self.step_attns = self.step(
+            att_objects, self.embed_and_dropout(self.step_input_ids),
+            prev_state, self.step_prev_attns)
+        self.step_logprobs = tf.nn.log_softmax(logits)
+        self.step_states = _state_parts(state)
+
+        self.step_batch_constants = _batch_constants(
+            [self.step_logprobs] + self.step_states + self.step_attns,
+            [self.step_input_ids] + self.step_prev_states
+            + self.step_prev_attns)
+
     def _visualize_attention(self) -> None:
         """Create image summaries with attentions"""
-        att_objects = self._runtime_attention_objects.values()
-
-        for i, a in enumerate(att_objects):
-            if not hasattr(a, "attentions_in_time"):
-                continue
+        histories = [self.attention_histories[a]
+                     for a in self._runtime_attention_objects.values()
+                     if a in self.attention_histories]
 
+        for i, history in enumerate(histories):
             alignments = tf.expand_dims(tf.transpose(
-                tf.stack(a.attentions_in_time), perm=[1, 2, 0]), -1)
+                history, perm=[1, 2, 0]), -1)
 
             tf.summary.image(
                 "attention_{}".format(i), alignments,
@@ -476,14 +819,18 @@ class Decoder(ModelPart):
 
         if sentences is not None:
             # train_mode=False, since we don't want to <unk>ize target words!
-            inputs, weights = self.vocabulary.sentences_to_tensor(
-                sentences_list, self.max_output_len, train_mode=False,
-                add_start_symbol=False, add_end_symbol=True)
+            if is_encoded_series(sentences_list):
+                to_tensor = self.vocabulary.ids_to_tensor
+            else:
+                to_tensor = self.vocabulary.sentences_to_tensor
 
-            assert inputs.shape == (self.max_output_len, len(sentences_list))
-            assert weights.shape == (self.max_output_len, len(sentences_list))
+            inputs, weights = to_tensor(
+                sentences_list, self.max_output_len,
+                pad_to_max_len=self._static_unrolling, train_mode=False,
+                add_start_symbol=False, add_end_symbol=True)
 
             fd[self.train_inputs] = inputs
             fd[self.train_padding] = weights
+            fd[self.runtime_min_steps] = inputs.shape[0]
 
         return fd
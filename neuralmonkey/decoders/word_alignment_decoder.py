@@ -42,11 +42,13 @@ class WordAlignmentDecoder(ModelPart):
                           collections=["summary_train"])
 
     def _make_decoder(self, runtime_mode=False):
-        attn_obj = self.decoder.get_attention_object(self.encoder,
-                                                     runtime_mode)
+        attn_obj = self.decoder.get_attention_object(
+            self.encoder, train_mode=not runtime_mode)
 
-        alignment_logits = tf.stack(attn_obj.logits_in_time,
-                                    name="alignment_logits")
+        # shape [decoding_steps, batch_size, max_input_len]
+        alignment_logits = tf.identity(
+            self.decoder.attention_logit_histories[attn_obj],
+            name="alignment_logits")
 
         if runtime_mode:
             # make batch_size the first dimension
@@ -56,8 +58,10 @@ class WordAlignmentDecoder(ModelPart):
         else:
             alignment = None
 
+            steps = tf.shape(alignment_logits)[0]
             xent = tf.nn.softmax_cross_entropy_with_logits(
-                labels=self.alignment_target, logits=alignment_logits)
+                labels=self.alignment_target[:steps],
+                logits=alignment_logits)
             loss = tf.reduce_sum(xent * self.decoder.train_padding)
 
         return alignment, loss
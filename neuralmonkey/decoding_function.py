@@ -5,14 +5,44 @@ for RNN decoders.
 See http://arxiv.org/abs/1606.07481
 """
 from abc import ABCMeta
+from typing import Dict, List
+import copy
 
 import tensorflow as tf
 from neuralmonkey.nn.projection import linear
 from neuralmonkey.nn.ortho_gru_cell import OrthoGRUCell
 
 
+def tile_for_beam(tensor: tf.Tensor, rows: tf.Tensor) -> tf.Tensor:
+    """Tile a batch-major encoder tensor to the rows of the decoder state.
+
+    The beam search decodes all hypotheses of a batch at once. The rows of
+    its decoder state are ordered by the beam and then by the batch, which
+    matches the order of ``tf.tile``. In greedy decoding, the number of rows
+    is the batch size and the tensor is returned unchanged.
+
+    Arguments:
+        tensor: The tensor whose first dimension is the batch size.
+        rows: The number of rows of the decoder state, a multiple of the
+            batch size.
+
+    Returns:
+        The tensor repeated ``rows / batch`` times along its first dimension.
+    """
+    batch = tf.shape(tensor)[0]
+    with tf.control_dependencies([tf.assert_equal(
+            tf.mod(rows, batch), 0,
+            message="Decoder rows are not a multiple of the batch size")]):
+        multiple = tf.div(rows, batch)
+    ones = [1] * (tensor.get_shape().ndims - 1)
+    return tf.tile(tensor, tf.stack([multiple] + ones))
+
+
 # pylint: disable=too-few-public-methods
 class BaseAttention(metaclass=ABCMeta):
+    # the batch-major tensors (or lists of them) read in the attention step
+    batch_major_attributes = ["attention_states", "input_weights"]
+
     def __init__(self,
                  scope: str,
                  attention_states: tf.Tensor,
@@ -29,6 +59,43 @@ class BaseAttention(metaclass=ABCMeta):
                   decoder_input: tf.Tensor) -> tf.Tensor:
         """Get context vector for given decoder state."""
         raise NotImplementedError("Abstract method")
+
+    def tiled(self, rows: tf.Tensor) -> "BaseAttention":
+        """Get a copy of the attention for a decoder state with more rows.
+
+        The beam search decodes the hypotheses of all sentences at once.
+        The encoder tensors the attention reads are tiled to the rows of its
+        decoder state once, before the search loop, instead of in every
+        step. The copy shares the variables with this object and it starts
+        with empty histories of the attention distributions.
+
+        Arguments:
+            rows: The number of rows of the decoder state.
+
+        Returns:
+            The copy of the attention object.
+        """
+        tiled = copy.copy(self)
+        tiled_tensors = {}  # type: Dict[int, tf.Tensor]
+
+        def tile(tensor: tf.Tensor) -> tf.Tensor:
+            # the attributes may share a tensor, it is tiled only once
+            if id(tensor) not in tiled_tensors:
+                tiled_tensors[id(tensor)] = tile_for_beam(tensor, rows)
+            return tiled_tensors[id(tensor)]
+
+        for name in self.batch_major_attributes:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                setattr(tiled, name, [tile(t) for t in value])
+            elif value is not None:
+                setattr(tiled, name, tile(value))
+
+        for name in ["logits_in_time", "attentions_in_time"]:
+            if hasattr(self, name):
+                setattr(tiled, name, [])
+
+        return tiled
 # pylint: enable=too-few-public-methods
 
 
@@ -36,6 +103,9 @@ class Attention(BaseAttention):
     # pylint: disable=unused-argument,too-many-instance-attributes
     # pylint: disable=too-many-arguments
 
+    batch_major_attributes = ["input_weights", "att_states_reshaped",
+                              "hidden_features"]
+
     # For maintaining the same API as in CoverageAttention
 
     def __init__(self,
@@ -122,8 +192,9 @@ class Attention(BaseAttention):
             self.attentions_in_time.append(a)
 
             # Now calculate the attention-weighted vector d.
-            d = tf.reduce_sum(tf.expand_dims(tf.expand_dims(a, -1), -1)
-                              * self.att_states_reshaped, [1, 2])
+            d = tf.reduce_sum(
+                tf.expand_dims(tf.expand_dims(a, -1), -1)
+                * self.att_states_reshaped, [1, 2])
 
             return tf.reshape(d, [-1, self.attn_size])
 
@@ -135,6 +206,8 @@ class Attention(BaseAttention):
 
 class CoverageAttention(Attention):
 
+    batch_major_attributes = Attention.batch_major_attributes + ["fertility"]
+
     # pylint: disable=too-many-arguments
     # Great objects require great number of parameters
     def __init__(self,
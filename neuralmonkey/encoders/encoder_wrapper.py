@@ -160,6 +160,10 @@ class FlatMultiAttention(MultiAttention):
 
     See equations 8 to 10 in the Attention Combination Strategies paper.
     """
+
+    batch_major_attributes = ["encoder_projections_for_logits",
+                              "encoder_projections_for_ctx", "masks_concat"]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -242,7 +246,9 @@ class FlatMultiAttention(MultiAttention):
                                   self.encoder_attn_biases):
 
                 logits.append(tf.reduce_sum(
-                    self.attn_v * tf.tanh(projected_state + proj), [2]) + bias)
+                    self.attn_v * tf.tanh(
+                        projected_state + proj),
+                    [2]) + bias)
 
             if self._use_sentinels:
                 sentinel_value = _sentinel(decoder_state,
@@ -257,12 +263,9 @@ class FlatMultiAttention(MultiAttention):
             self.attentions_in_time.append(attentions)
 
             if self._use_sentinels:
-                tiled_encoder_projections = self._tile_encoders_for_beamsearch(
-                    projected_sentinel)
-
                 projections_concat = tf.concat(
-                    tiled_encoder_projections + [projected_sentinel], 1)
-
+                    self.encoder_projections_for_ctx + [projected_sentinel],
+                    1)
             else:
                 projections_concat = tf.concat(
                     self.encoder_projections_for_ctx, 1)
@@ -272,20 +275,6 @@ class FlatMultiAttention(MultiAttention):
 
             return contexts
 
-    def _tile_encoders_for_beamsearch(self, projected_sentinel):
-        sentinel_batch_size = tf.shape(projected_sentinel)[0]
-        encoders_batch_size = tf.shape(
-            self.encoder_projections_for_ctx[0])[0]
-
-        modulo = tf.mod(sentinel_batch_size, encoders_batch_size)
-
-        with tf.control_dependencies([tf.assert_equal(modulo, 0)]):
-            beam_size = tf.div(sentinel_batch_size,
-                               encoders_batch_size)
-
-        return [tf.tile(proj, [beam_size, 1, 1])
-                for proj in self.encoder_projections_for_ctx]
-
     def _renorm_softmax(self, logits):
         """Renormalized softmax wrt. attention mask."""
         softmax_concat = tf.nn.softmax(logits) * self.masks_concat
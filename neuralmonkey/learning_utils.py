@@ -1,7 +1,7 @@
 # pylint: disable=too-many-lines
 # TODO de-clutter this file!
 
-from typing import Any, Callable, Dict, List, Tuple, Optional, Union, Iterable
+from typing import Any, Callable, Dict, List, Tuple, Optional, Union
 import time
 import re
 from datetime import timedelta
@@ -10,7 +10,8 @@ import tensorflow as tf
 from termcolor import colored
 
 from neuralmonkey.logging import log, log_print, warn, notice
-from neuralmonkey.dataset import Dataset, LazyDataset
+from neuralmonkey.checkpoint_averaging import average_checkpoints
+from neuralmonkey.dataset import Dataset, LazyDataset, BatchingScheme
 from neuralmonkey.tf_manager import TensorFlowManager
 from neuralmonkey.runners.base_runner import BaseRunner, ExecutionResult
 from neuralmonkey.trainers.generic_trainer import GenericTrainer
@@ -46,7 +47,9 @@ def training_loop(tf_manager: TensorFlowManager,
                   train_start_offset: int = 0,
                   runners_batch_size: Optional[int] = None,
                   initial_variables: Optional[Union[str, List[str]]] = None,
-                  postprocess: Postprocess = None) -> None:
+                  postprocess: Postprocess = None,
+                  batching_scheme: Optional[BatchingScheme] = None,
+                  average_n_best: int = 0) -> None:
     """
     Performs the training loop for given graph and data.
     Args:
@@ -80,13 +83,21 @@ def training_loop(tf_manager: TensorFlowManager,
         val_preview_num_examples: how many examples should be printed during
             validation
         train_start_offset: how many lines from the training dataset should be
-            skipped. The training starts from the next batch.
+            skipped in the first epoch. Lazy datasets seek directly to the
+            offset using the line index of their files.
         runners_batch_size: batch size of runners. It is the same as batch_size
             if not specified
         initial_variables: variables used for initialization, for example for
             continuation of training
         postprocess: A function which takes the dataset with its output series
             and generates additional series from them.
+        batching_scheme: Optional length-bucketed batching of the training
+            data. If provided, the training batches are filled up to a token
+            budget instead of having batch_size examples.
+        average_n_best: If greater than one, the variables of the given
+            number of the best saved models are averaged after the training
+            and the averaged model is used for the test datasets. At most
+            save_n_best models of the TensorFlow manager can be averaged.
     """
     check_argument_types()
 
@@ -100,6 +111,15 @@ def training_loop(tf_manager: TensorFlowManager,
 
     _check_series_collisions(runners, postprocess)
 
+    if average_n_best > 1:
+        if average_n_best > tf_manager.saver_max_to_keep:
+            raise ValueError("Cannot average {} best models when only {} are "
+                             "saved".format(average_n_best,
+                                            tf_manager.saver_max_to_keep))
+        if len(tf_manager.sessions) > 1:
+            raise ValueError("Checkpoint averaging is not supported when "
+                             "training with multiple sessions")
+
     _log_model_variables()
 
     if tf_manager.report_gpu_memory_consumption:
@@ -150,14 +170,20 @@ def training_loop(tf_manager: TensorFlowManager,
             log("Epoch {} starts".format(epoch_n), color='red')
 
             train_dataset.shuffle()
-            train_batched_datasets = train_dataset.batch_dataset(batch_size)
+            epoch_dataset = train_dataset
 
             if epoch_n == 1 and train_start_offset:
                 if not isinstance(train_dataset, LazyDataset):
                     warn("Not skipping training instances with "
                          "shuffled in-memory dataset")
                 else:
-                    _skip_lines(train_start_offset, train_batched_datasets)
+                    log("Skipping first {} instances in the dataset"
+                        .format(train_start_offset))
+                    epoch_dataset = train_dataset.from_offset(
+                        train_start_offset)
+
+            train_batched_datasets = epoch_dataset.batch_dataset(
+                batch_size, batching_scheme)
 
             for batch_n, batch_dataset in enumerate(train_batched_datasets):
                 step += 1
@@ -266,8 +292,12 @@ def training_loop(tf_manager: TensorFlowManager,
                     last_seen_instances = seen_instances
                     log("Validation time: {:.2f}s, inter-validation: {:.2f}s, "
                         "per-instance (train): {:.2f}s, per-instance (val): "
-                        "{:.2f}s".format(val_duration, training_duration,
-                                         steptime, valtime), color="blue")
+                        "{:.2f}s, waiting for input (total): {:.2f}s, "
+                        "feed dictionaries built: {}".format(
+                            val_duration, training_duration, steptime,
+                            valtime, tf_manager.input_wait_time,
+                            tf_manager.feed_dict_builds),
+                        color="blue")
                     if training_duration < 2 * val_duration:
                         notice("Validation period setting is inefficient.")
 
@@ -281,7 +311,11 @@ def training_loop(tf_manager: TensorFlowManager,
         .format(main_metric, tf_manager.best_score,
                 tf_manager.best_score_epoch))
 
-    if test_datasets:
+    if average_n_best > 1:
+        _average_best_vars(tf_manager, average_n_best, runners,
+                           val_datasets[-1], evaluators, main_metric,
+                           postprocess, runners_batch_size)
+    elif test_datasets:
         tf_manager.restore_best_vars()
 
     for dataset in test_datasets:
@@ -297,6 +331,38 @@ def training_loop(tf_manager: TensorFlowManager,
     log("Finished.")
 
 
+# pylint: disable=too-many-arguments
+def _average_best_vars(tf_manager: TensorFlowManager,
+                       n_best: int,
+                       runners: List[BaseRunner],
+                       val_dataset: Dataset,
+                       evaluators: EvalConfiguration,
+                       main_metric: str,
+                       postprocess: Postprocess,
+                       batch_size: int) -> None:
+    """Average the best saved models and load the result to the session."""
+    variables_files = tf_manager.best_variables_files(n_best)
+    if not variables_files:
+        warn("No model was saved during the training, nothing to average.")
+        return
+
+    log("Averaging the variables of the {} best models"
+        .format(len(variables_files)))
+    average_checkpoints(variables_files, tf_manager.averaged_vars_file,
+                        [var.op.name for var in tf.trainable_variables()])
+    tf_manager.restore(tf_manager.averaged_vars_file)
+
+    val_results, val_outputs = run_on_dataset(
+        tf_manager, runners, val_dataset, postprocess,
+        write_out=False, batch_size=batch_size)
+    val_outputs = {k: list(v) for k, v in val_outputs.items()}
+    val_evaluation = evaluation(evaluators, val_dataset, runners,
+                                val_results, val_outputs)
+    log("{} of the averaged model on validation data: {:.4g}"
+        .format(main_metric, val_evaluation[main_metric]), color="blue")
+# pylint: enable=too-many-arguments
+
+
 def _is_logging_time(step: int, logging_period_batch: int,
                      last_log_time: float, logging_period_time: int):
     if logging_period_batch is not None:
@@ -625,28 +691,6 @@ def _print_examples(dataset: Dataset,
         log_print("")
 
 
-def _skip_lines(start_offset: int,
-                batched_datasets: Iterable[Dataset]) -> None:
-    """Skip training instances from the beginning.
-
-    Arguments:
-        start_offset: How many training instances to skip (minimum)
-        batched_datasets: From where to throw away batches
-    """
-    log("Skipping first {} instances in the dataset".format(start_offset))
-
-    skipped_instances = 0
-    while skipped_instances < start_offset:
-        try:
-            skipped_instances += len(next(batched_datasets))  # type: ignore
-        except StopIteration:
-            raise ValueError("Trying to skip more instances than "
-                             "the size of the dataset")
-
-    if skipped_instances > 0:
-        log("Skipped {} instances".format(skipped_instances))
-
-
 def _log_model_variables() -> None:
     trainable_vars = tf.trainable_variables()
     total_params = 0
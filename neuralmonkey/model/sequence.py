@@ -8,7 +8,7 @@ from tensorflow.contrib.tensorboard.plugins import projector
 from typeguard import check_argument_types
 
 from neuralmonkey.model.model_part import ModelPart, FeedDict
-from neuralmonkey.vocabulary import Vocabulary
+from neuralmonkey.vocabulary import Vocabulary, is_encoded_series
 from neuralmonkey.decorators import tensor
 from neuralmonkey.dataset import Dataset
 
@@ -216,10 +216,15 @@ class EmbeddedFactorSequence(Sequence):
 
         for factor_plc, name, vocabulary in zip(
                 self.input_factors, self.data_ids, self.vocabularies):
-            factors = dataset.get_series(name)
-            vectors, paddings = vocabulary.sentences_to_tensor(
-                list(factors), self.max_length, pad_to_max_len=False,
-                train_mode=train)
+            factors = list(dataset.get_series(name))
+            if is_encoded_series(factors):
+                vectors, paddings = vocabulary.ids_to_tensor(
+                    factors, self.max_length, pad_to_max_len=False,
+                    train_mode=train)
+            else:
+                vectors, paddings = vocabulary.sentences_to_tensor(
+                    factors, self.max_length, pad_to_max_len=False,
+                    train_mode=train)
 
             fd[factor_plc] = list(zip(*vectors))
 
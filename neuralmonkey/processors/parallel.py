@@ -0,0 +1,159 @@
+"""Parallel application of preprocessors in a pool of processes.
+
+The worker processes are not forked from the calling process, which may
+already run TensorFlow sessions and other threads that must not be forked.
+They are started by a fork server (or spawned where the fork server is not
+available) and live until the end of the program, so they are shared by all
+the preprocessing runs, e.g. by all the epochs of the training.
+
+The applied function (e.g. a preprocessor with a large table) is pickled
+once per run into a temporary file. Each worker loads it from the file when
+it gets the first chunk of the run and keeps it for the following chunks,
+which carry only the token of the function.
+"""
+
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List
+import atexit
+import collections
+import itertools
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import uuid
+
+from neuralmonkey.logging import warn
+
+# number of items sent to a worker process at once
+DEFAULT_CHUNK_SIZE = 1000
+
+# the long-lived pools by the number of their workers
+_POOLS = {}  # type: Dict[int, Any]
+_POOLS_LOCK = threading.Lock()
+
+# the functions loaded in a worker process by their tokens, the newest last
+_WORKER_FUNCTIONS = collections.OrderedDict()  # type: Dict[str, Callable]
+_WORKER_FUNCTIONS_LIMIT = 8
+
+
+def _worker_function(token: str, path: str) -> Callable:
+    """Get the function of a run in a worker process, load it if needed."""
+    if token not in _WORKER_FUNCTIONS:
+        with open(path, "rb") as f_function:
+            _WORKER_FUNCTIONS[token] = pickle.load(f_function)
+        while len(_WORKER_FUNCTIONS) > _WORKER_FUNCTIONS_LIMIT:
+            _WORKER_FUNCTIONS.popitem(last=False)
+    return _WORKER_FUNCTIONS[token]
+
+
+def _map_chunk(token: str, path: str, chunk: List[Any]) -> List[Any]:
+    function = _worker_function(token, path)
+    return [function(item) for item in chunk]
+
+
+def _context() -> Any:
+    """Get the safe start method context of the worker processes."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def get_pool(workers: int) -> Any:
+    """Get the shared pool with the given number of worker processes.
+
+    The pool is created on the first request and reused afterwards. It can be
+    requested in advance to start the workers before the training starts.
+
+    Arguments:
+        workers: Number of the worker processes.
+
+    Returns:
+        The ``multiprocessing`` pool.
+    """
+    with _POOLS_LOCK:
+        if workers not in _POOLS:
+            _POOLS[workers] = _context().Pool(workers)
+        return _POOLS[workers]
+
+
+@atexit.register
+def _terminate_pools() -> None:
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.terminate()
+        _POOLS.clear()
+
+
+def _dump_function(function: Callable) -> str:
+    """Pickle a function into a temporary file and return its path.
+
+    Raises an exception (of any type the pickling raises) if the function
+    cannot be pickled.
+    """
+    fd, path = tempfile.mkstemp(prefix="neuralmonkey-map-", suffix=".pkl")
+    try:
+        with os.fdopen(fd, "wb") as f_function:
+            pickle.dump(function, f_function)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def parallel_map(function: Callable, items: Iterable[Any], workers: int,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Any]:
+    """Apply a function on a stream of items in multiple processes.
+
+    The items are sent to the worker processes in chunks and the results are
+    yielded in the order of the items as soon as they are available. Only a
+    limited number of chunks is processed at once, so the items may come
+    from a stream which does not fit into the memory.
+
+    The function is pickled once per call and each worker process loads it
+    once, so it may carry large data. If the function cannot be pickled or
+    if only a single worker is requested, the function is applied in the
+    current process.
+
+    Arguments:
+        function: The function to apply.
+        items: The items to process. They and the results must be picklable.
+        workers: Number of the worker processes.
+        chunk_size: Number of items sent to a worker at once.
+
+    Returns:
+        Generator yielding the results of the function.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+
+    try:
+        path = _dump_function(function)
+    # pylint: disable=broad-except
+    except Exception:
+        warn("Preprocessor {} cannot be sent to worker processes, it is "
+             "applied in a single process.".format(function))
+        yield from map(function, items)
+        return
+
+    # a new token for every call, the paths of the files may be reused
+    token = uuid.uuid4().hex
+    iterator = iter(items)
+    chunks = iter(lambda: list(itertools.islice(iterator, chunk_size)), [])
+
+    try:
+        pool = get_pool(workers)
+        pending = collections.deque()  # type: Deque[Any]
+        for chunk in itertools.islice(chunks, 2 * workers):
+            pending.append(
+                pool.apply_async(_map_chunk, (token, path, chunk)))
+
+        while pending:
+            results = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(
+                    pool.apply_async(_map_chunk, (token, path, chunk)))
+            yield from results
+    finally:
+        os.remove(path)
@@ -0,0 +1,186 @@
+"""Compact in-memory storage of series of tokenized sentences.
+
+Storing a series as a list of lists of Python strings costs a pointer and a
+list entry for every token, which is prohibitive for large corpora,
+especially character-level ones. The ragged series stores the tokens interned
+in a table and the sentences as a flat array of token codes with the offsets
+of the individual sentences.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+import array
+import collections
+
+import numpy as np
+
+
+class TokenTable(object):
+    """Table of interned tokens which can be shared by several series."""
+
+    def __init__(self) -> None:
+        self.tokens = []  # type: List[str]
+        self.token_to_code = {}  # type: Dict[str, int]
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def code(self, token: str) -> int:
+        """Get the code of a token, adding it to the table if needed."""
+        code = self.token_to_code.get(token)
+        if code is None:
+            code = len(self.tokens)
+            self.token_to_code[token] = code
+            self.tokens.append(token)
+        return code
+
+
+class RaggedSeriesBuilder(object):
+    """Incremental construction of a ragged token series.
+
+    The sentences are appended one by one, so a series can be built from a
+    stream without holding the sentences as lists at any time.
+    """
+
+    def __init__(self, table: Optional[TokenTable] = None) -> None:
+        """Create an empty builder.
+
+        Arguments:
+            table: Table of interned tokens to use. If None, a new table is
+                created.
+        """
+        if table is None:
+            table = TokenTable()
+        self.table = table
+
+        # typed arrays avoid holding a Python integer for every token
+        self._codes = array.array("I")
+        self._offsets = array.array("q", [0])
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def append(self, sentence: Iterable[str]) -> None:
+        """Add a tokenized sentence to the end of the series."""
+        self._codes.extend(self.table.code(token) for token in sentence)
+        self._offsets.append(len(self._codes))
+
+    def build(self) -> "RaggedTokenSeries":
+        """Create the series from the appended sentences.
+
+        Returns:
+            The new series, whose codes use the smallest sufficient unsigned
+            integer type.
+        """
+        dtype = np.uint32
+        for candidate in [np.uint8, np.uint16]:
+            if len(self.table) <= np.iinfo(candidate).max + 1:
+                dtype = candidate
+                break
+
+        return RaggedTokenSeries(
+            self.table,
+            np.frombuffer(self._codes, dtype=np.uint32).astype(dtype),
+            np.frombuffer(self._offsets, dtype=np.int64).copy())
+
+
+class RaggedTokenSeries(collections.Sequence):
+    """Array-backed series of tokenized sentences.
+
+    The series behaves like a read-only sequence of lists of tokens. Slicing
+    the series with a unit step returns a series sharing the buffers with the
+    original one.
+    """
+
+    def __init__(self, table: TokenTable, codes: np.ndarray,
+                 offsets: np.ndarray) -> None:
+        """Create the series from its buffers.
+
+        Arguments:
+            table: The table of interned tokens.
+            codes: The flat array of token codes of all sentences.
+            offsets: Array of the positions in ``codes`` where the sentences
+                start, followed by the end of the last sentence.
+        """
+        self.table = table
+        self.codes = codes
+        self.offsets = offsets
+
+    @staticmethod
+    def from_sentences(sentences: Iterable[List[str]],
+                       table: Optional[TokenTable] = None
+                      ) -> "RaggedTokenSeries":
+        """Build the series from tokenized sentences.
+
+        Arguments:
+            sentences: The sentences as lists of tokens.
+            table: Table of interned tokens to use. If None, a new table is
+                created.
+
+        Returns:
+            The new series, whose codes use the smallest sufficient unsigned
+            integer type.
+        """
+        builder = RaggedSeriesBuilder(table)
+        for sentence in sentences:
+            builder.append(sentence)
+        return builder.build()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return RaggedTokenSeries(self.table, self.codes, offsets)
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Ragged series index out of range")
+
+        tokens = self.table.tokens
+        return [tokens[code] for code in self.codes[
+            self.offsets[index]:self.offsets[index + 1]].tolist()]
+
+    def __iter__(self) -> Iterator[List[str]]:
+        tokens = self.table.tokens
+        codes = self.codes
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield [tokens[code] for code in codes[start:end].tolist()]
+
+    def lengths(self) -> np.ndarray:
+        """Get the lengths of the sentences."""
+        return np.diff(self.offsets)
+
+    def take(self, indices: np.ndarray) -> "RaggedTokenSeries":
+        """Select sentences of the series into a new compact series.
+
+        Arguments:
+            indices: Indices of the selected sentences.
+
+        Returns:
+            A series with the selected sentences in the given order, sharing
+            the token table with this series.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[:-1][indices]
+        lengths = self.offsets[1:][indices] - starts
+
+        new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+
+        # position of every selected token in the original buffer
+        positions = (np.arange(new_offsets[-1], dtype=np.int64)
+                     - np.repeat(new_offsets[:-1] - starts, lengths))
+        return RaggedTokenSeries(self.table, self.codes[positions],
+                                 new_offsets)
+
+    @property
+    def nbytes(self) -> int:
+        """Get the size of the code and offset buffers in bytes."""
+        return self.codes.nbytes + self.offsets.nbytes
@@ -0,0 +1,260 @@
+"""Binary format of pre-tokenized corpora.
+
+A compiled corpus stores the sentences of a text series already encoded as
+indices to a vocabulary, so the text does not have to be split and looked up
+in the vocabulary every epoch. The file consists of a short header, an array
+of ``int64`` offsets of the sentences and a flat ``int32`` array of the token
+indices. The header stores the content hash of the vocabulary which was used
+for the encoding, so the corpus cannot be used with a different vocabulary by
+mistake.
+
+The corpus is memory-mapped when read and the reader yields the sentences as
+numpy arrays of token indices, which are fed to the model by
+``EmbeddedFactorSequence`` and ``Decoder`` without the vocabulary lookup.
+"""
+
+from typing import (Any, BinaryIO, Callable, Iterable, Iterator, List,
+                    Optional)
+import argparse
+import array
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from neuralmonkey.logging import log
+from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+from neuralmonkey.vocabulary import (Vocabulary, UNK_TOKEN_INDEX,
+                                     from_wordlist)
+
+MAGIC = b"NMCORPUS"
+FORMAT_VERSION = 1
+
+# magic, version, header length
+_PREFIX = struct.Struct("<8sII")
+_ALIGNMENT = 8
+
+# number of token indices held in memory during the compilation
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+class BinaryCorpus(object):
+    """A memory-mapped compiled corpus."""
+
+    def __init__(self, path: str) -> None:
+        """Open a compiled corpus.
+
+        Arguments:
+            path: The path to the compiled corpus file.
+        """
+        self.path = path
+
+        with open(path, "rb") as f_corpus:
+            magic, version, header_len = _PREFIX.unpack(
+                f_corpus.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(
+                    "File {} is not a compiled corpus.".format(path))
+            if version != FORMAT_VERSION:
+                raise ValueError(
+                    "Unsupported version {} of compiled corpus {}.".format(
+                        version, path))
+            header = json.loads(f_corpus.read(header_len).decode("utf-8"))
+
+        self.vocabulary_hash = header["vocabulary_hash"]
+        num_sentences = header["sentences"]
+        num_tokens = header["tokens"]
+
+        offsets_start = _aligned(_PREFIX.size + header_len)
+        ids_start = offsets_start + 8 * (num_sentences + 1)
+
+        self._offsets = np.memmap(path, dtype=np.int64, mode="r",
+                                  offset=offsets_start,
+                                  shape=(num_sentences + 1,))
+        if num_tokens:
+            self._ids = np.memmap(path, dtype=np.int32, mode="r",
+                                  offset=ids_start, shape=(num_tokens,))
+        else:
+            self._ids = np.zeros([0], dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """Get the token indices of a sentence as a view to the file."""
+        return self._ids[self._offsets[index]:self._offsets[index + 1]]
+
+    def read_range(self, start: int = 0,
+                   count: Optional[int] = None) -> Iterator[np.ndarray]:
+        """Iterate over a range of sentences of the corpus.
+
+        Arguments:
+            start: The index of the first sentence.
+            count: Maximum number of sentences to read. If None, the corpus is
+                read until its end.
+        """
+        stop = len(self) if count is None else min(len(self), start + count)
+        for index in range(start, stop):
+            yield self[index]
+
+
+# pylint: disable=too-many-locals
+def compile_corpus(paths: List[str], output: str, vocabulary: Vocabulary,
+                   reader: Callable[[List[str]], Iterable[List[str]]] =
+                   UtfPlainTextReader,
+                   preprocessor: Optional[Callable[[Any], List[str]]] = None,
+                   buffer_size: int = WRITE_BUFFER_SIZE) -> int:
+    """Encode a text series into a compiled corpus.
+
+    The sentences are encoded while they are read and the token indices and
+    the offsets are written out in blocks, so the memory needed does not
+    depend on the size of the corpus. Because the offsets precede the token
+    indices in the corpus, they are collected in temporary files next to
+    the output first.
+
+    Arguments:
+        paths: The files of the series.
+        output: The path of the compiled corpus.
+        vocabulary: The vocabulary used to encode the tokens. Tokens which are
+            not in the vocabulary are encoded as the unknown token.
+        reader: The reader of the series.
+        preprocessor: Optional preprocessor applied to the sentences before
+            they are encoded.
+        buffer_size: Number of token indices (and offsets) kept in memory
+            before they are written to the temporary files.
+
+    Returns:
+        The number of sentences in the corpus.
+    """
+    word_to_index = vocabulary.word_to_index
+    directory = os.path.dirname(os.path.abspath(output))
+    num_sentences = 0
+    num_tokens = 0
+
+    with tempfile.TemporaryFile(dir=directory) as f_offsets, \
+            tempfile.TemporaryFile(dir=directory) as f_ids:
+        offsets = array.array("q", [0])
+        ids = array.array("i")
+
+        for sentence in reader(paths):
+            if preprocessor is not None:
+                sentence = preprocessor(sentence)
+            ids.extend(word_to_index.get(word, UNK_TOKEN_INDEX)
+                       for word in sentence)
+            num_tokens += len(sentence)
+            num_sentences += 1
+            offsets.append(num_tokens)
+
+            if len(ids) >= buffer_size or len(offsets) >= buffer_size:
+                _flush(offsets, f_offsets)
+                _flush(ids, f_ids)
+
+        _flush(offsets, f_offsets)
+        _flush(ids, f_ids)
+
+        header = json.dumps({"vocabulary_hash": vocabulary.content_hash(),
+                             "sentences": num_sentences,
+                             "tokens": num_tokens}).encode("utf-8")
+
+        with open(output, "wb") as f_out:
+            f_out.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f_out.write(header)
+            f_out.write(b"\x00" * (_aligned(f_out.tell()) - f_out.tell()))
+            for f_tmp in [f_offsets, f_ids]:
+                f_tmp.seek(0)
+                shutil.copyfileobj(f_tmp, f_out)
+
+    log("Compiled corpus {} with {} sentences and {} tokens".format(
+        output, num_sentences, num_tokens))
+    return num_sentences
+# pylint: enable=too-many-locals
+
+
+def _flush(buffer: array.array, f_out: BinaryIO) -> None:
+    """Write out the items of a typed array and empty it."""
+    buffer.tofile(f_out)
+    del buffer[:]
+
+
+def get_binary_corpus_reader(vocabulary: Vocabulary) -> Callable:
+    """Get reader of compiled corpora.
+
+    The reader checks that the corpora were compiled with the given
+    vocabulary and yields the sentences as arrays of token indices. It
+    provides the ``read_range`` and ``count_items`` functions, so lazy
+    datasets can read the corpora from arbitrary positions.
+
+    Arguments:
+        vocabulary: The vocabulary the corpora were encoded with.
+    """
+    vocabulary_hash = vocabulary.content_hash()
+
+    def open_corpus(path: str) -> BinaryCorpus:
+        corpus = BinaryCorpus(path)
+        if corpus.vocabulary_hash != vocabulary_hash:
+            raise ValueError(
+                "Corpus {} was compiled with a different vocabulary."
+                .format(path))
+        return corpus
+
+    def reader(files: List[str]) -> Iterable[np.ndarray]:
+        for path in files:
+            yield from open_corpus(path).read_range()
+
+    def read_range(files: List[str], start: int = 0,
+                   count: Optional[int] = None) -> Iterable[np.ndarray]:
+        for path in files:
+            if count is not None and count <= 0:
+                return
+
+            corpus = open_corpus(path)
+            if start >= len(corpus):
+                start -= len(corpus)
+                continue
+
+            yield from corpus.read_range(start, count)
+
+            if count is not None:
+                count -= len(corpus) - start
+            start = 0
+
+    def count_items(files: List[str]) -> int:
+        return sum(len(open_corpus(path)) for path in files)
+
+    reader.read_range = read_range  # type: ignore
+    reader.count_items = count_items  # type: ignore
+    return reader
+
+
+def _aligned(position: int) -> int:
+    return -(-position // _ALIGNMENT) * _ALIGNMENT
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compile tokenized text into a binary corpus of "
+        "vocabulary indices.")
+    parser.add_argument("inputs", metavar="INPUT", nargs="+",
+                        help="tokenized text files (possibly gzipped), "
+                        "concatenated into a single corpus")
+    parser.add_argument("-o", "--output", required=True,
+                        help="the compiled corpus file")
+    parser.add_argument("-v", "--vocabulary", required=True,
+                        help="the wordlist of the vocabulary")
+    parser.add_argument("--no-header", action="store_true",
+                        help="the wordlist does not have a header")
+    parser.add_argument("--no-frequencies", action="store_true",
+                        help="the wordlist does not contain frequencies")
+    args = parser.parse_args()
+
+    vocabulary = from_wordlist(args.vocabulary,
+                               contains_header=not args.no_header,
+                               contains_frequencies=not args.no_frequencies)
+    compile_corpus(args.inputs, args.output, vocabulary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Persistent index of line offsets for random access into text files.
+
+The index stores the position of every ``stride``-th line of a file, so that
+reading can start at an arbitrary line after skipping less than ``stride``
+lines. The index is saved to a sidecar file next to the indexed file and is
+rebuilt whenever the size or the modification time of the file changes.
+
+Gzipped files are indexed by blocks: every position is a pair of the
+compressed offset of the gzip member in which the line starts and the
+uncompressed offset of the line within the member. For files consisting of
+many gzip members (e.g. created by ``bgzip`` or by concatenating gzipped
+shards), seeking is as fast as for plain files. A file compressed as a single
+member has to be decompressed from its beginning, but the lines are still not
+split nor parsed.
+"""
+
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+import gzip
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+from neuralmonkey.logging import log, warn
+
+INDEX_SUFFIX = ".lineidx.npz"
+INDEX_VERSION = 1
+DEFAULT_STRIDE = 64
+
+_READ_BLOCK_SIZE = 1 << 20
+
+# indices that were already loaded in this process
+_LOADED_INDICES = {}  # type: Dict[Tuple[str, int], LineIndex]
+
+
+class LineIndex(object):
+    """Index of line offsets of a single (possibly gzipped) text file."""
+
+    def __init__(self, path: str, stride: int = DEFAULT_STRIDE) -> None:
+        """Load the index of the file or build it if it is not valid.
+
+        Arguments:
+            path: The indexed file.
+            stride: Every ``stride``-th line position is stored.
+        """
+        if stride < 1:
+            raise ValueError("Index stride must be a positive integer.")
+
+        self.path = path
+        self.stride = stride
+        self.compressed = path.endswith(".gz")
+        self._signature = _file_signature(path)
+
+        if not self._load():
+            self._build()
+            self._save()
+
+    @property
+    def index_path(self) -> str:
+        return self.path + INDEX_SUFFIX
+
+    def is_valid(self) -> bool:
+        """Check whether the indexed file has not changed."""
+        return _file_signature(self.path) == self._signature
+
+    def __len__(self) -> int:
+        """Get the number of lines of the indexed file."""
+        return self.num_lines
+
+    def _load(self) -> bool:
+        if not os.path.isfile(self.index_path):
+            return False
+
+        try:
+            with np.load(self.index_path) as index_data:
+                meta = [int(x) for x in index_data["meta"]]
+                members = index_data["members"]
+                offsets = index_data["offsets"]
+        # pylint: disable=broad-except
+        except Exception as exc:
+            warn("Cannot read line index {}: {}".format(self.index_path, exc))
+            return False
+
+        version, size, mtime, num_lines, stride = meta
+        if (version != INDEX_VERSION or stride != self.stride
+                or (size, mtime) != self._signature):
+            return False
+
+        self.num_lines = num_lines
+        self._members = members
+        self._offsets = offsets
+        return True
+
+    def _save(self) -> None:
+        size, mtime = self._signature
+        meta = np.array([INDEX_VERSION, size, mtime, self.num_lines,
+                         self.stride], dtype=np.int64)
+        # concurrent processes may save the same index, it is written to a
+        # temporary file and replaced at once
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.index_path) + ".",
+                dir=os.path.dirname(os.path.abspath(self.index_path)))
+        except OSError as exc:
+            warn("Cannot save line index {}: {}".format(self.index_path, exc))
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f_index:
+                np.savez(f_index, meta=meta, members=self._members,
+                         offsets=self._offsets)
+            os.replace(tmp_path, self.index_path)
+        except OSError as exc:
+            os.remove(tmp_path)
+            warn("Cannot save line index {}: {}".format(self.index_path, exc))
+
+    def _build(self) -> None:
+        log("Building line index of {}".format(self.path))
+        members = []  # type: List[int]
+        offsets = []  # type: List[int]
+        num_lines = 0
+        at_line_start = True
+
+        for member, inner_offset, data in _iterate_blocks(
+                self.path, self.compressed):
+            position = 0
+            while position < len(data):
+                if at_line_start:
+                    if num_lines % self.stride == 0:
+                        members.append(member)
+                        offsets.append(inner_offset + position)
+                    num_lines += 1
+                    at_line_start = False
+
+                newline = data.find(b"\n", position)
+                if newline == -1:
+                    break
+                position = newline + 1
+                at_line_start = True
+
+        self.num_lines = num_lines
+        self._members = np.array(members, dtype=np.int64)
+        self._offsets = np.array(offsets, dtype=np.int64)
+
+    def iterate_lines(self, start: int = 0,
+                      count: Optional[int] = None) -> Iterator[bytes]:
+        """Iterate over the lines of the file starting at the given line.
+
+        Arguments:
+            start: The index of the first line to read.
+            count: Maximum number of lines to read. If None, the file is read
+                until its end.
+
+        Returns:
+            Generator yielding the lines as bytes.
+        """
+        if start >= self.num_lines or count == 0:
+            return
+
+        checkpoint = start // self.stride
+        member = int(self._members[checkpoint])
+        offset = int(self._offsets[checkpoint])
+
+        with open(self.path, "rb") as f_raw:
+            if self.compressed:
+                f_raw.seek(member)
+                f_data = gzip.GzipFile(
+                    fileobj=f_raw, mode="rb")  # type: BinaryIO
+                f_data.seek(offset)
+            else:
+                f_raw.seek(offset)
+                f_data = f_raw
+
+            for _ in range(start - checkpoint * self.stride):
+                f_data.readline()
+
+            read = 0
+            for line in f_data:
+                yield line
+                read += 1
+                if count is not None and read >= count:
+                    break
+
+
+def get_line_index(path: str, stride: int = DEFAULT_STRIDE) -> LineIndex:
+    """Get the line index of a file, reusing the already loaded ones.
+
+    Arguments:
+        path: The indexed file.
+        stride: Every ``stride``-th line position is stored.
+
+    Returns:
+        A valid line index of the file.
+    """
+    key = (os.path.abspath(path), stride)
+    index = _LOADED_INDICES.get(key)
+
+    if index is None or not index.is_valid():
+        index = LineIndex(path, stride)
+        _LOADED_INDICES[key] = index
+
+    return index
+
+
+def iterate_lines(paths: List[str], start: int = 0,
+                  count: Optional[int] = None) -> Iterator[bytes]:
+    """Iterate over lines of a concatenation of files.
+
+    Arguments:
+        paths: The files to read.
+        start: The index of the first line to read counted over all files.
+        count: Maximum number of lines to read. If None, the files are read
+            until their end.
+
+    Returns:
+        Generator yielding the lines as bytes.
+    """
+    for path in paths:
+        if count is not None and count <= 0:
+            return
+
+        index = get_line_index(path)
+        if start >= len(index):
+            start -= len(index)
+            continue
+
+        to_read = None if count is None else min(count, len(index) - start)
+        yield from index.iterate_lines(start, to_read)
+
+        if count is not None:
+            count -= len(index) - start
+        start = 0
+
+
+def count_lines(paths: List[str]) -> int:
+    """Count the lines of the files using their indices."""
+    return sum(len(get_line_index(path)) for path in paths)
+
+
+def _file_signature(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _iterate_blocks(path: str,
+                    compressed: bool) -> Iterator[Tuple[int, int, bytes]]:
+    """Read the (decompressed) content of a file by blocks.
+
+    Returns:
+        Generator of tuples of the compressed offset of the gzip member the
+        block belongs to (zero for uncompressed files), the uncompressed
+        offset of the block within the member, and the block data.
+    """
+    with open(path, "rb") as f_raw:
+        if not compressed:
+            offset = 0
+            for data in iter(lambda: f_raw.read(_READ_BLOCK_SIZE), b""):
+                yield 0, offset, data
+                offset += len(data)
+            return
+
+        member = 0
+        consumed = 0
+        inner_offset = 0
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+        for chunk in iter(lambda: f_raw.read(_READ_BLOCK_SIZE), b""):
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield member, inner_offset, data
+                    inner_offset += len(data)
+
+                if not decompressor.eof:
+                    consumed += len(chunk)
+                    break
+
+                # the member has ended, the next one starts in the rest
+                consumed += len(chunk) - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+                member = consumed
+                inner_offset = 0
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+                if chunk and not chunk.strip(b"\x00"):
+                    # trailing zero padding
+                    return
@@ -3,7 +3,16 @@ import gzip
 
 
 def get_plain_text_reader(encoding: str = "utf-8"):
-    """Get reader for space-separated tokenized text."""
+    """Get reader for space-separated tokenized text.
+
+    The reader has the ``parse_line`` attribute which parses a single line
+    given as bytes. This allows reading the files from arbitrary offsets.
+    Lines are split only on ``\\n`` (a lone ``\\r`` stays in the line), the
+    same way as the line index of the files splits them.
+    """
+    def parse_line(line: bytes) -> List[str]:
+        return str(line, encoding).strip().split(" ")
+
     def reader(files: List[str]) -> Iterable[List[str]]:
         for path in files:
 
@@ -12,10 +21,11 @@ def get_plain_text_reader(encoding: str = "utf-8"):
                     for line in f_data:
                         yield str(line, 'utf-8').strip().split(" ")
             else:
-                with open(path, encoding=encoding) as f_data:
+                with open(path, encoding=encoding, newline="\n") as f_data:
                     for line in f_data:
                         yield line.strip().split(" ")
 
+    reader.parse_line = parse_line  # type: ignore
     return reader
 
 
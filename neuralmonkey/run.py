@@ -33,6 +33,7 @@ CONFIG.ignore_argument('minimize')
 CONFIG.ignore_argument('random_seed')
 CONFIG.ignore_argument('save_n_best')
 CONFIG.ignore_argument('overwrite_output_dir')
+CONFIG.ignore_argument('batching_scheme')
 
 
 def default_variable_file(output_dir):
@@ -146,3 +147,5 @@ def main() -> None:
                                  execution_results, output_data)
         if eval_result:
             print_final_evaluation(dataset.name, eval_result)
+
+    CONFIG.model.tf_manager.close()
@@ -3,19 +3,20 @@ from typing import Callable, List, Dict, Optional
 import numpy as np
 from typeguard import check_argument_types
 
+from neuralmonkey.logging import warn
 from neuralmonkey.model.model_part import ModelPart
 from neuralmonkey.decoders.beam_search_decoder import (BeamSearchDecoder,
                                                        SearchStepOutput)
 from neuralmonkey.runners.base_runner import (BaseRunner, Executable,
                                               ExecutionResult, NextExecute)
-from neuralmonkey.vocabulary import Vocabulary, END_TOKEN
+from neuralmonkey.vocabulary import Vocabulary
 
 
 class BeamSearchExecutable(Executable):
     def __init__(self,
                  rank: int,
                  all_encoders: List[ModelPart],
-                 bs_outputs: List[SearchStepOutput],
+                 bs_outputs: SearchStepOutput,
                  vocabulary: Vocabulary,
                  postprocess: Optional[Callable]) -> None:
 
@@ -34,36 +35,35 @@ class BeamSearchExecutable(Executable):
         if len(results) > 1:
             raise ValueError("Beam search runner does not support ensembling.")
 
+        # shape of each output = time x beam x batch
         evaluated_bs = results[0]['bs_outputs']
 
-        # pick the end of the hypothesis based on its rank
-        hyp_index = np.argpartition(
-            -evaluated_bs[-1].scores, self._rank - 1)[self._rank - 1]
-        bs_score = evaluated_bs[-1].scores[hyp_index]
-
-        # now backtrack
-        output_tokens = []  # type: List[str]
-        for output in reversed(evaluated_bs):
-            token_id = output.token_ids[hyp_index]
-            token = self._vocabulary.index_to_word[token_id]
-            output_tokens.append(token)
-            hyp_index = output.parent_ids[hyp_index]
-        output_tokens.reverse()
-
-        before_eos_tokens = []  # type: List[str]
-        for tok in output_tokens:
-            if tok == END_TOKEN:
-                break
-            before_eos_tokens.append(tok)
+        last_scores = evaluated_bs.scores[-1]
+        batch_range = np.arange(last_scores.shape[1])
+
+        # pick the ends of the hypotheses based on their rank
+        hyp_indices = np.argpartition(
+            -last_scores, self._rank - 1, axis=0)[self._rank - 1]
+        bs_scores = last_scores[hyp_indices, batch_range]
+
+        # now backtrack all sentences at once
+        token_ids = []  # type: List[np.ndarray]
+        for step in reversed(range(len(evaluated_bs.token_ids))):
+            token_ids.append(
+                evaluated_bs.token_ids[step, hyp_indices, batch_range])
+            hyp_indices = evaluated_bs.parent_ids[
+                step, hyp_indices, batch_range]
+        token_ids.reverse()
+
+        # the tokens are cut before the end symbol
+        decoded_tokens = self._vocabulary.vectors_to_sentences(token_ids)
 
         if self._postprocess is not None:
-            decoded_tokens = self._postprocess([before_eos_tokens])
-        else:
-            decoded_tokens = [before_eos_tokens]
+            decoded_tokens = self._postprocess(decoded_tokens)
 
         self.result = ExecutionResult(
             outputs=decoded_tokens,
-            losses=[bs_score],
+            losses=[float(np.sum(bs_scores))],
             scalar_summaries=None,
             histogram_summaries=None,
             image_summaries=None)
@@ -83,6 +83,11 @@ class BeamSearchRunner(BaseRunner):
                 ("Rank of output hypothesis must be between 1 and the beam "
                  "size ({}), was {}.").format(decoder.beam_size, rank))
 
+        if rank > decoder.early_stop_rank:
+            warn("The beam search may stop before the hypotheses of rank {} "
+                 "are final, set early_stop_rank of the decoder to get the "
+                 "same hypotheses as from the full search.".format(rank))
+
         self._rank = rank
         self._postprocess = postprocess
 
@@ -7,174 +7,96 @@ model ensembling and beam search.
 
 The TensorFlow session is invoked for every single output of the decoder
 separately which allows ensembling from all sessions and do the beam pruning
-before the a next output is emmited.
+before the a next output is emmited. Every session run advances the decoding
+by a single step: the RNN states and attention contexts of the hypotheses are
+fetched and fed back in the next step together with the outputs of the
+encoders, which are computed only once for a batch.
 """
 
 
-from typing import Dict, List, Callable, NamedTuple, Tuple
+from typing import Dict, List, Callable, Optional
 import numpy as np
 import tensorflow as tf
 
 from neuralmonkey.runners.base_runner import (BaseRunner, Executable,
-                                              ExecutionResult, NextExecute)
-from neuralmonkey.vocabulary import END_TOKEN_INDEX
+                                              ExecutionResult, FeedDict,
+                                              NextExecute)
+from neuralmonkey.vocabulary import END_TOKEN_INDEX, PAD_TOKEN_INDEX
 
 
 # pylint: disable=invalid-name
-BeamBatch = NamedTuple('BeamBatch',
-                       [('decoded', np.ndarray),
-                        ('logprobs', np.ndarray)])
-ExpandedBeamBatch = NamedTuple('ExpandedBeamBatch',
-                               [('beam_batch', BeamBatch),
-                                ('next_logprobs', np.ndarray)])
+# Scores the hypotheses given the sums of their log-probabilities and their
+# lengths (including the end symbol). Both are arrays of the same shape.
 ScoringFunction = Callable[[np.ndarray, np.ndarray], np.ndarray]
+# pylint: enable=invalid-name
 
-# pylint: disable=too-many-locals
-
-
-def _n_best_indices(scores: np.ndarray, n: int) -> np.ndarray:
-    if scores.shape[0] <= n:
-        unsorted_n_best_indices = np.arange(scores.shape[0])
-    else:
-        unsorted_n_best_indices = np.argpartition(-scores, n)[:n]
-    n_best_indices = unsorted_n_best_indices[
-        np.argsort(scores[unsorted_n_best_indices])]
-    return n_best_indices
 
+def likelihood_beam_score(logprob_sums: np.ndarray,
+                          lengths: np.ndarray) -> np.ndarray:
+    """Score the beam by normalized probaility."""
+    return logprob_sums - np.log(lengths)
 
-def _score_expanded(n: int,
-                    batch_size: int,
-                    expanded: List[ExpandedBeamBatch],
-                    scoring_function: ScoringFunction) -> \
-        Tuple[List[np.ndarray], List[np.ndarray]]:
-    """Score expanded beams.
 
-    After all hypotheses have their possible continuations, we need to score
-    the expanded hypotheses. We collect all possible conitnuations (typically
-    `n`-times size of the voabulary), score them using `scoring_function` and
-    keep only `n` with the highest scores.
+def n_best(n: int, scores: np.ndarray) -> np.ndarray:
+    """Get the indices of the n best scores in every row.
 
     Args:
-        n: Number of best hypotheses.
-        batch_size: Number hypothese in the batch.
-        expanded: List of expanded hypotheses from the previous beam, organized
-            into batches.
-        scoring_function: A function that scores the expanded hypotheses based
-            on the hypotheses and individual words' log-probs.
+        n: Number of the best scores. If a row is shorter, all its items are
+            selected.
+        scores: Matrix of the scores.
 
     Returns:
-        Hypotheses indices and logprobs for the next decoding step.
+        Matrix with the column indices of the best scores in every row,
+        ordered from the best one.
     """
-    next_beam_hypotheses = []
-    next_beam_logprobs = []
-    # agregate the expanded hypotheses hypothesis-wise
-    for rank in range(batch_size):
-        candidate_scores = None
-        candidate_hypotheses = None
-        candidate_logprobs = None
-
-        for expanded_batch in expanded:
-            next_distribution = expanded_batch.next_logprobs[rank]
-            if expanded_batch.beam_batch is None:
-                expanded_hypotheses = np.expand_dims(np.arange(
-                    len(next_distribution)), axis=1)
-                expanded_logprobs = np.expand_dims(next_distribution, 1)
-            else:
-                hypothesis = expanded_batch.beam_batch.decoded[rank]
-                prev_logprobs = expanded_batch.beam_batch.logprobs[rank]
-
-                expanded_hypotheses = np.array(
-                    [np.append(hypothesis, index)
-                     for index, _ in enumerate(next_distribution)])
-                expanded_logprobs = np.array(
-                    [np.append(prev_logprobs, logprob)
-                     for logprob in next_distribution])
-
-            assert expanded_hypotheses.shape == expanded_logprobs.shape
-            scores = scoring_function(expanded_hypotheses, expanded_logprobs)
-            assert scores.shape[0] == expanded_hypotheses.shape[0]
-            n_best_indices = _n_best_indices(scores, n)
-            candidate_scores = _try_append(
-                candidate_scores, scores[n_best_indices])
-            candidate_hypotheses = _try_append(
-                candidate_hypotheses, expanded_hypotheses[n_best_indices])
-            candidate_logprobs = _try_append(
-                candidate_logprobs, expanded_logprobs[n_best_indices])
-            assert len(candidate_hypotheses.shape) == 2
-
-        n_best_indices = _n_best_indices(candidate_scores, n)
-        n_best_hypotheses = candidate_hypotheses[n_best_indices]
-        n_best_logprobs = candidate_logprobs[n_best_indices]
-
-        assert len(n_best_hypotheses.shape) == 2
-        assert n_best_hypotheses.shape == n_best_logprobs.shape
-        next_beam_hypotheses.append(n_best_hypotheses)
-        next_beam_logprobs.append(n_best_logprobs)
-    return next_beam_hypotheses, next_beam_logprobs
-
-
-def _try_append(first, second):
-    if first is None:
-        return second
-
-    return np.append(first, second, axis=0)
-
-
-def likelihood_beam_score(decoded, logprobs):
-    """Score the beam by normalized probaility."""
+    n = min(n, scores.shape[1])
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
 
-    mask = []
-    for hypothesis in decoded:
-        before_end = True
-        hyp_mask = []
-        for index in hypothesis:
-            hyp_mask.append(float(before_end))
-            before_end &= (index != END_TOKEN_INDEX)
-        mask.append(hyp_mask)
-
-    mask_matrix = np.array(mask)
-    masked_logprobs = mask_matrix * logprobs
-    # pylint: disable=no-member
-    avg_logprobs = masked_logprobs.sum(
-        axis=1) - np.log(mask_matrix.sum(axis=1))
-    return avg_logprobs
-
-
-def n_best(n: int,
-           expanded: List[ExpandedBeamBatch],
-           scoring_function) -> List[BeamBatch]:
-    """Take n-best from expanded beam search hypotheses.
-
-    To do the scoring we need to "reshape" the hypohteses. Before the scoring
-    the hypothesis are split into beam batches by their position in the beam.
-    To do the scoring, however, they need to be organized by the instances.
-    After the scoring, only _n_ hypotheses is kept for each isntance. These
-    are again split by their position in the beam.
+    if n < scores.shape[1]:
+        indices = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    else:
+        indices = np.tile(np.arange(n), [scores.shape[0], 1])
+
+    order = np.argsort(-scores[rows, indices], axis=1, kind="mergesort")
+    return indices[rows, order]
+
+
+def expand_hypotheses(logprob_sums: np.ndarray,
+                      lengths: np.ndarray,
+                      finished: np.ndarray,
+                      next_logprobs: np.ndarray,
+                      scoring_function: ScoringFunction) -> np.ndarray:
+    """Score all continuations of the hypotheses.
+
+    The finished hypotheses can only be continued by the padding symbol,
+    which does not change their log-probability or length.
 
     Args:
-        n: Beam size.
-        expanded: List of batched expanded hypotheses.
-        scoring_function: A function
+        logprob_sums: Sums of the log-probabilities of the hypotheses of
+            shape batch x beam.
+        lengths: Lengths of the hypotheses of shape batch x beam.
+        finished: Flags whether the hypotheses have ended of shape
+            batch x beam.
+        next_logprobs: Log-probabilities of the next words of shape
+            batch x beam x vocabulary.
+        scoring_function: A function that scores the expanded hypotheses.
 
     Returns:
-        List of BeamBatches ready for new expansion.
-
+        The scores of the continuations of shape batch x beam x vocabulary.
     """
+    unfinished = np.logical_not(finished)[:, :, np.newaxis]
 
-    batch_size = expanded[0].next_logprobs.shape[0]
-    next_beam_hypotheses, next_beam_logprobs = _score_expanded(
-        n, batch_size, expanded, scoring_function)
+    expanded_sums = (logprob_sums[:, :, np.newaxis]
+                     + np.where(unfinished, next_logprobs, 0.))
+    expanded_lengths = np.broadcast_to(
+        lengths[:, :, np.newaxis] + unfinished, expanded_sums.shape)
 
-    # now cut the beams by hypotheses rank
-    beam_batches = []
-    for rank in range(n):
-        hypotheses = np.array([beam[rank] for beam in next_beam_hypotheses])
-        logprobs = np.array([beam[rank] for beam in next_beam_logprobs])
-        assert len(hypotheses.shape) == 2
-        assert hypotheses.shape == logprobs.shape
-        beam_batches.append(BeamBatch(hypotheses, logprobs))
+    scores = scoring_function(expanded_sums, expanded_lengths)
+    assert scores.shape == expanded_sums.shape
 
-    return beam_batches
+    not_padding = np.arange(next_logprobs.shape[2]) != PAD_TOKEN_INDEX
+    return np.where(np.logical_and(finished[:, :, np.newaxis], not_padding),
+                    -np.inf, scores)
 
 
 class RuntimeRnnRunner(BaseRunner):
@@ -187,9 +109,11 @@ class RuntimeRnnRunner(BaseRunner):
                 ) -> None:
         super(RuntimeRnnRunner, self).__init__(output_series, decoder)
 
-        self._initial_fetches = [decoder.runtime_rnn_states[0]]
-        self._initial_fetches += [e.encoded for e in self.all_coders
-                                  if hasattr(e, 'encoded')]
+        if decoder.step_logprobs is None:
+            raise ValueError(
+                "The decoder cannot be run step by step, the runtime RNN "
+                "runner does not support coverage attention.")
+
         self._beam_size = beam_size
         self._beam_scoring_f = beam_scoring_f
         self._postprocess = postprocess
@@ -197,7 +121,6 @@ class RuntimeRnnRunner(BaseRunner):
     def get_executable(self, compute_losses=False, summaries=True):
 
         return RuntimeRnnExecutable(self.all_coders, self._decoder,
-                                    self._initial_fetches,
                                     self._decoder.vocabulary,
                                     beam_size=self._beam_size,
                                     beam_scoring_f=self._beam_scoring_f,
@@ -211,67 +134,87 @@ class RuntimeRnnRunner(BaseRunner):
 
 # pylint: disable=too-many-instance-attributes
 class RuntimeRnnExecutable(Executable):
-    """Run and ensemble the RNN decoder step by step."""
+    """Run and ensemble the RNN decoder step by step.
+
+    All hypotheses of the batch are decoded in a single session run. Their
+    states are ordered by the beam and then by the batch, the other arrays
+    are of shape batch x beam.
+    """
 
     # pylint: disable=too-many-arguments
-    def __init__(self, all_coders, decoder, initial_fetches, vocabulary,
+    def __init__(self, all_coders, decoder, vocabulary,
                  beam_scoring_f, postprocess, beam_size=1,
                  compute_loss=True):
         self._all_coders = all_coders
         self._decoder = decoder
         self._vocabulary = vocabulary
-        self._initial_fetches = initial_fetches
         self._compute_loss = compute_loss
         self._beam_size = beam_size
         self._beam_scoring_f = beam_scoring_f
         self._postprocess = postprocess
 
-        self._to_exapand = [None]  # type: List[Option[BeamBatch]]
-        self._current_beam_batch = None
-        self._expanded = []  # type: List[ExpandedBeamBatch]
         self._time_step = 0
+        self._loss = 0.
+
+        # the hypotheses, empty until the first step is run
+        self._logprob_sums = np.zeros([0, 1])
+        self._lengths = np.zeros([0, 1], dtype=np.int32)
+        self._finished = np.zeros([0, 1], dtype=bool)
+        self._scores = np.zeros([0, 1])
+
+        # decoded words and back-pointers to the previous hypotheses
+        self._token_ids = []  # type: List[np.ndarray]
+        self._parent_ids = []  # type: List[np.ndarray]
+
+        # RNN states, attention contexts and batch constants of the decoder
+        # step in each session
+        self._states = []  # type: List[List[np.ndarray]]
+        self._batch_constants = []  # type: List[Dict[tf.Tensor, np.ndarray]]
 
-        self.result = None  # type: Option[ExecutionResult]
+        self.result = None  # type: Optional[ExecutionResult]
 
     def next_to_execute(self) -> NextExecute:
         """Get the feedables and tensors to run.
 
-        It takes a beam batch that should be expanded the next and preprare an
-        additional feed_dict based on the hypotheses history.
+        In the first step, the decoder starts from its initial state and the
+        batch constants are computed. In the following steps, the additional
+        feed dictionaries for all the sessions continue the decoding of all
+        the hypotheses from their last states.
         """
 
         if self.result is not None:
             raise Exception(
                 "Nothing to execute, if there is already a result.")
 
-        to_run = {'logprobs': self._decoder.train_logprobs[self._time_step]}
+        to_run = {'logprobs': self._decoder.step_logprobs,
+                  'states': (self._decoder.step_states
+                             + self._decoder.step_attns)}
 
-        self._current_beam_batch = self._to_exapand.pop()
-
-        if self._current_beam_batch is not None:
-            batch_size, output_len = self._current_beam_batch.decoded.shape
-            fed_value = np.zeros([self._decoder.max_output_len, batch_size])
-            fed_value[:output_len, :] = self._current_beam_batch.decoded.T
+        if self._time_step == 0:
+            to_run['constants'] = self._decoder.step_batch_constants
+            if self._compute_loss:
+                to_run['xent'] = self._decoder.train_loss
+            return self._all_coders, to_run, {}
 
-            additional_feed_dict = {self._decoder.train_inputs: fed_value}
-        else:
-            additional_feed_dict = {}
+        step_inputs = (self._decoder.step_prev_states
+                       + self._decoder.step_prev_attns)
+        last_words = self._token_ids[-1].T.reshape(-1)
 
-        # at the end, we should compute loss
-        if self._time_step == self._decoder.max_output_len - 1:
-            if self._compute_loss:
-                to_run["xent"] = self._decoder.train_loss
-            else:
-                to_run["xent"] = tf.zeros([])
+        additional_feed_dicts = []  # type: List[FeedDict]
+        for states, constants in zip(self._states, self._batch_constants):
+            session_feed_dict = dict(constants)
+            session_feed_dict.update(zip(step_inputs, states))
+            session_feed_dict[self._decoder.step_input_ids] = last_words
+            additional_feed_dicts.append(session_feed_dict)
 
-        return self._all_coders, to_run, additional_feed_dict
+        return self._all_coders, to_run, additional_feed_dicts
 
     def collect_results(self, results: List[Dict]) -> None:
         """Process what the TF session returned.
 
         Only a single time step is always processed at once. First,
-        distributions from all sessions are aggregated.
-
+        distributions from all sessions are aggregated. Then the best
+        continuations of the hypotheses of every sentence are selected.
         """
 
         summed_logprobs = -np.inf
@@ -280,28 +223,83 @@ class RuntimeRnnExecutable(Executable):
                                            sess_result["logprobs"])
         avg_logprobs = summed_logprobs - np.log(len(results))
 
-        expanded_batch = ExpandedBeamBatch(self._current_beam_batch,
-                                           avg_logprobs)
-        self._expanded.append(expanded_batch)
-
-        if not self._to_exapand:
-            self._time_step += 1
-            self._to_exapand = n_best(
-                self._beam_size, self._expanded, self._beam_scoring_f)
-            self._expanded = []
-
-        if self._time_step == self._decoder.max_output_len:
-            top_batch = self._to_exapand[-1].decoded.T
-            decoded_tokens = self._vocabulary.vectors_to_sentences(top_batch)
-
-            if self._postprocess is not None:
-                decoded_tokens = self._postprocess(decoded_tokens)
-
-            loss = np.mean([res["xent"] for res in results])
-            self.result = ExecutionResult(
-                outputs=decoded_tokens,
-                losses=[loss],
-                scalar_summaries=None,
-                histogram_summaries=None,
-                image_summaries=None
-            )
+        if self._time_step == 0:
+            self._start(results, avg_logprobs.shape[0])
+            if self._compute_loss:
+                self._loss = np.mean([res["xent"] for res in results])
+
+        batch_size, beam = self._logprob_sums.shape
+        vocabulary_size = avg_logprobs.shape[1]
+
+        # shape(next_logprobs) = batch x beam x vocabulary
+        next_logprobs = avg_logprobs.reshape(
+            [beam, batch_size, vocabulary_size]).transpose([1, 0, 2])
+        scores = expand_hypotheses(
+            self._logprob_sums, self._lengths, self._finished,
+            next_logprobs, self._beam_scoring_f).reshape([batch_size, -1])
+
+        # shape(all) = batch x new beam
+        best = n_best(self._beam_size, scores)
+        batch_range = np.arange(batch_size)[:, np.newaxis]
+        parent_ids = best // vocabulary_size
+        token_ids = best % vocabulary_size
+
+        self._scores = scores[batch_range, best]
+        self._logprob_sums = (
+            self._logprob_sums[batch_range, parent_ids]
+            + np.where(self._finished[batch_range, parent_ids], 0.,
+                       next_logprobs[batch_range, parent_ids, token_ids]))
+        self._lengths = (self._lengths[batch_range, parent_ids]
+                         + np.logical_not(
+                             self._finished[batch_range, parent_ids]))
+        self._finished = np.logical_or(
+            self._finished[batch_range, parent_ids],
+            token_ids == END_TOKEN_INDEX)
+
+        # rows of the parent states, ordered by the new beam and the batch
+        parent_rows = (parent_ids.T * batch_size + batch_range.T).reshape(-1)
+        self._states = [[part[parent_rows] for part in sess_result['states']]
+                        for sess_result in results]
+
+        self._token_ids.append(token_ids)
+        self._parent_ids.append(parent_ids)
+        self._time_step += 1
+
+        if (self._time_step == self._decoder.max_output_len
+                or self._finished.all()):
+            self._finish()
+
+    def _start(self, results: List[Dict], batch_size: int) -> None:
+        """Initialize a single hypothesis for each sentence."""
+        self._logprob_sums = np.zeros([batch_size, 1])
+        self._lengths = np.zeros([batch_size, 1], dtype=np.int32)
+        self._finished = np.zeros([batch_size, 1], dtype=bool)
+        self._batch_constants = [
+            dict(zip(self._decoder.step_batch_constants,
+                     sess_result['constants']))
+            for sess_result in results]
+
+    def _finish(self) -> None:
+        """Backtrack the best hypotheses and store the result."""
+        batch_range = np.arange(self._scores.shape[0])
+        hyp_indices = np.argmax(self._scores, axis=1)
+
+        token_ids = []  # type: List[np.ndarray]
+        for tokens, parents in zip(reversed(self._token_ids),
+                                   reversed(self._parent_ids)):
+            token_ids.append(tokens[batch_range, hyp_indices])
+            hyp_indices = parents[batch_range, hyp_indices]
+        token_ids.reverse()
+
+        decoded_tokens = self._vocabulary.vectors_to_sentences(token_ids)
+
+        if self._postprocess is not None:
+            decoded_tokens = self._postprocess(decoded_tokens)
+
+        self.result = ExecutionResult(
+            outputs=decoded_tokens,
+            losses=[self._loss],
+            scalar_summaries=None,
+            histogram_summaries=None,
+            image_summaries=None
+        )
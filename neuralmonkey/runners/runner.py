@@ -12,6 +12,24 @@ from neuralmonkey.runners.base_runner import (BaseRunner, Executable,
 # pylint: disable=too-few-public-methods
 
 
+def _logaddexp_in_time(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Sum time-major log-probabilities of possibly different lengths.
+
+    The decoding stops when all outputs end, so different sessions may decode
+    a different number of steps. The shorter array is padded by impossible
+    outcomes.
+    """
+    length = max(first.shape[0], second.shape[0])
+
+    def pad(logprobs: np.ndarray) -> np.ndarray:
+        padding = [(0, length - logprobs.shape[0])] + [(0, 0)] * (
+            logprobs.ndim - 1)
+        return np.pad(logprobs, padding, "constant",
+                      constant_values=-np.inf)
+
+    return np.logaddexp(pad(first), pad(second))
+
+
 class GreedyRunner(BaseRunner):
 
     def __init__(self,
@@ -67,16 +85,20 @@ class GreedyRunExecutable(Executable):
     def collect_results(self, results: List[Dict]) -> None:
         train_loss = 0.
         runtime_loss = 0.
-        summed_logprobs = [-np.inf for _ in self._fetches["decoded_logprobs"]]
+        summed_logprobs = None  # type: Optional[np.ndarray]
 
         for sess_result in results:
             train_loss += sess_result["train_xent"]
             runtime_loss += sess_result["runtime_xent"]
 
-            for i, logprob in enumerate(sess_result["decoded_logprobs"]):
-                summed_logprobs[i] = np.logaddexp(summed_logprobs[i], logprob)
+            logprobs = np.asarray(sess_result["decoded_logprobs"])
+            if summed_logprobs is None:
+                summed_logprobs = logprobs
+            else:
+                summed_logprobs = _logaddexp_in_time(summed_logprobs,
+                                                     logprobs)
 
-        argmaxes = [np.argmax(l, axis=1) for l in summed_logprobs]
+        argmaxes = np.argmax(summed_logprobs, axis=2)
 
         decoded_tokens = self._vocabulary.vectors_to_sentences(argmaxes)
 
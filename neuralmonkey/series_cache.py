@@ -0,0 +1,466 @@
+"""On-disk cache of preprocessed data series.
+
+Sentence-level preprocessors (e.g. BPE segmentation) can be expensive and
+their outputs do not change between epochs nor between runs as long as their
+inputs and the preprocessors stay the same. The cache stores the preprocessed
+series on disk under a content-addressed key, which is computed from the
+content of the input files, the reader, and the identity and configuration of
+the preprocessor.
+
+Series of token lists are stored as a table of distinct tokens and a flat
+array of token indices, series of numpy arrays are stored concatenated; in
+both cases together with the offsets of the individual items. The arrays are
+memory-mapped when the series is read, so a cached series can be read lazily
+and randomly accessed.
+
+The size of the cache directory can be bounded, in which case the least
+recently used series are evicted when a new series is stored.
+"""
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import types
+
+import numpy as np
+from typeguard import check_argument_types
+
+from neuralmonkey.logging import log, warn
+
+CACHE_VERSION = 1
+
+_META_FILE = "meta.json"
+_FINGERPRINT_DIR = "fingerprints"
+# prefix of the directories of series which are being written
+_TMP_PREFIX = ".tmp-"
+_HASH_BLOCK_SIZE = 1 << 20
+# number of token indices collected before they are converted to an array
+_TOKEN_CHUNK_SIZE = 1 << 20
+
+
+class CachedSeries(object):
+    """A preprocessed series stored in the cache.
+
+    The series behaves as a read-only sequence of its items.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open a cached series stored in the given directory.
+
+        Arguments:
+            path: The directory of the cached series.
+        """
+        self.path = path
+
+        with open(os.path.join(path, _META_FILE), "r") as f_meta:
+            meta = json.load(f_meta)
+
+        self.kind = meta["kind"]
+        self._offsets = np.load(os.path.join(path, "offsets.npy"),
+                                mmap_mode="r")
+        self._data = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+
+        if self.kind == "tokens":
+            with open(os.path.join(path, "tokens.json"), "r",
+                      encoding="utf-8") as f_tokens:
+                self._tokens = json.load(f_tokens)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> Any:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Cached series index out of range")
+
+        item = self._data[self._offsets[index]:self._offsets[index + 1]]
+        if self.kind == "tokens":
+            return [self._tokens[i] for i in item.tolist()]
+        return np.array(item)
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.read_range()
+
+    def read_range(self, start: int = 0,
+                   count: Optional[int] = None) -> Iterator[Any]:
+        """Iterate over a range of the items of the series.
+
+        Arguments:
+            start: The index of the first item.
+            count: Maximum number of items to read. If None, the series is read
+                until its end.
+        """
+        stop = len(self) if count is None else min(len(self), start + count)
+        for index in range(start, stop):
+            yield self[index]
+
+
+def get_cached_series_reader(
+        opened: Optional[List[CachedSeries]] = None) -> Callable:
+    """Get reader of series from the cache.
+
+    This reader can be used by the lazy dataset instead of reading the source
+    files and applying the preprocessor. Besides reading the whole series, it
+    supports random access through its ``read_range`` and ``count_items``
+    attributes.
+
+    Every cached series is opened only once by the reader and reused in all
+    the following reads, so the token table is not parsed again for every
+    range of the series.
+
+    Arguments:
+        opened: Already opened cached series, which the reader uses instead
+            of opening their directories again.
+    """
+    # type: Dict[str, CachedSeries]
+    series_by_path = {series.path: series for series in opened or []}
+
+    def open_series(path: str) -> CachedSeries:
+        if path not in series_by_path:
+            series_by_path[path] = CachedSeries(path)
+        return series_by_path[path]
+
+    def reader(paths: List[str]) -> Iterable[Any]:
+        for path in paths:
+            yield from open_series(path)
+
+    def read_range(paths: List[str], start: int = 0,
+                   count: Optional[int] = None) -> Iterable[Any]:
+        for path in paths:
+            if count is not None and count <= 0:
+                return
+
+            series = open_series(path)
+            if start >= len(series):
+                start -= len(series)
+                continue
+
+            yield from series.read_range(start, count)
+
+            if count is not None:
+                count -= len(series) - start
+            start = 0
+
+    def count_items(paths: List[str]) -> int:
+        return sum(len(open_series(path)) for path in paths)
+
+    reader.read_range = read_range  # type: ignore
+    reader.count_items = count_items  # type: ignore
+    return reader
+
+
+class SeriesCache(object):
+    """Content-addressed on-disk cache of preprocessed series."""
+
+    def __init__(self, directory: str,
+                 max_size_mb: Optional[int] = None) -> None:
+        """Create a cache in the given directory.
+
+        Arguments:
+            directory: The directory where the series are stored. It is
+                created if it does not exist and can be shared between
+                experiments.
+            max_size_mb: Maximum size of the cached series in megabytes. If
+                None, the size of the cache is not bounded.
+        """
+        check_argument_types()
+
+        if max_size_mb is not None and max_size_mb <= 0:
+            raise ValueError("Maximum cache size must be a positive integer.")
+
+        self.directory = directory
+        self.max_size = (None if max_size_mb is None
+                         else max_size_mb * 1024 * 1024)
+
+        os.makedirs(os.path.join(directory, _FINGERPRINT_DIR), exist_ok=True)
+
+    def series_key(self, paths: List[str], reader: Callable,
+                   preprocessor: Callable) -> str:
+        """Compute the key of a preprocessed series.
+
+        Arguments:
+            paths: The files of the source series.
+            reader: The reader of the source series.
+            preprocessor: The preprocessor applied on the source series.
+
+        Returns:
+            Hexadecimal digest identifying the preprocessed series.
+        """
+        hasher = hashlib.sha1()
+        hasher.update("version {}".format(CACHE_VERSION).encode("utf-8"))
+        for path in paths:
+            hasher.update(self._file_fingerprint(path).encode("utf-8"))
+        hasher.update(_callable_fingerprint(reader))
+        hasher.update(_callable_fingerprint(preprocessor))
+        return hasher.hexdigest()
+
+    def load(self, key: str) -> Optional[CachedSeries]:
+        """Load a series from the cache.
+
+        Arguments:
+            key: The key of the series.
+
+        Returns:
+            The cached series or None if the series is not in the cache.
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isfile(os.path.join(path, _META_FILE)):
+            return None
+
+        try:
+            series = CachedSeries(path)
+        # pylint: disable=broad-except
+        except Exception as exc:
+            warn("Cannot read cached series {}: {}".format(path, exc))
+            return None
+
+        # mark the series as recently used
+        os.utime(os.path.join(path, _META_FILE))
+        return series
+
+    def store(self, key: str, items: Iterable[Any]) -> Optional[CachedSeries]:
+        """Store a series in the cache.
+
+        Arguments:
+            key: The key of the series.
+            items: The items of the series. Only series of lists of strings and
+                series of numpy arrays of the same dtype and trailing
+                dimensions can be stored.
+
+        Returns:
+            The cached series or None if the series cannot be cached.
+        """
+        path = os.path.join(self.directory, key)
+        tmp_path = tempfile.mkdtemp(prefix=_TMP_PREFIX + key,
+                                    dir=self.directory)
+
+        try:
+            _write_series(tmp_path, items)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # stored by another process in the meantime
+                shutil.rmtree(tmp_path)
+        except (TypeError, ValueError) as exc:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            warn("Series cannot be cached: {}".format(exc))
+            return None
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        log("Preprocessed series stored in cache: {}".format(path))
+        self._evict(keep=key)
+        return CachedSeries(path)
+
+    def _file_fingerprint(self, path: str) -> str:
+        """Get a digest of the content of a file.
+
+        The digests are remembered in the cache directory together with the
+        size and the modification time of the files, so unchanged files are
+        not hashed repeatedly.
+        """
+        abs_path = os.path.abspath(path)
+        stat = os.stat(abs_path)
+        record_path = os.path.join(
+            self.directory, _FINGERPRINT_DIR,
+            hashlib.sha1(abs_path.encode("utf-8")).hexdigest() + ".json")
+
+        if os.path.isfile(record_path):
+            try:
+                with open(record_path, "r") as f_record:
+                    record = json.load(f_record)
+                if (record["size"] == stat.st_size
+                        and record["mtime"] == stat.st_mtime_ns):
+                    return record["digest"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        hasher = hashlib.sha1()
+        with open(abs_path, "rb") as f_data:
+            for block in iter(lambda: f_data.read(_HASH_BLOCK_SIZE), b""):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+
+        # the record is replaced at once, other processes may read it
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=_TMP_PREFIX, dir=os.path.dirname(record_path))
+        except OSError as exc:
+            warn("Cannot save file fingerprint {}: {}".format(
+                record_path, exc))
+            return digest
+
+        try:
+            with os.fdopen(fd, "w") as f_record:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                           "digest": digest}, f_record)
+            os.replace(tmp_path, record_path)
+        except OSError as exc:
+            os.remove(tmp_path)
+            warn("Cannot save file fingerprint {}: {}".format(
+                record_path, exc))
+
+        return digest
+
+    def _evict(self, keep: str) -> None:
+        """Remove the least recently used series above the size limit."""
+        if self.max_size is None:
+            return
+
+        entries = []
+        for key in os.listdir(self.directory):
+            # series being written by other processes are not evicted
+            if key.startswith(_TMP_PREFIX) or key == _FINGERPRINT_DIR:
+                continue
+            meta_path = os.path.join(self.directory, key, _META_FILE)
+            if os.path.isfile(meta_path):
+                entries.append((os.path.getmtime(meta_path), key,
+                                _directory_size(
+                                    os.path.join(self.directory, key))))
+
+        total_size = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            log("Evicting series from cache: {}".format(key))
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+            total_size -= size
+
+        if total_size > self.max_size:
+            warn("The series {} alone exceeds the size limit of the cache."
+                 .format(keep))
+
+
+def _write_series(path: str, items: Iterable[Any]) -> None:
+    """Write a series to a directory in the compact format.
+
+    Raises:
+        TypeError when the items cannot be stored.
+        ValueError when numpy array items have different dtypes or shapes.
+    """
+    offsets = [0]
+    kind = None  # type: Optional[str]
+    token_ids = {}  # type: Dict[str, int]
+    chunks = []  # type: List[np.ndarray]
+    buf = []  # type: List[int]
+
+    for item in items:
+        if kind is None:
+            kind = "arrays" if isinstance(item, np.ndarray) else "tokens"
+
+        if kind == "tokens":
+            if not isinstance(item, list) or not all(
+                    isinstance(token, str) for token in item):
+                raise TypeError("Items of type {} cannot be cached".format(
+                    type(item).__name__))
+            buf.extend(token_ids.setdefault(token, len(token_ids))
+                       for token in item)
+            offsets.append(offsets[-1] + len(item))
+
+            if len(buf) >= _TOKEN_CHUNK_SIZE:
+                chunks.append(np.array(buf, dtype=np.int32))
+                buf = []
+        else:
+            if not isinstance(item, np.ndarray) or item.ndim == 0:
+                raise TypeError("Items of type {} cannot be cached".format(
+                    type(item).__name__))
+            if chunks and (item.dtype != chunks[0].dtype
+                           or item.shape[1:] != chunks[0].shape[1:]):
+                raise ValueError("Arrays in the series differ in their dtype "
+                                 "or shape")
+            chunks.append(item)
+            offsets.append(offsets[-1] + len(item))
+
+    if kind is None or kind == "tokens":
+        kind = "tokens"
+        chunks.append(np.array(buf, dtype=np.int32))
+        tokens = [""] * len(token_ids)
+        for token, index in token_ids.items():
+            tokens[index] = token
+        with open(os.path.join(path, "tokens.json"), "w",
+                  encoding="utf-8") as f_tokens:
+            json.dump(tokens, f_tokens, ensure_ascii=False)
+
+    np.save(os.path.join(path, "data.npy"), np.concatenate(chunks))
+    np.save(os.path.join(path, "offsets.npy"),
+            np.array(offsets, dtype=np.int64))
+
+    with open(os.path.join(path, _META_FILE), "w") as f_meta:
+        json.dump({"version": CACHE_VERSION, "kind": kind,
+                   "length": len(offsets) - 1}, f_meta)
+
+
+def _directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def _code_bytes(code: types.CodeType) -> bytes:
+    """Serialize the bytecode and the constants of a code object."""
+    parts = [code.co_code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(_code_bytes(const))
+        else:
+            parts.append(repr(const).encode("utf-8"))
+    return b"\x00".join(parts)
+
+
+def _state_bytes(value: Any) -> bytes:
+    """Serialize the configuration of a callable in a stable way."""
+    if callable(value) and not isinstance(value, type):
+        return _callable_fingerprint(value)
+    if isinstance(value, dict):
+        return b"\x00".join(
+            repr(k).encode("utf-8") + b"=" + _state_bytes(v)
+            for k, v in sorted(value.items(), key=lambda kv: repr(kv[0])))
+    if isinstance(value, (list, tuple)):
+        return b"\x00".join(_state_bytes(v) for v in value)
+    try:
+        return pickle.dumps(value, protocol=4)
+    # pylint: disable=broad-except
+    except Exception:
+        return repr(value).encode("utf-8")
+
+
+def _callable_fingerprint(func: Callable) -> bytes:
+    """Compute a digest of the identity and configuration of a callable.
+
+    Functions are identified by their qualified name, bytecode and the values
+    they close over, callable objects by the name and the code of their class
+    and by their attributes.
+    """
+    hasher = hashlib.sha1()
+
+    if isinstance(func, types.MethodType):
+        hasher.update(_state_bytes(func.__self__))
+        func = func.__func__
+
+    if isinstance(func, types.FunctionType):
+        name = "{}.{}".format(func.__module__, func.__qualname__)
+        code = func.__code__  # type: Optional[types.CodeType]
+        state = [cell.cell_contents for cell in func.__closure__ or []]
+        state.extend([func.__defaults__, func.__kwdefaults__])
+        state.append(vars(func))
+    else:
+        cls = type(func)
+        name = "{}.{}".format(cls.__module__, cls.__qualname__)
+        code = getattr(getattr(cls, "__call__", None), "__code__", None)
+        state = [getattr(func, "__dict__", None)]
+
+    hasher.update(name.encode("utf-8"))
+    if code is not None:
+        hasher.update(_code_bytes(code))
+    hasher.update(_state_bytes(state))
+    return hasher.digest()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3.5
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from neuralmonkey.dataset import load_dataset_from_files
+from neuralmonkey.readers.binary_corpus import (
+    BinaryCorpus, compile_corpus, get_binary_corpus_reader)
+from neuralmonkey.vocabulary import Vocabulary
+
+CORPUS = [
+    "the colorless ideas slept furiously",
+    "pooh slept all night",
+    "",
+    "working class hero is something to be",
+    "I am the working class walrus",
+    "walrus for president"
+]
+
+TOKENIZED_CORPUS = [s.split(" ") for s in CORPUS]
+
+
+class TestBinaryCorpus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.text = os.path.join(self.tmpdir.name, "corpus.txt")
+        self.compiled = os.path.join(self.tmpdir.name, "corpus.bin")
+
+        with open(self.text, "w") as f_text:
+            for line in CORPUS:
+                print(line, file=f_text)
+
+        self.vocabulary = Vocabulary()
+        for sentence in TOKENIZED_CORPUS[:-1]:
+            self.vocabulary.add_tokenized_text(sentence)
+
+        compile_corpus([self.text], self.compiled, self.vocabulary)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        corpus = BinaryCorpus(self.compiled)
+        self.assertEqual(len(corpus), len(CORPUS))
+        self.assertEqual(corpus.vocabulary_hash,
+                         self.vocabulary.content_hash())
+
+        for sentence, ids in zip(TOKENIZED_CORPUS, corpus.read_range()):
+            self.assertEqual(ids.dtype, np.int32)
+            self.assertEqual(
+                [self.vocabulary.get_word_index(w) for w in sentence],
+                ids.tolist())
+
+    def test_small_write_buffer(self):
+        compiled = os.path.join(self.tmpdir.name, "buffered.bin")
+        self.assertEqual(
+            compile_corpus([self.text], compiled, self.vocabulary,
+                           buffer_size=3), len(CORPUS))
+
+        with open(self.compiled, "rb") as f_expected, \
+                open(compiled, "rb") as f_compiled:
+            self.assertEqual(f_expected.read(), f_compiled.read())
+
+    def test_vocabulary_mismatch(self):
+        other = Vocabulary(tokenized_text=["different", "words"])
+        reader = get_binary_corpus_reader(other)
+
+        with self.assertRaises(ValueError):
+            list(reader([self.compiled]))
+
+    def test_tensor_matches_text(self):
+        reader = get_binary_corpus_reader(self.vocabulary)
+        ids = list(reader([self.compiled]))
+
+        for kwargs in [{"max_len": 4},
+                       {"max_len": 10, "pad_to_max_len": False,
+                        "add_end_symbol": True},
+                       {"add_start_symbol": True, "add_end_symbol": True,
+                        "pad_to_max_len": False}]:
+            from_text = self.vocabulary.sentences_to_tensor(
+                TOKENIZED_CORPUS, **kwargs)
+            from_ids = self.vocabulary.ids_to_tensor(ids, **kwargs)
+
+            np.testing.assert_array_equal(from_text[0], from_ids[0])
+            np.testing.assert_array_equal(from_text[1], from_ids[1])
+
+    def test_lazy_dataset(self):
+        reader = get_binary_corpus_reader(self.vocabulary)
+        dataset = load_dataset_from_files(
+            s_source=self.text, s_ids=(self.compiled, reader), lazy=True,
+            shuffle_chunk_size=2)
+
+        self.assertEqual(len(dataset), len(CORPUS))
+        dataset.shuffle()
+        for batch in dataset.batch_dataset(4):
+            for sentence, ids in zip(batch.get_series("source"),
+                                     batch.get_series("ids")):
+                self.assertEqual(len(sentence), len(ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
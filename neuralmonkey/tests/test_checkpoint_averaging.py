@@ -0,0 +1,57 @@
+#!/usr/bin/env python3.5
+"""Test averaging of checkpoints."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from neuralmonkey.checkpoint_averaging import (average_checkpoints,
+                                               last_checkpoints)
+
+
+class TestCheckpointAveraging(unittest.TestCase):
+
+    def test_average_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoints = []
+            with tf.Graph().as_default():
+                weights = tf.get_variable("layer/weights", [2, 3])
+                bias = tf.get_variable("layer/bias", [3])
+                step = tf.Variable(0, name="global_step", trainable=False)
+                saver = tf.train.Saver()
+
+                with tf.Session() as session:
+                    session.run(tf.global_variables_initializer())
+                    for i in range(3):
+                        session.run([
+                            weights.assign(np.full([2, 3], i, np.float32)),
+                            bias.assign(np.full([3], 2 * i, np.float32)),
+                            step.assign(10 * i)])
+                        path = os.path.join(tmp_dir, "vars.{}".format(i))
+                        checkpoints.append(saver.save(session, path))
+                        # make the order of the saving unambiguous
+                        os.utime(path + ".index", (1000 + i, 1000 + i))
+
+                trainable = [var.op.name for var in tf.trainable_variables()]
+
+            self.assertEqual(last_checkpoints(checkpoints, 2),
+                             checkpoints[:0:-1])
+
+            output = os.path.join(tmp_dir, "vars.avg")
+            average_checkpoints(checkpoints[1:], output, trainable)
+            reader = tf.train.NewCheckpointReader(output)
+            np.testing.assert_allclose(reader.get_tensor("layer/weights"),
+                                       np.full([2, 3], 1.5))
+            np.testing.assert_allclose(reader.get_tensor("layer/bias"),
+                                       np.full([3], 3.))
+            self.assertEqual(reader.get_tensor("global_step"), 10)
+
+            with self.assertRaises(ValueError):
+                average_checkpoints(checkpoints, output, ["layer/missing"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,29 @@
 #!/usr/bin/env python3.5
 
+import functools
+import os
+import tempfile
 import unittest
 
-from neuralmonkey.dataset import LazyDataset
+import numpy as np
+
+from neuralmonkey.dataset import (Dataset, LazyDataset, ShardedDataset,
+                                  BatchingScheme, load_dataset_from_files,
+                                  _interleave_shards)
+from neuralmonkey.ragged import RaggedTokenSeries
 from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
 
+SOURCE = [["a"] * length for length in [3, 1, 7, 2, 7, 5, 1, 4, 6, 2]]
+TARGET = [["b"] * (length + 1) for length in [3, 1, 7, 2, 7, 5, 1, 4, 6, 2]]
+
+
+def reverse_tokens(sentence):
+    return sentence[::-1]
+
+
+def source_lengths(dataset):
+    return [len(s) for s in dataset.get_series("source")]
+
 
 class TestDataset(unittest.TestCase):
 
@@ -15,6 +34,282 @@ class TestDataset(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             LazyDataset("name", paths_and_readers, {}, None)
 
+    def test_bucketed_batches(self):
+        dataset = Dataset("dataset", {"source": SOURCE, "target": TARGET}, {})
+        scheme = BatchingScheme(token_budget=16,
+                                length_series=["source", "target"])
+
+        batches = list(dataset.batch_dataset(4, scheme))
+        self.assertEqual(sum(len(b) for b in batches), len(dataset))
+
+        for batch in batches:
+            sources = list(batch.get_series("source"))
+            targets = list(batch.get_series("target"))
+            max_len = max(len(t) for t in targets)
+            if len(batch) > 1:
+                self.assertLessEqual(len(batch) * max_len, 16)
+
+            # examples must stay aligned across the series
+            for src, tgt in zip(sources, targets):
+                self.assertEqual(len(src) + 1, len(tgt))
+
+    def test_bucketing_max_batch_size(self):
+        dataset = Dataset("dataset", {"source": SOURCE}, {})
+        scheme = BatchingScheme(token_budget=1000, max_batch_size=3)
+
+        batches = list(dataset.batch_dataset(4, scheme))
+        self.assertEqual([len(b) for b in batches if len(b) != 3], [1])
+
+    def test_bucketing_length_key(self):
+        dataset = Dataset("dataset", {"source": SOURCE, "target": TARGET}, {})
+        scheme = BatchingScheme(token_budget=1,
+                                length_key=lambda ex: len(ex["source"]),
+                                shuffle_batches=False)
+
+        lengths = [len(list(b.get_series("source"))[0])
+                   for b in dataset.batch_dataset(4, scheme)]
+        self.assertEqual(lengths, sorted(len(s) for s in SOURCE))
+
+    def test_shuffle_permutes_indices(self):
+        source = [list(s) for s in SOURCE]
+        vectors = np.arange(len(SOURCE) * 2).reshape([len(SOURCE), 2])
+        dataset = Dataset("dataset", {"source": source, "vectors": vectors},
+                          {})
+
+        dataset.shuffle()
+        shuffled = list(dataset.get_series("source"))
+        self.assertEqual(source, SOURCE)
+        self.assertEqual(sorted(map(len, shuffled)), sorted(map(len, SOURCE)))
+        for src, vec in zip(shuffled, dataset.get_series("vectors")):
+            self.assertIs(src, source[vec[0] // 2])
+
+    def test_batch_views(self):
+        vectors = np.arange(len(SOURCE) * 2).reshape([len(SOURCE), 2])
+        dataset = Dataset("dataset", {"source": SOURCE, "vectors": vectors},
+                          {})
+
+        batches = list(dataset.batch_dataset(4))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertTrue(np.shares_memory(
+            batches[1].get_series("vectors"), vectors))
+        self.assertEqual(list(batches[1].get_series("source")), SOURCE[4:8])
+
+        subset = batches[1].subset(1, 10)
+        self.assertEqual(len(subset), 3)
+        self.assertEqual(list(subset.get_series("source")), SOURCE[5:8])
+
+    def test_add_series_to_shuffled(self):
+        dataset = Dataset("dataset", {"source": SOURCE}, {})
+        dataset.shuffle()
+        dataset.add_series("length", [len(s) for s in
+                                      dataset.get_series("source")])
+
+        for src, length in zip(dataset.get_series("source"),
+                               dataset.get_series("length")):
+            self.assertEqual(len(src), length)
+
+
+class TestLazyShuffle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, "source.txt")
+        self.target = os.path.join(self.tmpdir.name, "target.txt")
+
+        with open(self.source, "w") as f_src, \
+                open(self.target, "w") as f_tgt:
+            for i in range(100):
+                print("src {}".format(i), file=f_src)
+                print("tgt {}".format(i), file=f_tgt)
+
+    def _load(self, **kwargs):
+        return load_dataset_from_files(
+            s_source=self.source, s_target=self.target, lazy=True,
+            preprocessors=[("source", "source_rev", lambda s: s[::-1])],
+            **kwargs)
+
+    def _check_shuffled(self, dataset):
+        dataset.shuffle()
+        sources = list(dataset.get_series("source"))
+        targets = list(dataset.get_series("target"))
+        reversed_sources = list(dataset.get_series("source_rev"))
+
+        self.assertEqual(sorted(int(s[1]) for s in sources),
+                         list(range(100)))
+        self.assertNotEqual([int(s[1]) for s in sources], list(range(100)))
+        for src, tgt, rev in zip(sources, targets, reversed_sources):
+            self.assertEqual(src[1], tgt[1])
+            self.assertEqual(src[::-1], rev)
+
+    def test_shuffle_buffer(self):
+        self._check_shuffled(self._load(shuffle_buffer_size=10))
+
+    def test_shuffle_chunks(self):
+        self._check_shuffled(self._load(shuffle_buffer_size=5,
+                                        shuffle_chunk_size=7))
+
+    def test_no_shuffle(self):
+        dataset = self._load()
+        dataset.shuffle()
+        self.assertEqual([int(s[1]) for s in dataset.get_series("source")],
+                         list(range(100)))
+
+    def test_len_and_subset(self):
+        dataset = self._load()
+        self.assertEqual(len(dataset), 100)
+
+        subset = dataset.subset(42, 5)
+        self.assertEqual(len(subset), 5)
+        self.assertEqual([s[1] for s in subset.get_series("target")],
+                         [str(i) for i in range(42, 47)])
+        self.assertEqual(list(subset.get_series("source_rev")),
+                         [["{}".format(i), "src"] for i in range(42, 47)])
+
+    def test_from_offset(self):
+        dataset = self._load().from_offset(90)
+        self.assertEqual(len(dataset), 10)
+        self.assertEqual([int(s[1]) for s in dataset.get_series("source")],
+                         list(range(90, 100)))
+
+        with self.assertRaises(ValueError):
+            dataset.from_offset(11)
+
+    def test_single_pass_batches(self):
+        calls = []
+
+        def preprocess(sentence):
+            calls.append(sentence)
+            return sentence[::-1]
+
+        dataset = load_dataset_from_files(
+            s_source=self.source, s_target=self.target, lazy=True,
+            preprocessors=[("source", "source_rev", preprocess)],
+            shuffle_buffer_size=10)
+        dataset.shuffle()
+
+        batches = list(dataset.batch_dataset(8))
+        self.assertEqual([len(b) for b in batches], [8] * 12 + [4])
+        self.assertEqual(len(calls), 100)
+
+        for batch in batches:
+            for src, tgt, rev in zip(batch.get_series("source"),
+                                     batch.get_series("target"),
+                                     batch.get_series("source_rev")):
+                self.assertEqual(src[1], tgt[1])
+                self.assertEqual(src[::-1], rev)
+
+    def test_parallel_preprocessing(self):
+        for lazy in [False, True]:
+            dataset = load_dataset_from_files(
+                s_source=self.source, lazy=lazy, preprocess_workers=3,
+                preprocessors=[("source", "source_rev", reverse_tokens)])
+            dataset.shuffle()
+
+            examples = [ex for batch in dataset.batch_dataset(7)
+                        for ex in zip(batch.get_series("source"),
+                                      batch.get_series("source_rev"))]
+            self.assertEqual(len(examples), 100)
+            for src, rev in examples:
+                self.assertEqual(src[::-1], rev)
+
+    def test_compact_series(self):
+        dataset = load_dataset_from_files(
+            s_source=self.source, compact_series=True,
+            preprocessors=[("source", "source_rev", reverse_tokens),
+                           ("source", "length", len)])
+
+        self.assertIsInstance(dataset.get_series("source"),
+                              RaggedTokenSeries)
+        self.assertIsInstance(dataset.get_series("source_rev"),
+                              RaggedTokenSeries)
+        self.assertIs(dataset.get_series("source").table,
+                      dataset.get_series("source_rev").table)
+        self.assertEqual(dataset.get_series("source_rev")[3], ["3", "src"])
+        self.assertEqual(list(dataset.get_series("length")), [2] * 100)
+
+    def test_parallel_dataset_preprocessing(self):
+        dataset = load_dataset_from_files(
+            s_source=self.source, preprocess_workers=2,
+            pre_lengths=source_lengths)
+
+        self.assertEqual(list(dataset.get_series("lengths")), [2] * 100)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class TestShardedDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        for shard in range(5):
+            with open(self._path(shard, "src"), "w") as f_src, \
+                    open(self._path(shard, "tgt"), "w") as f_tgt:
+                for i in range(20):
+                    print("src {} {}".format(shard, i), file=f_src)
+                    print("tgt {} {}".format(shard, i), file=f_tgt)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _path(self, shard, suffix):
+        return os.path.join(self.tmpdir.name,
+                            "shard{}.{}".format(shard, suffix))
+
+    def _load(self, **kwargs):
+        return load_dataset_from_files(
+            s_source=os.path.join(self.tmpdir.name, "shard*.src"),
+            s_target=[self._path(i, "tgt") for i in range(5)],
+            preprocessors=[("source", "source_rev", reverse_tokens)],
+            sharded=True, parallel_shards=3, **kwargs)
+
+    def _check_examples(self, dataset):
+        examples = [ex for batch in dataset.batch_dataset(8)
+                    for ex in zip(batch.get_series("source"),
+                                  batch.get_series("target"),
+                                  batch.get_series("source_rev"))]
+
+        self.assertEqual(len(examples), 100)
+        self.assertEqual(len({tuple(src) for src, _, _ in examples}), 100)
+        for src, tgt, rev in examples:
+            self.assertEqual(src[1:], tgt[1:])
+            self.assertEqual(src[::-1], rev)
+
+        return [src for src, _, _ in examples]
+
+    def test_interleaving(self):
+        dataset = self._load()
+        self.assertIsInstance(dataset, ShardedDataset)
+        self.assertEqual(len(dataset), 100)
+
+        sources = self._check_examples(dataset)
+        self.assertEqual(sources, self._check_examples(dataset))
+
+    def test_interleave_shards(self):
+        shards = [functools.partial(lambda i: ((i, j) for j in range(150)), i)
+                  for i in range(4)]
+        items = list(_interleave_shards(shards, 2))
+
+        self.assertEqual(sorted(items),
+                         [(i, j) for i in range(4) for j in range(150)])
+        # blocks are taken from the first two shards in turns
+        self.assertEqual([i for i, _ in items[::64][:4]], [0, 1, 0, 1])
+
+    def test_shuffled_shards(self):
+        dataset = self._load(shuffle_buffer_size=30)
+        orders = set()
+        for _ in range(5):
+            dataset.shuffle()
+            orders.add(tuple(tuple(s) for s in self._check_examples(dataset)))
+        self.assertGreater(len(orders), 1)
+
+    def test_misaligned_shards(self):
+        with self.assertRaises(ValueError):
+            load_dataset_from_files(
+                s_source=os.path.join(self.tmpdir.name, "shard*.src"),
+                s_target=self._path(0, "tgt"), sharded=True)
+
 
 if __name__ == "__main__":
     unittest.main()
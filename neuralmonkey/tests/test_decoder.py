@@ -4,6 +4,9 @@
 
 import unittest
 
+import numpy as np
+import tensorflow as tf
+
 from neuralmonkey.decoders.decoder import Decoder
 from neuralmonkey.vocabulary import Vocabulary
 
@@ -22,6 +25,104 @@ class TestDecoder(unittest.TestCase):
             rnn_size=10)
         self.assertIsNotNone(decoder)
 
+    def test_runtime_loop(self):
+        with tf.Graph().as_default():
+            vocabulary = Vocabulary()
+            decoder = Decoder(
+                encoders=[],
+                vocabulary=vocabulary,
+                data_id="foo",
+                name="test-runtime-decoder",
+                max_output_len=20,
+                embedding_size=10,
+                rnn_size=10)
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {decoder.train_mode: False,
+                             decoder.go_symbols: np.ones([1, 3], np.int32)}
+
+                logits, mask = sess.run(
+                    [decoder.runtime_logits, decoder.runtime_mask],
+                    feed_dict)
+                self.assertLessEqual(logits.shape[0], 20)
+                self.assertEqual(logits.shape[1:], (3, len(vocabulary)))
+                self.assertEqual(mask.shape, logits.shape[:2])
+                if logits.shape[0] < 20:
+                    self.assertFalse(mask[-1].any())
+
+                feed_dict[decoder.runtime_min_steps] = 20
+                logits = sess.run(decoder.runtime_logits, feed_dict)
+                self.assertEqual(logits.shape[0], 20)
+
+    def test_incremental_step(self):
+        with tf.Graph().as_default():
+            decoder = Decoder(
+                encoders=[],
+                vocabulary=Vocabulary(),
+                data_id="foo",
+                name="test-incremental-decoder",
+                max_output_len=5,
+                embedding_size=10,
+                rnn_size=10,
+                rnn_cell="LSTM")
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {decoder.train_mode: False,
+                             decoder.go_symbols: np.ones([1, 3], np.int32),
+                             decoder.runtime_min_steps: 5}
+                runtime_logprobs = sess.run(decoder.runtime_logprobs,
+                                            feed_dict)
+
+                logprobs, states, constants = sess.run(
+                    [decoder.step_logprobs, decoder.step_states,
+                     decoder.step_batch_constants], feed_dict)
+                np.testing.assert_allclose(logprobs, runtime_logprobs[0],
+                                           rtol=1e-5)
+
+                feed_dict.update(zip(decoder.step_batch_constants,
+                                     constants))
+                for step in range(1, 5):
+                    feed_dict[decoder.step_input_ids] = np.argmax(logprobs, 1)
+                    feed_dict.update(zip(decoder.step_prev_states, states))
+                    logprobs, states = sess.run(
+                        [decoder.step_logprobs, decoder.step_states],
+                        feed_dict)
+                    np.testing.assert_allclose(
+                        logprobs, runtime_logprobs[step], rtol=1e-5)
+
+    def test_dynamic_train_length(self):
+        with tf.Graph().as_default():
+            vocabulary = Vocabulary(["a", "b"])
+            decoder = Decoder(
+                encoders=[],
+                vocabulary=vocabulary,
+                data_id="foo",
+                name="test-train-decoder",
+                max_output_len=10,
+                embedding_size=10,
+                rnn_size=10)
+
+            sentences = [["a", "b"], ["b"]]
+            padded = vocabulary.sentences_to_tensor(
+                sentences, 10, add_end_symbol=True)
+            trimmed = vocabulary.sentences_to_tensor(
+                sentences, 10, pad_to_max_len=False, add_end_symbol=True)
+            self.assertEqual(trimmed[0].shape, (3, 2))
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                losses = []
+                for inputs, weights in [padded, trimmed]:
+                    losses.append(sess.run(decoder.train_loss, {
+                        decoder.train_mode: False,
+                        decoder.go_symbols: np.ones([1, 2], np.int32),
+                        decoder.train_inputs: inputs,
+                        decoder.train_padding: weights}))
+
+                self.assertAlmostEqual(losses[0], losses[1], places=5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3.5
+
+import gzip
+import os
+import tempfile
+import unittest
+
+from neuralmonkey.readers.line_index import (LineIndex, INDEX_SUFFIX,
+                                             count_lines, iterate_lines)
+from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+
+LINES = ["line {} {}\n".format(i, "x" * (i % 13)).encode("utf-8")
+         for i in range(1000)]
+
+
+class TestLineIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.plain = os.path.join(self.tmpdir.name, "data.txt")
+        self.multi_gz = os.path.join(self.tmpdir.name, "multi.gz")
+        self.single_gz = os.path.join(self.tmpdir.name, "single.gz")
+
+        with open(self.plain, "wb") as f_plain:
+            f_plain.writelines(LINES)
+
+        with open(self.multi_gz, "wb") as f_gz:
+            for i in range(0, len(LINES), 77):
+                f_gz.write(gzip.compress(b"".join(LINES[i:i + 77])))
+
+        with open(self.single_gz, "wb") as f_gz:
+            f_gz.write(gzip.compress(b"".join(LINES)))
+
+    def test_random_access(self):
+        for path in [self.plain, self.multi_gz, self.single_gz]:
+            index = LineIndex(path, stride=16)
+            self.assertEqual(len(index), len(LINES))
+
+            for start, count in [(0, 3), (15, 2), (16, 1), (500, 100),
+                                 (998, None)]:
+                end = None if count is None else start + count
+                self.assertEqual(list(index.iterate_lines(start, count)),
+                                 LINES[start:end])
+
+    def test_persistence(self):
+        LineIndex(self.plain, stride=16)
+        self.assertTrue(os.path.isfile(self.plain + INDEX_SUFFIX))
+
+        with open(self.plain, "ab") as f_plain:
+            f_plain.write(b"one more line\n")
+
+        index = LineIndex(self.plain, stride=16)
+        self.assertEqual(len(index), len(LINES) + 1)
+
+    def test_multiple_files(self):
+        paths = [self.plain, self.multi_gz]
+        self.assertEqual(count_lines(paths), 2 * len(LINES))
+        self.assertEqual(list(iterate_lines(paths, 995, 10)),
+                         LINES[995:] + LINES[:5])
+
+    def test_carriage_return(self):
+        path = os.path.join(self.tmpdir.name, "cr.txt")
+        with open(path, "wb") as f_data:
+            f_data.write(b"a\rb c\r\nd e\n\rf\n")
+
+        read = list(UtfPlainTextReader([path]))
+        self.assertEqual(read, [["a\rb", "c"], ["d", "e"], ["f"]])
+        self.assertEqual(count_lines([path]), len(read))
+        self.assertEqual(
+            [UtfPlainTextReader.parse_line(line)
+             for line in iterate_lines([path], 1)], read[1:])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
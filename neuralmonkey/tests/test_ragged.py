@@ -0,0 +1,79 @@
+#!/usr/bin/env python3.5
+
+import unittest
+
+import numpy as np
+
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.ragged import (RaggedSeriesBuilder, RaggedTokenSeries,
+                                 TokenTable)
+
+SENTENCES = [list("the colorless ideas"), [], list("slept"),
+             list("furiously"), list("pooh")]
+
+
+class TestRaggedTokenSeries(unittest.TestCase):
+
+    def test_roundtrip(self):
+        series = RaggedTokenSeries.from_sentences(SENTENCES)
+
+        self.assertEqual(len(series), len(SENTENCES))
+        self.assertEqual(list(series), SENTENCES)
+        self.assertEqual(series[-1], SENTENCES[-1])
+        self.assertEqual(series.codes.dtype, np.uint8)
+        self.assertEqual(series.lengths().tolist(),
+                         [len(s) for s in SENTENCES])
+
+    def test_slice_shares_buffer(self):
+        series = RaggedTokenSeries.from_sentences(SENTENCES)
+        sliced = series[1:4]
+
+        self.assertIs(sliced.codes, series.codes)
+        self.assertEqual(list(sliced), SENTENCES[1:4])
+        self.assertEqual(list(series[::2]), SENTENCES[::2])
+
+    def test_take(self):
+        series = RaggedTokenSeries.from_sentences(SENTENCES)
+        taken = series.take(np.array([3, 0, 1, 3]))
+
+        self.assertEqual(list(taken), [SENTENCES[i] for i in [3, 0, 1, 3]])
+        self.assertEqual(len(taken.codes), sum(taken.lengths()))
+
+    def test_shared_table(self):
+        table = TokenTable()
+        first = RaggedTokenSeries.from_sentences([["a", "b"]], table)
+        second = RaggedTokenSeries.from_sentences([["b", "c"]], table)
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(first), [["a", "b"]])
+        self.assertEqual(list(second), [["b", "c"]])
+
+    def test_builder(self):
+        builder = RaggedSeriesBuilder()
+        for sentence in iter(SENTENCES):
+            builder.append(sentence)
+
+        self.assertEqual(len(builder), len(SENTENCES))
+        self.assertEqual(list(builder.build()), SENTENCES)
+
+    def test_dataset(self):
+        series = RaggedTokenSeries.from_sentences(SENTENCES)
+        dataset = Dataset("dataset", {"chars": series}, {})
+
+        batches = list(dataset.batch_dataset(2))
+        self.assertIsInstance(batches[1].get_series("chars"),
+                              RaggedTokenSeries)
+        self.assertEqual(list(batches[1].get_series("chars")),
+                         SENTENCES[2:4])
+
+        dataset.shuffle()
+        dataset.add_series("lengths", [len(s) for s in
+                                       dataset.get_series("chars")])
+        self.assertIsInstance(dataset.get_series("chars"), RaggedTokenSeries)
+        for chars, length in zip(dataset.get_series("chars"),
+                                 dataset.get_series("lengths")):
+            self.assertEqual(len(chars), length)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3.5
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from neuralmonkey.dataset import load_dataset_from_files
+from neuralmonkey.readers.plain_text_reader import UtfPlainTextReader
+from neuralmonkey.series_cache import SeriesCache, get_cached_series_reader
+
+
+def reverse_tokens(sentence):
+    return sentence[::-1]
+
+
+class Repeat(object):
+
+    def __init__(self, times):
+        self.times = times
+
+    def __call__(self, sentence):
+        return sentence * self.times
+
+
+class TestSeriesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.source = os.path.join(self.tmpdir.name, "source.txt")
+
+        with open(self.source, "w") as f_src:
+            for i in range(50):
+                print("src {} ž".format(i), file=f_src)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, cache, preprocessor=reverse_tokens, **kwargs):
+        return load_dataset_from_files(
+            s_source=self.source, series_cache=cache,
+            preprocessors=[("source", "source_pre", preprocessor)], **kwargs)
+
+    def test_eager_roundtrip(self):
+        cache = SeriesCache(self.cache_dir)
+        first = self._load(cache)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        second = self._load(cache)
+        self.assertEqual(list(first.get_series("source_pre")),
+                         list(second.get_series("source_pre")))
+        self.assertEqual(list(second.get_series("source_pre"))[3],
+                         ["ž", "3", "src"])
+
+    def test_lazy_reads_from_cache(self):
+        cache = SeriesCache(self.cache_dir)
+        eager = self._load(None)
+        lazy = self._load(cache, lazy=True, shuffle_chunk_size=7)
+
+        self.assertIn("source_pre", lazy.series_paths_and_readers)
+        self.assertEqual(list(lazy.get_series("source_pre")),
+                         list(eager.get_series("source_pre")))
+        self.assertEqual(len(lazy), 50)
+
+        lazy.shuffle()
+        for batch in lazy.batch_dataset(8):
+            for src, pre in zip(batch.get_series("source"),
+                                batch.get_series("source_pre")):
+                self.assertEqual(src[::-1], pre)
+
+        subset = lazy.from_offset(45).subset(0, 10)
+        self.assertEqual(list(subset.get_series("source_pre")),
+                         list(eager.get_series("source_pre"))[45:])
+
+    def test_reader_opens_series_once(self):
+        cache = SeriesCache(self.cache_dir)
+        key = cache.series_key([self.source], UtfPlainTextReader,
+                               reverse_tokens)
+        path = cache.store(key, map(reverse_tokens, UtfPlainTextReader(
+            [self.source]))).path
+
+        reader = get_cached_series_reader()
+        self.assertEqual(reader.count_items([path]), 50)
+
+        # the reader does not need the files which are parsed on opening
+        os.remove(os.path.join(path, "tokens.json"))
+        self.assertEqual(list(reader.read_range([path], 48)),
+                         [["ž", "48", "src"], ["ž", "49", "src"]])
+        self.assertEqual(len(list(reader([path]))), 50)
+
+    def test_key_changes(self):
+        cache = SeriesCache(self.cache_dir)
+        key = cache.series_key([self.source], UtfPlainTextReader,
+                               Repeat(2))
+
+        self.assertEqual(key, cache.series_key(
+            [self.source], UtfPlainTextReader, Repeat(2)))
+        self.assertNotEqual(key, cache.series_key(
+            [self.source], UtfPlainTextReader, Repeat(3)))
+        self.assertNotEqual(key, cache.series_key(
+            [self.source], UtfPlainTextReader, reverse_tokens))
+
+        with open(self.source, "a") as f_src:
+            print("another line", file=f_src)
+        self.assertNotEqual(key, cache.series_key(
+            [self.source], UtfPlainTextReader, Repeat(2)))
+
+    def test_arrays(self):
+        cache = SeriesCache(self.cache_dir)
+        arrays = [np.arange(i * 3, dtype=np.float32).reshape([i, 3])
+                  for i in range(5)]
+
+        stored = cache.store("arrays", arrays)
+        self.assertEqual(len(stored), 5)
+        for orig, loaded in zip(arrays, cache.load("arrays")):
+            np.testing.assert_array_equal(orig, loaded)
+
+    def test_uncacheable_items(self):
+        cache = SeriesCache(self.cache_dir)
+        self.assertIsNone(cache.store("dicts", [{"a": 1}]))
+        self.assertIsNone(cache.load("dicts"))
+
+    def test_eviction(self):
+        cache = SeriesCache(self.cache_dir, max_size_mb=1)
+        items = [["x{}".format(i)] * 1000 for i in range(100)]
+
+        cache.store("first", items)
+        os.utime(os.path.join(self.cache_dir, "first", "meta.json"), (0, 0))
+
+        # a series written by another process, but not yet published
+        writing = os.path.join(self.cache_dir, ".tmp-fourth")
+        os.mkdir(writing)
+        with open(os.path.join(writing, "meta.json"), "w") as f_meta:
+            f_meta.write("{}")
+        os.utime(os.path.join(writing, "meta.json"), (0, 0))
+
+        cache.store("second", items)
+        cache.store("third", items)
+
+        self.assertIsNone(cache.load("first"))
+        self.assertIsNotNone(cache.load("third"))
+        self.assertTrue(os.path.isdir(writing))
+
+    def test_concurrent_store(self):
+        cache = SeriesCache(self.cache_dir)
+        items = [["x", str(i)] for i in range(10)]
+
+        def stored_meanwhile():
+            # another process publishes the series while it is written
+            SeriesCache(self.cache_dir).store("series", items)
+            yield from items
+
+        stored = cache.store("series", stored_meanwhile())
+        self.assertEqual(list(stored), items)
+        self.assertEqual(
+            [name for name in os.listdir(self.cache_dir)
+             if name.startswith(".tmp-")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3.5
 
+import os
+import tempfile
 import unittest
 
-from neuralmonkey.vocabulary import Vocabulary
+import numpy as np
+
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.vocabulary import (
+    Vocabulary, from_binary, from_dataset, PAD_TOKEN_INDEX, START_TOKEN_INDEX,
+    END_TOKEN_INDEX, UNK_TOKEN_INDEX)
 
 CORPUS = [
     "the colorless ideas slept furiously",
@@ -46,6 +53,97 @@ class TestVocabulary(unittest.TestCase):
                 zip(TOKENIZED_CORPUS, senteces_again):
             self.assertSequenceEqual(orig_sentence, reconstructed_sentence)
 
+    def test_vectors_to_sentences(self):
+        the = VOCABULARY.get_word_index("the")
+        vectors = [np.array([the, END_TOKEN_INDEX, the]),
+                   np.array([END_TOKEN_INDEX, the, the]),
+                   np.array([the, END_TOKEN_INDEX, the])]
+
+        self.assertEqual(VOCABULARY.vectors_to_sentences(vectors),
+                         [["the"], [], ["the", "the", "the"]])
+
+        ids, lengths = VOCABULARY.vectors_to_sentences(vectors,
+                                                       return_ids=True)
+        np.testing.assert_array_equal(lengths, [1, 0, 3])
+        np.testing.assert_array_equal(ids[2], [the, the, the])
+
+    def test_tensor_padding_and_symbols(self):
+        sentences = [["walrus", "jindrisek"], [], ["the"] * 6]
+        vectors, weights = VOCABULARY.sentences_to_tensor(
+            sentences, 4, pad_to_max_len=False, add_start_symbol=True,
+            add_end_symbol=True)
+
+        walrus = VOCABULARY.get_word_index("walrus")
+        the = VOCABULARY.get_word_index("the")
+        self.assertEqual(vectors.dtype, np.int32)
+        np.testing.assert_array_equal(vectors.T, [
+            [START_TOKEN_INDEX, walrus, UNK_TOKEN_INDEX, END_TOKEN_INDEX,
+             PAD_TOKEN_INDEX],
+            [START_TOKEN_INDEX, END_TOKEN_INDEX] + [PAD_TOKEN_INDEX] * 3,
+            [START_TOKEN_INDEX] + [the] * 4])
+        np.testing.assert_array_equal(weights.T, [
+            [1, 1, 1, 1, 0], [1, 1, 0, 0, 0], [1, 1, 1, 1, 1]])
+
+    def test_ids_to_tensor(self):
+        ids = [np.array([VOCABULARY.get_word_index(w) for w in sent])
+               for sent in TOKENIZED_CORPUS]
+
+        for kwargs in [{"max_len": 20}, {"max_len": 3},
+                       {"pad_to_max_len": False, "add_end_symbol": True,
+                        "add_start_symbol": True}]:
+            from_words = VOCABULARY.sentences_to_tensor(TOKENIZED_CORPUS,
+                                                        **kwargs)
+            from_ids = VOCABULARY.ids_to_tensor(ids, **kwargs)
+            np.testing.assert_array_equal(from_words[0], from_ids[0])
+            np.testing.assert_array_equal(from_words[1], from_ids[1])
+
+    def test_unk_sampling(self):
+        vocabulary = Vocabulary(unk_sample_prob=0.5, random_seed=42)
+        vocabulary.correct_counts = True
+        for sentence in TOKENIZED_CORPUS:
+            vocabulary.add_tokenized_text(sentence)
+
+        tensors = [vocabulary.sentences_to_tensor(
+            TOKENIZED_CORPUS * 20, train_mode=True)[0] for _ in range(2)]
+        vocabulary.set_random_seed(42)
+        np.testing.assert_array_equal(
+            tensors[0], vocabulary.sentences_to_tensor(
+                TOKENIZED_CORPUS * 20, train_mode=True)[0])
+        self.assertFalse(np.array_equal(tensors[0], tensors[1]))
+
+        # only the words seen once are sampled
+        clean = vocabulary.sentences_to_tensor(TOKENIZED_CORPUS * 20)[0]
+        sampled = tensors[0] != clean
+        self.assertTrue(sampled.any())
+        self.assertTrue((tensors[0][sampled] == UNK_TOKEN_INDEX).all())
+        self.assertTrue(vocabulary.singleton_mask[clean[sampled]].all())
+        self.assertNotIn(vocabulary.get_word_index("walrus"), clean[sampled])
+
+        # the counts are updated when the vocabulary changes
+        vocabulary.add_word("walrus", 3)
+        self.assertEqual(
+            vocabulary.count_array[vocabulary.get_word_index("walrus")], 5)
+
+    def test_unk_sampling_global_seed(self):
+        tensors = []
+        for _ in range(2):
+            np.random.seed(42)
+            vocabulary = Vocabulary(unk_sample_prob=0.5)
+            vocabulary.correct_counts = True
+            for sentence in TOKENIZED_CORPUS:
+                vocabulary.add_tokenized_text(sentence)
+            tensors.append(vocabulary.sentences_to_tensor(
+                TOKENIZED_CORPUS * 20, train_mode=True)[0])
+
+        np.testing.assert_array_equal(tensors[0], tensors[1])
+
+        # creating a vocabulary does not use the global generator
+        np.random.seed(42)
+        Vocabulary(unk_sample_prob=0.5)
+        value = np.random.random_sample()
+        np.random.seed(42)
+        self.assertEqual(np.random.random_sample(), value)
+
     def test_min_freq(self):
 
         vocabulary = Vocabulary()
@@ -59,6 +157,63 @@ class TestVocabulary(unittest.TestCase):
         self.assertTrue("walrus" in vocabulary)
         self.assertFalse("colorless" in vocabulary)
 
+    def test_from_dataset(self):
+        dataset = Dataset("corpus", {"text": TOKENIZED_CORPUS * 3}, {})
+
+        for workers in [1, 2]:
+            vocabulary = from_dataset([dataset], ["text"], max_size=9,
+                                      workers=workers, chunk_size=2)
+            # the later words are kept among the words of the same count
+            self.assertEqual(vocabulary.index_to_word[4:], [
+                "the", "slept", "working", "class", "I", "am", "walrus",
+                "for", "president"])
+            self.assertEqual(vocabulary.word_count["the"], 6)
+
+        vocabulary = from_dataset([dataset], ["text"], max_size=100,
+                                  min_freq=4)
+        self.assertEqual(len(vocabulary), 9)
+        self.assertIn("walrus", vocabulary)
+        self.assertNotIn("pooh", vocabulary)
+
+    def test_from_dataset_truncation(self):
+        dataset = Dataset("corpus", {"text": TOKENIZED_CORPUS * 3}, {})
+
+        for max_size, min_freq in [(5, None), (12, None), (12, 4)]:
+            expected = Vocabulary()
+            expected.correct_counts = True
+            for sentence in dataset.get_series("text"):
+                expected.add_tokenized_text(sentence)
+            expected.truncate(max_size)
+            if min_freq is not None:
+                expected.truncate_by_min_freq(min_freq)
+
+            vocabulary = from_dataset([dataset], ["text"], max_size=max_size,
+                                      min_freq=min_freq, chunk_size=3)
+            self.assertEqual(vocabulary.index_to_word,
+                             expected.index_to_word)
+            self.assertEqual(vocabulary.word_count, expected.word_count)
+
+    def test_binary_roundtrip(self):
+        vocabulary = Vocabulary(["ž", "walrus", "walrus"])
+        vocabulary.correct_counts = True
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "vocab.bin")
+            vocabulary.save_binary(path)
+            with self.assertRaises(FileExistsError):
+                vocabulary.save_binary(path)
+
+            loaded = from_binary(path)
+            self.assertEqual(loaded.index_to_word, vocabulary.index_to_word)
+            self.assertEqual(loaded.word_to_index, vocabulary.word_to_index)
+            self.assertEqual(loaded.word_count, vocabulary.word_count)
+            self.assertTrue(loaded.correct_counts)
+            self.assertEqual(loaded.content_hash(), vocabulary.content_hash())
+
+            loaded.add_word("pooh")
+            self.assertNotEqual(loaded.content_hash(),
+                                vocabulary.content_hash())
+
     def test_count_fail(self):
 
         vocabulary = Vocabulary()
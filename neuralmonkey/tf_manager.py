@@ -8,11 +8,14 @@ variables.
 
 """
 # pylint: disable=unused-import
-from typing import Any, List, Union, Optional
+from typing import Any, Iterable, Iterator, List, Set, Tuple, Union, Optional
 # pylint: enable=unused-import
 
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tensorflow as tf
@@ -23,7 +26,8 @@ from typeguard import check_argument_types
 
 from neuralmonkey.logging import log
 from neuralmonkey.dataset import Dataset
-from neuralmonkey.runners.base_runner import (ExecutionResult,
+from neuralmonkey.runners.base_runner import (Executable, ExecutionResult,
+                                              FeedDict,
                                               reduce_execution_results)
 
 
@@ -44,7 +48,10 @@ class TensorFlowManager(object):
                  gpu_allow_growth: bool = True,
                  per_process_gpu_memory_fraction: float = 1.0,
                  report_gpu_memory_consumption: bool = False,
-                 enable_tf_debug: bool = False) -> None:
+                 enable_tf_debug: bool = False,
+                 prefetch_batches: int = 0,
+                 prefetch_workers: int = 1,
+                 parallel_sessions: bool = True) -> None:
         """Initialize a TensorflowManager.
 
         At this moment the graph must already exist. This method initializes
@@ -62,12 +69,41 @@ class TensorFlowManager(object):
             per_process_gpu_memory_fraction: Limit TF memory use.
             report_gpu_memory_consumption: Report overall GPU memory at every
                 logging
+            prefetch_batches: How many batches (and their feed dictionaries)
+                are prepared in advance in background threads while the
+                session is running. Zero disables the prefetching.
+            prefetch_workers: Number of threads preparing the feed
+                dictionaries when prefetching is enabled.
+            parallel_sessions: Run the sessions of an ensemble at the same
+                time in separate threads. The inter-op and intra-op threads
+                are then split among the sessions.
         """
         check_argument_types()
 
+        if prefetch_batches < 0:
+            raise ValueError("prefetch_batches must not be negative")
+        if prefetch_workers < 1:
+            raise ValueError("prefetch_workers must be greater than zero")
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_workers = prefetch_workers
+
+        # wall-clock time the execution spent waiting for the input data
+        self.input_wait_time = 0.0
+        # number of feed dictionaries built by the model parts
+        self.feed_dict_builds = 0
+
+        # the debugger wrapper is interactive, it cannot run in parallel
+        self.parallel_sessions = (parallel_sessions and num_sessions > 1
+                                  and not enable_tf_debug)
+
+        # the parallel sessions would oversubscribe the cores
+        session_threads = num_threads
+        if self.parallel_sessions:
+            session_threads = max(1, num_threads // num_sessions)
+
         session_cfg = tf.ConfigProto()
-        session_cfg.inter_op_parallelism_threads = num_threads
-        session_cfg.intra_op_parallelism_threads = num_threads
+        session_cfg.inter_op_parallelism_threads = session_threads
+        session_cfg.intra_op_parallelism_threads = session_threads
         session_cfg.allow_soft_placement = True  # needed for multiple GPUs
         # pylint: disable=no-member
         session_cfg.gpu_options.allow_growth = gpu_allow_growth
@@ -87,6 +123,12 @@ class TensorFlowManager(object):
             self.sessions = [tf_debug.LocalCLIDebugWrapperSession(sess)
                              for sess in self.sessions]
 
+        # TensorFlow releases the GIL while running the graph
+        self._session_executor = None  # type: Optional[ThreadPoolExecutor]
+        if self.parallel_sessions:
+            self._session_executor = ThreadPoolExecutor(
+                max_workers=num_sessions)
+
         init_op = tf.global_variables_initializer()
         for sess in self.sessions:
             sess.run(init_op)
@@ -109,6 +151,7 @@ class TensorFlowManager(object):
 
         self.variables_files = []  # type: List[str]
         self.best_vars_file = None  # type: str
+        self.averaged_vars_file = None  # type: str
 
     # pylint: enable=too-many-arguments
 
@@ -138,6 +181,7 @@ class TensorFlowManager(object):
                                     for i in range(self.saver_max_to_keep)]
 
         self.best_vars_file = "{}.best".format(vars_prefix)
+        self.averaged_vars_file = "{}.avg".format(vars_prefix)
         self._update_best_vars(var_index=0)
 
     def validation_hook(self, score: float, epoch: int, batch: int) -> None:
@@ -178,50 +222,42 @@ class TensorFlowManager(object):
         batched_dataset = dataset.batch_dataset(batch_size)
         last_log_time = time.process_time()
 
+        script_coders = set.union(
+            *[s.all_coders for s in execution_scripts])  # type: Set[Any]
+        if self.prefetch_batches > 0:
+            prefetched = _prefetch_feed_dicts(
+                batched_dataset, script_coders, train,
+                self.prefetch_batches, self.prefetch_workers)
+        else:
+            prefetched = ((batch, None) for batch in batched_dataset)
+
         batch_results = [
             [] for _ in execution_scripts]  # type: List[List[ExecutionResult]]
-        for batch_id, batch in enumerate(batched_dataset):
-            if (time.process_time() - last_log_time > log_progress
-                    and log_progress > 0):
-                log("Processed {} examples.".format(batch_id * batch_size))
-                last_log_time = time.process_time()
-            executables = [s.get_executable(compute_losses=compute_losses,
-                                            summaries=summaries)
-                           for s in execution_scripts]
-            while not all(ex.result is not None for ex in executables):
-                all_feedables = set()   # type: Set[Any]
-                # type: Dict[Executable, tf.Tensor]
-                all_tensors_to_execute = {}
-                additional_feed_dicts = []
-                tensor_list_lengths = []  # type: List[int]
-
-                for executable in executables:
-                    if executable.result is None:
-                        (feedables,
-                         tensors_to_execute,
-                         add_feed_dict) = executable.next_to_execute()
-                        all_feedables = all_feedables.union(feedables)
-                        all_tensors_to_execute[executable] = tensors_to_execute
-                        additional_feed_dicts.append(add_feed_dict)
-                        tensor_list_lengths.append(len(tensors_to_execute))
-                    else:
-                        tensor_list_lengths.append(0)
-
-                feed_dict = _feed_dicts(batch, all_feedables, train=train)
-                for fdict in additional_feed_dicts:
-                    feed_dict.update(fdict)
-
-                session_results = [sess.run(all_tensors_to_execute,
-                                            feed_dict=feed_dict)
-                                   for sess in self.sessions]
-
-                for executable in executables:
-                    if executable.result is None:
-                        executable.collect_results(
-                            [res[executable] for res in session_results])
-
-            for script_list, executable in zip(batch_results, executables):
-                script_list.append(executable.result)
+        try:
+            for batch_id, (batch, batch_feed_dict) in enumerate(
+                    self._timed_input(prefetched)):
+                if (time.process_time() - last_log_time > log_progress
+                        and log_progress > 0):
+                    log("Processed {} examples.".format(batch_id * batch_size))
+                    last_log_time = time.process_time()
+                executables = [s.get_executable(compute_losses=compute_losses,
+                                                summaries=summaries)
+                               for s in execution_scripts]
+
+                if batch_feed_dict is None:
+                    fed_coders = set()  # type: Set[Any]
+                else:
+                    fed_coders = script_coders
+                    self.feed_dict_builds += len(script_coders)
+
+                self._run_executables(batch, batch_feed_dict, fed_coders,
+                                      executables, train)
+
+                for script_list, executable in zip(batch_results,
+                                                   executables):
+                    script_list.append(executable.result)
+        finally:
+            prefetched.close()
 
         collected_results = []  # type: List[ExecutionResult]
         for result_list in batch_results:
@@ -229,6 +265,99 @@ class TensorFlowManager(object):
 
         return collected_results
 
+    def _timed_input(self, batches: Iterable[Any]) -> Iterator[Any]:
+        """Iterate over the batches and measure the time spent waiting."""
+        iterator = iter(batches)
+        while True:
+            wait_start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.input_wait_time += time.time() - wait_start
+            yield item
+
+    # pylint: disable=too-many-arguments
+    def _run_executables(self, batch: Dataset,
+                         batch_feed_dict: Optional[FeedDict],
+                         fed_coders: Set[Any],
+                         executables: List[Executable],
+                         train: bool) -> None:
+        """Run the executables on a single batch until they have results.
+
+        The feed dictionaries of the model parts do not change while the
+        batch is processed, so each of them is built only once and reused in
+        all the session runs. The executables only supply the additional
+        feeds of the individual steps.
+
+        Arguments:
+            batch: The batch the executables are run on.
+            batch_feed_dict: Prefetched feed dictionary of the batch, if
+                available.
+            fed_coders: The model parts already in the prefetched feed
+                dictionary.
+            executables: The executables to be run.
+            train: Flag whether this is a training run.
+        """
+        feed_dict = dict(batch_feed_dict or {})  # type: FeedDict
+        fed_coders = set(fed_coders)
+
+        while not all(ex.result is not None for ex in executables):
+            all_feedables = set()   # type: Set[Any]
+            # type: Dict[Executable, tf.Tensor]
+            all_tensors_to_execute = {}
+            additional_feed_dicts = []
+            tensor_list_lengths = []  # type: List[int]
+
+            for executable in executables:
+                if executable.result is None:
+                    (feedables,
+                     tensors_to_execute,
+                     add_feed_dict) = executable.next_to_execute()
+                    all_feedables = all_feedables.union(feedables)
+                    all_tensors_to_execute[executable] = tensors_to_execute
+                    additional_feed_dicts.append(add_feed_dict)
+                    tensor_list_lengths.append(len(tensors_to_execute))
+                else:
+                    tensor_list_lengths.append(0)
+
+            missing_coders = all_feedables - fed_coders
+            if missing_coders:
+                feed_start = time.time()
+                feed_dict.update(_feed_dicts(batch, missing_coders,
+                                             train=train))
+                self.input_wait_time += time.time() - feed_start
+                self.feed_dict_builds += len(missing_coders)
+                fed_coders.update(missing_coders)
+
+            session_feed_dicts = _session_feed_dicts(
+                feed_dict, additional_feed_dicts, len(self.sessions))
+
+            session_results = self._run_sessions(all_tensors_to_execute,
+                                                 session_feed_dicts)
+
+            for executable in executables:
+                if executable.result is None:
+                    executable.collect_results(
+                        [res[executable] for res in session_results])
+    # pylint: enable=too-many-arguments
+
+    def _run_sessions(self, fetches: Any,
+                      session_feed_dicts: List[FeedDict]) -> List[Any]:
+        """Run all the sessions, in parallel if enabled.
+
+        Returns:
+            The results of the sessions in the order of the sessions.
+        """
+        if self._session_executor is None:
+            return [sess.run(fetches, feed_dict=feed_dict)
+                    for sess, feed_dict in zip(self.sessions,
+                                               session_feed_dicts)]
+
+        return list(self._session_executor.map(
+            lambda sess, feed_dict: sess.run(fetches, feed_dict=feed_dict),
+            self.sessions, session_feed_dicts))
+
     def save(self, variable_files: Union[str, List[str]]) -> None:
         if isinstance(variable_files, str) and len(self.sessions) == 1:
             self.saver.save(self.sessions[0], variable_files)
@@ -258,10 +387,36 @@ class TensorFlowManager(object):
             log("Loading variables from {}".format(file_name))
             self.saver.restore(sess, file_name)
 
+    def close(self) -> None:
+        """Close the sessions and stop the threads running them."""
+        if self._session_executor is not None:
+            self._session_executor.shutdown()
+            self._session_executor = None
+
+        for sess in self.sessions:
+            sess.close()
+
     def restore_best_vars(self) -> None:
         # TODO warn when link does not exist
         self.restore(self.variables_files[self.best_score_index])
 
+    def best_variables_files(self, n: int) -> List[str]:
+        """Get the variables files of the best models saved so far.
+
+        Arguments:
+            n: Maximum number of the returned files.
+
+        Returns:
+            The saved variables files sorted from the best one.
+        """
+        init_score = np.inf if self.minimize_metric else -np.inf
+        order = np.argsort(self.saved_scores)
+        if not self.minimize_metric:
+            order = order[::-1]
+
+        return [self.variables_files[i] for i in order[:n]
+                if self.saved_scores[i] != init_score]
+
     def initialize_model_parts(self, runners, save=False) -> None:
         """Initialize model parts variables from their checkpoints."""
 
@@ -285,3 +440,95 @@ def _feed_dicts(dataset, coders, train=False):
         res.update(coder.feed_dict(dataset, train=train))
 
     return res
+
+
+def _session_feed_dicts(
+        feed_dict: FeedDict,
+        additional_feed_dicts: List[Union[FeedDict, List[FeedDict]]],
+        num_sessions: int) -> List[FeedDict]:
+    """Add the feeds of the executables to the feed dictionary of the batch.
+
+    The executables may feed each of the sessions differently. The feed
+    dictionary of the batch is not modified.
+    """
+    if not any(additional_feed_dicts):
+        return [feed_dict] * num_sessions
+
+    session_feed_dicts = [dict(feed_dict) for _ in range(num_sessions)]
+    for fdict in additional_feed_dicts:
+        if not isinstance(fdict, list):
+            fdict = [fdict] * num_sessions
+        for sess_feed_dict, sess_fdict in zip(session_feed_dicts, fdict):
+            sess_feed_dict.update(sess_fdict)
+
+    return session_feed_dicts
+
+
+# pylint: disable=too-many-arguments
+def _prefetch_feed_dicts(
+        batches: Iterable[Dataset],
+        coders: Set[Any],
+        train: bool,
+        queue_size: int,
+        workers: int) -> Iterator[Tuple[Dataset, FeedDict]]:
+    """Prepare the batches and their feed dictionaries in the background.
+
+    A producer thread pulls the batches from the batched dataset and submits
+    the feed dictionary construction to a pool of worker threads. At most
+    ``queue_size`` batches are prepared ahead of the consumer. The batches are
+    always yielded in the original order, regardless of the number of workers.
+
+    Arguments:
+        batches: The batched dataset.
+        coders: The model parts that feed the data.
+        train: Flag whether this is a training run.
+        queue_size: Maximum number of batches prepared in advance.
+        workers: Number of threads building the feed dictionaries.
+
+    Returns:
+        Generator yielding tuples of a batch and its feed dictionary.
+    """
+    prefetched = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                prefetched.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        # pylint: disable=broad-except
+        try:
+            for batch in batches:
+                if not put((batch, executor.submit(
+                        _feed_dicts, batch, coders, train=train))):
+                    return
+            put(None)
+        except Exception as exc:
+            put(exc)
+
+    producer = threading.Thread(target=produce, name="batch-prefetch",
+                                daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = prefetched.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            batch, future = item
+            yield batch, future.result()
+    finally:
+        # also reached on KeyboardInterrupt or when the consumer stops early
+        stop.set()
+        producer.join()
+        executor.shutdown(wait=True)
+# pylint: enable=too-many-arguments
@@ -45,6 +45,8 @@ def create_config() -> Configuration:
                         required=False, default=15)
     config.add_argument('train_start_offset', required=False, default=0)
     config.add_argument('runners_batch_size', required=False, default=None)
+    config.add_argument('batching_scheme', required=False, default=None)
+    config.add_argument('average_n_best', required=False, default=0)
     config.add_argument('postprocess')
     config.add_argument('name')
     config.add_argument('random_seed', required=False)
@@ -225,4 +227,8 @@ def main() -> None:
         postprocess=cfg.model.postprocess,
         train_start_offset=cfg.model.train_start_offset,
         runners_batch_size=cfg.model.runners_batch_size,
-        initial_variables=cfg.model.initial_variables)
+        initial_variables=cfg.model.initial_variables,
+        batching_scheme=cfg.model.batching_scheme,
+        average_n_best=cfg.model.average_n_best)
+
+    cfg.model.tf_manager.close()
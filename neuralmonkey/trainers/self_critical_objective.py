@@ -69,9 +69,9 @@ def self_critical_objective(decoder: Decoder,
     check_argument_types()
 
     # logits, shape (time, batch, vocab)
-    train_logits = tf.stack(decoder.train_logits)
-    runtime_logits = tf.stack(decoder.runtime_logits)
-    runtime_mask = tf.stack(decoder.runtime_mask)
+    train_logits = decoder.train_logits
+    runtime_logits = decoder.runtime_logits
+    runtime_mask = decoder.runtime_mask
 
     # decoded, shape (time, batch)
     train_decoded = tf.argmax(train_logits, axis=2)
@@ -4,16 +4,20 @@ can be used to obtain a Vocabulary instance.
 # pylint: disable=too-many-lines
 
 import collections
+import hashlib
+import itertools
+import json
 import os
-import random
+import struct
 
-from typing import List, Optional, Tuple
+from typing import Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 from typeguard import check_argument_types
 
 from neuralmonkey.logging import log, warn
-from neuralmonkey.dataset import Dataset, LazyDataset
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.processors.parallel import DEFAULT_CHUNK_SIZE, parallel_map
 
 PAD_TOKEN = "<pad>"
 START_TOKEN = "<s>"
@@ -27,6 +31,13 @@ START_TOKEN_INDEX = 1
 END_TOKEN_INDEX = 2
 UNK_TOKEN_INDEX = 3
 
+BINARY_MAGIC = b"NMVOCABL"
+BINARY_FORMAT_VERSION = 1
+
+# magic, version, header length
+_BINARY_PREFIX = struct.Struct("<8sII")
+_BINARY_ALIGNMENT = 8
+
 
 def _is_special_token(word: str) -> bool:
     """Check whether word is a special token (such as <pad> or <s>).
@@ -43,6 +54,20 @@ def _is_special_token(word: str) -> bool:
             or word == UNK_TOKEN)
 
 
+def is_encoded_series(sentences: List) -> bool:
+    """Check whether sentences are already encoded as arrays of indices.
+
+    Arguments:
+        sentences: List of sentences, either as lists of tokens or as numpy
+            arrays of vocabulary indices.
+
+    Returns:
+        True if the sentences are given as integer numpy arrays.
+    """
+    return (bool(sentences) and isinstance(sentences[0], np.ndarray)
+            and np.issubdtype(sentences[0].dtype, np.integer))
+
+
 # pylint: disable=unused-argument
 def from_file(*args, **kwargs) -> 'Vocabulary':
     raise NotImplementedError("Use loading by from_wordlist")
@@ -95,14 +120,43 @@ def from_wordlist(path: str,
     return vocabulary
 
 
-# pylint: disable=too-many-arguments
+class _OrderedCounter(collections.Counter, collections.OrderedDict):
+    """Counter which remembers the order of the first occurrences."""
+
+    def __reduce__(self):
+        return self.__class__, (collections.OrderedDict(self),)
+
+
+def _count_tokens(sentences: Iterable[List[str]]) -> _OrderedCounter:
+    """Count the tokens in a chunk of sentences."""
+    counter = _OrderedCounter()
+    for sentence in sentences:
+        counter.update(sentence)
+    return counter
+
+
+def _chunks(series: Iterable, chunk_size: int) -> Iterable[List]:
+    iterator = iter(series)
+    return iter(lambda: list(itertools.islice(iterator, chunk_size)), [])
+
+
+# pylint: disable=too-many-arguments,too-many-locals
 # helper function, this number of parameters is needed
 def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
                  save_file: str = None, overwrite: bool = False,
                  min_freq: Optional[int] = None,
-                 unk_sample_prob: float = 0.5) -> 'Vocabulary':
+                 unk_sample_prob: float = 0.5,
+                 random_seed: Optional[int] = None,
+                 workers: int = 1,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'Vocabulary':
     """Loads vocabulary from a dataset with an option to save it.
 
+    The series are streamed in chunks of sentences, the tokens of each chunk
+    are counted (possibly in worker processes) and the counts are merged.
+    The memory needed therefore does not depend on the size of the data,
+    so the vocabulary can be built from lazy datasets as well. The words are
+    selected by ``Vocabulary.truncate`` and ``truncate_by_min_freq``.
+
     Arguments:
         datasets: A list of datasets from which to create the vocabulary
         series_ids: A list of ids of series of the datasets that should be used
@@ -114,34 +168,43 @@ def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
         min_freq: Do not include words with frequency smaller than this.
         unk_sample_prob: The probability with which to sample unks out of
                          words with frequency 1. Defaults to 0.5.
+        random_seed: Seed of the random generator for the unk sampling.
+        workers: Number of processes counting the tokens.
+        chunk_size: Number of sentences counted at once by a process.
 
     Returns:
         The new Vocabulary instance.
     """
     check_argument_types()
 
-    vocabulary = Vocabulary(unk_sample_prob=unk_sample_prob)
-    vocabulary.correct_counts = True
-
+    counts = _OrderedCounter()
     for dataset in datasets:
-        if isinstance(dataset, LazyDataset):
-            warn("Inferring vocabulary from lazy dataset!")
-
         for series_id in series_ids:
             if not dataset.has_series(series_id):
                 warn("Data series '{}' not present in the dataset"
                      .format(series_id))
 
             series = dataset.get_series(series_id, allow_none=True)
-            if series:
-                vocabulary.add_tokenized_text(
-                    [token for sent in series for token in sent])
+            if series is None:
+                continue
+
+            for chunk_counts in parallel_map(
+                    _count_tokens, _chunks(series, chunk_size), workers,
+                    chunk_size=1):
+                counts.update(chunk_counts)
+
+    vocabulary = Vocabulary(unk_sample_prob=unk_sample_prob,
+                            random_seed=random_seed)
+    vocabulary.correct_counts = True
+
+    # the words are added in the order of their first occurrences
+    for word, count in counts.items():
+        vocabulary.add_word(word, count)
 
     vocabulary.truncate(max_size)
 
     if min_freq is not None:
-        if min_freq > 1:
-            vocabulary.truncate_by_min_freq(min_freq)
+        vocabulary.truncate_by_min_freq(min_freq)
 
     log("Vocabulary for series {} initialized, containing {} words"
         .format(series_ids, len(vocabulary)))
@@ -157,6 +220,64 @@ def from_dataset(datasets: List[Dataset], series_ids: List[str], max_size: int,
     return vocabulary
 
 
+def from_binary(path: str) -> 'Vocabulary':
+    """Load a vocabulary saved in the binary format.
+
+    The arrays of the file are memory-mapped and the words are decoded at
+    once, so loading takes a fraction of the time needed to parse a wordlist
+    of the same size. The binary vocabulary is created by the
+    ``Vocabulary.save_binary`` method.
+
+    Arguments:
+        path: The path to the binary vocabulary file.
+
+    Returns:
+        The new Vocabulary instance.
+    """
+    with open(path, "rb") as f_vocab:
+        magic, version, header_len = _BINARY_PREFIX.unpack(
+            f_vocab.read(_BINARY_PREFIX.size))
+        if magic != BINARY_MAGIC:
+            raise ValueError(
+                "File {} is not a binary vocabulary.".format(path))
+        if version != BINARY_FORMAT_VERSION:
+            raise ValueError(
+                "Unsupported version {} of binary vocabulary {}.".format(
+                    version, path))
+        header = json.loads(f_vocab.read(header_len).decode("utf-8"))
+
+    size = header["words"]
+    counts_start = _binary_aligned(_BINARY_PREFIX.size + header_len)
+    words_start = counts_start + 8 * size
+
+    counts = np.memmap(path, dtype=np.int64, mode="r", offset=counts_start,
+                       shape=(size,))
+    words_blob = np.memmap(path, dtype=np.uint8, mode="r",
+                           offset=words_start, shape=(header["bytes"],))
+    words = words_blob.tobytes().decode("utf-8").split("\x00")
+
+    if words[:len(_SPECIAL_TOKENS)] != _SPECIAL_TOKENS:
+        raise ValueError("Binary vocabulary {} does not start with the "
+                         "special tokens.".format(path))
+
+    vocabulary = Vocabulary()
+    vocabulary.index_to_word = words
+    vocabulary.word_to_index = dict(zip(words, range(size)))
+    vocabulary.word_count = dict(zip(words, counts.tolist()))
+    vocabulary.correct_counts = header["correct_counts"]
+    # pylint: disable=protected-access
+    vocabulary._count_array = counts
+    vocabulary._content_hash = header["content_hash"]
+    # pylint: enable=protected-access
+
+    log("Binary vocabulary loaded, containing {} words".format(size))
+    return vocabulary
+
+
+def _binary_aligned(position: int) -> int:
+    return -(-position // _BINARY_ALIGNMENT) * _BINARY_ALIGNMENT
+
+
 def from_bpe(path: str, encoding: str = "utf-8") -> 'Vocabulary':
     """Loads vocabulary from Byte-pair encoding merge list.
 
@@ -237,14 +358,38 @@ def initialize_vocabulary(directory: str, name: str,
                         save_file=file_name, overwrite=False)
 
 
+def _batch_max_len(lengths: List[int], max_len: Optional[int],
+                   pad_to_max_len: bool, add_end_symbol: bool) -> int:
+    """Compute the length of the tensor representing a batch of sentences.
+
+    See ``Vocabulary.sentences_to_tensor`` for the meaning of the arguments.
+    """
+    if pad_to_max_len and max_len is not None:
+        return max_len
+
+    batch_max_len = max(lengths)
+    if add_end_symbol:
+        batch_max_len += 1
+    if max_len is not None:
+        batch_max_len = min(max_len, batch_max_len)
+    return batch_max_len
+
+
 class Vocabulary(collections.Sized):
 
     def __init__(self, tokenized_text: List[str] = None,
-                 unk_sample_prob: float = 0.0) -> None:
+                 unk_sample_prob: float = 0.0,
+                 random_seed: Optional[int] = None) -> None:
         """Create a new instance of a vocabulary.
 
         Arguments:
             tokenized_text: The initial list of words to add.
+            unk_sample_prob: The probability with which the words seen only
+                once are replaced by the unknown token in train mode.
+            random_seed: Seed of the random generator used for the sampling
+                of unknown words. If None, the seed is drawn from the global
+                numpy random generator at the first sampling, so the sampling
+                is reproducible when the experiment sets its random seed.
         """
         self.word_to_index = {}  # type: Dict[str, int]
         self.index_to_word = []  # type: List[str]
@@ -254,6 +399,15 @@ class Vocabulary(collections.Sized):
         self.correct_counts = False
 
         self.unk_sample_prob = unk_sample_prob
+        self._random_seed = random_seed
+        # the generator of the unk sampling, created on the first sampling
+        self._random = None  # type: Optional[np.random.Generator]
+
+        # counts and singleton flags indexed by word ids, built on demand
+        self._count_array = None  # type: Optional[np.ndarray]
+        self._singleton_mask = None  # type: Optional[np.ndarray]
+        self._word_array = None  # type: Optional[np.ndarray]
+        self._content_hash = None  # type: Optional[str]
 
         self.add_word(PAD_TOKEN)
         self.add_word(START_TOKEN)
@@ -282,6 +436,31 @@ class Vocabulary(collections.Sized):
         """
         return word in self.word_to_index
 
+    def content_hash(self) -> str:
+        """Compute a hash of the words of the vocabulary and their indices.
+
+        The hash identifies the mapping between the words and the indices,
+        e.g. for checking that a corpus encoded to indices matches the
+        vocabulary. The word counts do not affect the hash.
+
+        Returns:
+            Hexadecimal digest of the vocabulary.
+        """
+        if self._content_hash is None:
+            hasher = hashlib.sha1()
+            for word in self.index_to_word:
+                hasher.update(word.encode("utf-8"))
+                hasher.update(b"\x00")
+            self._content_hash = hasher.hexdigest()
+        return self._content_hash
+
+    def _invalidate_caches(self) -> None:
+        """Discard the values derived from the words and their counts."""
+        self._count_array = None
+        self._singleton_mask = None
+        self._word_array = None
+        self._content_hash = None
+
     def add_word(self, word: str, occurences: int = 1) -> None:
         """Add a word to the vocablulary.
 
@@ -294,6 +473,7 @@ class Vocabulary(collections.Sized):
             self.index_to_word.append(word)
             self.word_count[word] = 0
         self.word_count[word] += occurences
+        self._invalidate_caches()
 
     def add_tokenized_text(self, tokenized_text: List[str]) -> None:
         """Add words from a list to the vocabulary.
@@ -336,7 +516,8 @@ class Vocabulary(collections.Sized):
         idx = self.word_to_index.get(word, self.get_word_index(UNK_TOKEN))
         freq = self.word_count.get(word, 0)
 
-        if freq <= 1 and random.random() < self.unk_sample_prob:
+        if (freq <= 1 and self.unk_sample_prob > 0
+                and self._generator().random() < self.unk_sample_prob):
             if not self.correct_counts:
                 raise ValueError("The vocabulary does not have correct "
                                  "word_counts to use with unknown sampling")
@@ -344,6 +525,75 @@ class Vocabulary(collections.Sized):
 
         return idx
 
+    def set_random_seed(self, seed: Optional[int]) -> None:
+        """Reseed the random generator used for unknown word sampling.
+
+        Arguments:
+            seed: The new seed. If None, the seed is drawn from the global
+                numpy random generator at the next sampling.
+        """
+        self._random_seed = seed
+        self._random = None
+
+    def _generator(self) -> np.random.Generator:
+        """Get the random generator of the unk sampling.
+
+        The generator is created on the first sampling. Without an explicit
+        seed, its seed is drawn from the global numpy random generator at
+        that time, so creating a vocabulary does not shift the global random
+        stream.
+        """
+        if self._random is None:
+            seed = self._random_seed
+            if seed is None:
+                seed = np.random.randint(2**31)
+            self._random = np.random.default_rng(seed)
+        return self._random
+
+    @property
+    def count_array(self) -> np.ndarray:
+        """Get the word counts as an array indexed by the word ids."""
+        if self._count_array is None:
+            self._count_array = np.fromiter(
+                (self.word_count[w] for w in self.index_to_word),
+                dtype=np.int64, count=len(self.index_to_word))
+        return self._count_array
+
+    @property
+    def singleton_mask(self) -> np.ndarray:
+        """Get the flags of words seen at most once indexed by the word ids.
+        """
+        if self._singleton_mask is None:
+            self._singleton_mask = self.count_array <= 1
+        return self._singleton_mask
+
+    def sample_unknown_words(self, ids: np.ndarray) -> np.ndarray:
+        """Replace words seen only once by the unknown token at random.
+
+        Each index of a word whose count is at most one is replaced by the
+        index of the unknown token with the probability of
+        ``unk_sample_prob``. This is the vectorized equivalent of calling
+        ``get_unk_sampled_word_index`` on every word.
+
+        Arguments:
+            ids: Array of word indices of any shape, modified in place.
+
+        Returns:
+            The array of the indices with the sampled unknown words.
+        """
+        if self.unk_sample_prob <= 0 or ids.size == 0:
+            return ids
+
+        sampled = self.singleton_mask[ids]
+        sampled &= (self._generator().random(ids.shape)
+                    < self.unk_sample_prob)
+        if not self.correct_counts and sampled.any():
+            raise ValueError("The vocabulary does not have correct "
+                             "word_counts to use with unknown sampling")
+
+        ids[sampled] = UNK_TOKEN_INDEX
+        return ids
+
     def truncate(self, size: int) -> None:
         """Truncate the vocabulary to the requested size by discarding
         infrequent tokens.
@@ -361,23 +611,20 @@ class Vocabulary(collections.Sized):
                                key=lambda w: self.word_count[w])
 
         # keep the least frequent words which are not special symbols
-        words_to_delete = [w for w in words_by_freq[:-size]
-                           if not _is_special_token(w)]
+        words_to_delete = set(w for w in words_by_freq[:-size]
+                              if not _is_special_token(w))
 
-        # sort by index ... bigger indices needs to be removed first
-        # to keep the lists propertly shaped
-        delete_words_by_index = sorted(
-            [(w, self.word_to_index[w]) for w in words_to_delete],
-            key=lambda p: -p[1])
-
-        for word, index in delete_words_by_index:
+        for word in words_to_delete:
             del self.word_count[word]
-            del self.index_to_word[index]
+        self.index_to_word = [w for w in self.index_to_word
+                              if w not in words_to_delete]
 
         self.word_to_index = {}
         for index, word in enumerate(self.index_to_word):
             self.word_to_index[word] = index
 
+        self._invalidate_caches()
+
     def truncate_by_min_freq(self, min_freq: int) -> None:
         """Truncate the vocabulary only keeping words with a minimum frequency.
 
@@ -435,58 +682,151 @@ class Vocabulary(collections.Sized):
             The shape of the padding vector is the same as of the sentence
             vector.
         """
-        if pad_to_max_len and max_len is not None:
-            batch_max_len = max_len
-        else:
-            batch_max_len = max(len(s) for s in sentences)
-            if add_end_symbol:
-                batch_max_len += 1
-            if max_len is not None:
-                batch_max_len = min(max_len, batch_max_len)
+        batch_max_len = _batch_max_len(
+            [len(s) for s in sentences], max_len, pad_to_max_len,
+            add_end_symbol)
+
+        # every sentence is truncated and mapped to indices only once
+        truncated = [s[:batch_max_len] for s in sentences]
+        word_to_index = self.word_to_index
+        unk_index = self.get_word_index(UNK_TOKEN)
+        ids = (word_to_index.get(word, unk_index)
+               for sent in truncated for word in sent)
+
+        flat_ids = np.fromiter(ids, dtype=np.int32,
+                               count=sum(len(s) for s in truncated))
+        if train_mode:
+            self.sample_unknown_words(flat_ids)
+
+        return self._fill_tensor(
+            flat_ids, np.array([len(s) for s in sentences], dtype=np.int64),
+            batch_max_len, add_start_symbol, add_end_symbol)
+
+    def ids_to_tensor(
+            self,
+            sentences: List[np.ndarray],
+            max_len: int = None,
+            pad_to_max_len: bool = True,
+            train_mode: bool = False,
+            add_start_symbol: bool = False,
+            add_end_symbol: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Generate the tensor representation for already encoded sentences.
+
+        This is the batch API equivalent to ``sentences_to_tensor`` for
+        sentences given as arrays of vocabulary indices (e.g. read from a
+        compiled corpus), which skips looking up the words in the vocabulary.
+
+        Arguments:
+            sentences: List of sentences as arrays of token indices.
+            max_len: See ``sentences_to_tensor``.
+            pad_to_max_len: See ``sentences_to_tensor``.
+            train_mode: See ``sentences_to_tensor``.
+            add_start_symbol: See ``sentences_to_tensor``.
+            add_end_symbol: See ``sentences_to_tensor``.
+
+        Returns:
+            A tuple of a sentence tensor and a padding weight vector of the
+            same shapes as returned by ``sentences_to_tensor``.
+        """
+        batch_max_len = _batch_max_len(
+            [len(s) for s in sentences], max_len, pad_to_max_len,
+            add_end_symbol)
+
+        truncated = [np.asarray(s[:batch_max_len], dtype=np.int32)
+                     for s in sentences]
+        flat_ids = (np.concatenate(truncated) if truncated
+                    else np.zeros([0], dtype=np.int32))
+
+        if train_mode:
+            self.sample_unknown_words(flat_ids)
+
+        return self._fill_tensor(
+            flat_ids, np.array([len(s) for s in sentences], dtype=np.int64),
+            batch_max_len, add_start_symbol, add_end_symbol)
+
+    def _fill_tensor(self, flat_ids: np.ndarray, lengths: np.ndarray,
+                     batch_max_len: int, add_start_symbol: bool,
+                     add_end_symbol: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """Fill the time-major index matrix and the weights of a batch.
+
+        Arguments:
+            flat_ids: Concatenated indices of the sentences truncated to
+                ``batch_max_len``.
+            lengths: The original (not truncated) lengths of the sentences.
+            batch_max_len: The length of the tensor without the start symbol.
+            add_start_symbol: Whether to prepend the start symbol.
+            add_end_symbol: Whether to append the end symbol to the sentences
+                shorter than ``batch_max_len``.
+
+        Returns:
+            A tuple of the index matrix and the weights.
+        """
+        batch_size = len(lengths)
+        offset = 1 if add_start_symbol else 0
 
         word_indices = np.full(
-            [batch_max_len, len(sentences)], self.get_word_index(PAD_TOKEN),
-            dtype=np.int32)
-        weights = np.zeros([batch_max_len, len(sentences)])
-
-        for i in range(batch_max_len):
-            for j, sent in enumerate(sentences):
-                if i < len(sent):
-                    w_idx = (self.get_unk_sampled_word_index(sent[i])
-                             if train_mode else self.get_word_index(sent[i]))
-                    word_indices[i, j] = w_idx
-                    weights[i, j] = 1
-
-                elif i == len(sent) and add_end_symbol:
-                    word_indices[i, j] = self.get_word_index(END_TOKEN)
-                    weights[i, j] = 1
+            [batch_max_len + offset, batch_size],
+            self.get_word_index(PAD_TOKEN), dtype=np.int32)
+        weights = np.zeros([batch_max_len + offset, batch_size])
+
+        # time step and sentence index of every token in the flat array
+        truncated_lengths = np.minimum(lengths, batch_max_len)
+        columns = np.repeat(np.arange(batch_size), truncated_lengths)
+        starts = np.cumsum(truncated_lengths) - truncated_lengths
+        rows = (np.arange(len(flat_ids))
+                - np.repeat(starts, truncated_lengths) + offset)
+
+        word_indices[rows, columns] = flat_ids
+        weights[rows, columns] = 1
+
+        if add_end_symbol:
+            ended = np.flatnonzero(lengths < batch_max_len)
+            word_indices[lengths[ended] + offset, ended] = (
+                self.get_word_index(END_TOKEN))
+            weights[lengths[ended] + offset, ended] = 1
 
         if add_start_symbol:
-            word_indices = np.insert(word_indices, 0,
-                                     self.get_word_index(START_TOKEN), axis=0)
-            weights = np.insert(weights, 0, 1, axis=0)
+            word_indices[0] = self.get_word_index(START_TOKEN)
+            weights[0] = 1
 
         return word_indices, weights
 
-    def vectors_to_sentences(self,
-                             vectors: List[np.ndarray]) -> List[List[str]]:
+    def vectors_to_sentences(
+            self, vectors: Union[List[np.ndarray], np.ndarray],
+            return_ids: bool = False
+    ) -> Union[List[List[str]], Tuple[np.ndarray, np.ndarray]]:
         """Convert vectors of indexes of vocabulary items to lists of words.
 
+        The sentences end before the first end token, or at the end of the
+        vectors if they do not contain it.
+
         Arguments:
-            vectors: List of vectors of vocabulary indices.
+            vectors: Time-major list of vectors of vocabulary indices.
+            return_ids: If True, return the indices instead of the words.
 
         Returns:
-            List of lists of words.
+            List of lists of words, or if ``return_ids`` is set, a tuple of a
+            batch-major matrix of the indices and a vector of the lengths of
+            the sentences.
         """
-        sentences = [[] for _ in range(vectors[0].shape[0])]
-        # type: List[List[str]]
+        ids = np.asarray(vectors)
+        ended = ids == END_TOKEN_INDEX
+        lengths = np.where(ended.any(axis=0), ended.argmax(axis=0),
+                           ids.shape[0])
 
-        for vec in vectors:
-            for sentence, word_i in zip(sentences, vec):
-                if not sentence or sentence[-1] != END_TOKEN:
-                    sentence.append(self.index_to_word[word_i])
+        if return_ids:
+            return ids.T, lengths
 
-        return [s[:-1] if s[-1] == END_TOKEN else s for s in sentences]
+        words = self.word_array[ids.T]
+        return [row[:length].tolist()
+                for row, length in zip(words, lengths.tolist())]
+
+    @property
+    def word_array(self) -> np.ndarray:
+        """Get the words in an object array indexed by the word ids."""
+        if self._word_array is None:
+            self._word_array = np.array(self.index_to_word, dtype=object)
+        return self._word_array
 
     def save_wordlist(self, path: str, overwrite: bool = False,
                       save_frequencies: bool = False,
@@ -529,6 +869,43 @@ class Vocabulary(collections.Sized):
 
                 output_file.write("\n")
 
+    def save_binary(self, path: str, overwrite: bool = False) -> None:
+        """Save the vocabulary in the binary format.
+
+        The file stores the content hash of the vocabulary, the word counts
+        and the table of the words, and can be loaded by ``from_binary``.
+
+        Arguments:
+            path: The path to save the file to.
+            overwrite: Flag whether to overwrite existing file.
+
+        Raises:
+            FileExistsError if the file exists and overwrite flag is
+            disabled.
+        """
+        if os.path.exists(path) and not overwrite:
+            raise FileExistsError("Cannot save vocabulary: File exists and "
+                                  "overwrite is disabled. {}".format(path))
+
+        if any("\x00" in word for word in self.index_to_word):
+            raise ValueError("Words with a null character cannot be saved "
+                             "in a binary vocabulary.")
+
+        words_blob = "\x00".join(self.index_to_word).encode("utf-8")
+        header = json.dumps({"content_hash": self.content_hash(),
+                             "correct_counts": self.correct_counts,
+                             "words": len(self),
+                             "bytes": len(words_blob)}).encode("utf-8")
+
+        with open(path, "wb") as f_out:
+            f_out.write(_BINARY_PREFIX.pack(
+                BINARY_MAGIC, BINARY_FORMAT_VERSION, len(header)))
+            f_out.write(header)
+            f_out.write(b"\x00" * (_binary_aligned(f_out.tell())
+                                   - f_out.tell()))
+            f_out.write(self.count_array.astype(np.int64).tobytes())
+            f_out.write(words_blob)
+
     def log_sample(self, size: int = 5):
         """Logs a sample of the vocabulary
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+
+Benchmark of the ensemble session execution. The script builds a synthetic
+model (a stack of dense layers) and measures how many batches per second the
+TensorFlow manager processes when the sessions of the ensemble run one after
+another and when they run in parallel.
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from neuralmonkey.dataset import Dataset
+from neuralmonkey.runners.base_runner import (BaseRunner, Executable,
+                                              ExecutionResult)
+from neuralmonkey.tf_manager import TensorFlowManager
+
+
+class SyntheticModel(object):
+    """A stack of dense layers applied on random input vectors."""
+
+    def __init__(self, hidden_size, layers, max_batch_size):
+        self._data = np.random.uniform(
+            -1, 1, [max_batch_size, hidden_size]).astype(np.float32)
+        self.input = tf.placeholder(tf.float32, [None, hidden_size])
+
+        hidden = self.input
+        for i in range(layers):
+            hidden = tf.layers.dense(hidden, hidden_size, tf.tanh,
+                                     name="layer_{}".format(i))
+        self.output = tf.reduce_mean(hidden)
+
+    def feed_dict(self, dataset, train=False):
+        # pylint: disable=unused-argument
+        return {self.input: self._data[:len(dataset)]}
+
+
+class SyntheticExecutable(Executable):
+
+    def __init__(self, all_coders, output):
+        self._all_coders = all_coders
+        self._output = output
+        self.result = None
+
+    def next_to_execute(self):
+        return self._all_coders, {"output": self._output}, {}
+
+    def collect_results(self, results):
+        self.result = ExecutionResult(
+            outputs=[np.mean([res["output"] for res in results])],
+            losses=[],
+            scalar_summaries=None,
+            histogram_summaries=None,
+            image_summaries=None)
+
+
+class SyntheticRunner(BaseRunner):
+
+    def get_executable(self, compute_losses=False, summaries=True):
+        return SyntheticExecutable(self.all_coders, self._decoder.output)
+
+    @property
+    def loss_names(self):
+        return []
+
+
+def measure(args, parallel_sessions):
+    """Get the number of batches processed per second."""
+    with tf.Graph().as_default():
+        model = SyntheticModel(args.hidden_size, args.layers, args.batch_size)
+        runner = SyntheticRunner("output", model)
+        tf_manager = TensorFlowManager(
+            num_sessions=args.sessions, num_threads=args.threads,
+            parallel_sessions=parallel_sessions)
+
+        dataset = Dataset("benchmark", {"source": [[]] * args.batch_size},
+                          {})
+
+        # warm up the sessions
+        tf_manager.execute(dataset, [runner], compute_losses=False)
+
+        start = time.time()
+        for _ in range(args.batches):
+            tf_manager.execute(dataset, [runner], compute_losses=False)
+        duration = time.time() - start
+
+        tf_manager.close()
+
+    return args.batches / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares serial and parallel ensemble execution.")
+    parser.add_argument("--sessions", type=int, default=4,
+                        help="Number of the ensembled sessions.")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="The num_threads of the TensorFlow manager.")
+    parser.add_argument("--batches", type=int, default=50,
+                        help="Number of the measured batches.")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="Number of the vectors in a batch.")
+    parser.add_argument("--hidden-size", type=int, default=1024,
+                        help="Size of the dense layers.")
+    parser.add_argument("--layers", type=int, default=8,
+                        help="Number of the dense layers.")
+    args = parser.parse_args()
+
+    serial = measure(args, parallel_sessions=False)
+    parallel = measure(args, parallel_sessions=True)
+
+    print("serial:   {:.2f} batches/s".format(serial))
+    print("parallel: {:.2f} batches/s".format(parallel))
+    print("speedup:  {:.2f}x".format(parallel / serial))
+
+
+if __name__ == "__main__":
+    main()